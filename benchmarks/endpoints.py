@@ -0,0 +1,412 @@
+# RAVENPOINT BENCHMARK: API ENDPOINTS
+# Generates synthetic lists at each size into a temporary SQLite database.
+# Each list has a single lookup to a categories list and a multi-lookup to a
+# tags list. Runs a matrix of reads ($select/$expand/$filter/$orderby/$top,
+# paging, streaming, cached), writes (create, MERGE, DELETE) and CSV uploads
+# against them. Latency percentiles, throughput and peak memory are written as
+# JSON, so runs on different commits can be compared with `--compare`.
+#
+# Usage: python benchmarks/endpoints.py [--sizes 1000 100000 1000000] [--requests 50]
+#          [--concurrency 1] [--server] [--uploads 1] [--output results.json]
+#          [--compare baseline.json]
+import argparse
+import csv
+import http.client
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import numpy as np
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+# Point the app at a temporary database before it is imported
+DATA_DIR = tempfile.mkdtemp(prefix='ravenpoint-bench-')
+os.environ['RAVENPOINT_DATABASE'] = os.path.join(DATA_DIR, 'bench.sqlite')
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_DIR)
+from werkzeug.serving import make_server
+from project import app, db
+from project.catalog import catalog
+from project.connections import connect
+from project.indexer import indexer
+from project.ingest import load_staging_table, build_junction_table
+from project.models import Table, Relationship
+
+STATUSES = ['Open', 'In Progress', 'Closed', 'On Hold']
+N_TAGS = 50
+MAX_TAGS_PER_ITEM = 3
+CHUNK_SIZE = 100000
+PERCENTILES = [50, 90, 95, 99]
+
+# Data generation
+def size_label(size):
+  for factor, suffix in [(1000000, 'm'), (1000, 'k')]:
+    if size >= factor and size % factor == 0:
+      return f'{size // factor}{suffix}'
+  return str(size)
+
+def get_list_names(size):
+  label = size_label(size)
+  return {'items': f'bm_items_{label}', 'categories': f'bm_categories_{label}', 'tags': f'bm_tags_{label}'}
+
+def generate_item_rows(size, n_categories, seed):
+  '''Yield chunks of item rows: Id, Title, Status, Amount, Quantity, CreatedAt, Category, Tags.'''
+  rng = np.random.default_rng(seed)
+  for start in range(0, size, CHUNK_SIZE):
+    n = min(CHUNK_SIZE, size - start)
+    ids = np.arange(start, start + n)
+    statuses = rng.choice(STATUSES, n)
+    amounts = np.round(rng.random(n) * 1000, 2)
+    quantities = rng.integers(0, 100, n)
+    created = (np.datetime64('2020-01-01') + rng.integers(0, 1500, n)).astype(str)
+    categories = rng.integers(0, n_categories, n)
+    n_tags = rng.integers(0, MAX_TAGS_PER_ITEM + 1, n)
+    tag_ids = rng.integers(0, N_TAGS, (n, MAX_TAGS_PER_ITEM))
+    tags = [','.join(map(str, row[:k])) or None for row, k in zip(tag_ids.tolist(), n_tags.tolist())]
+    yield list(zip(
+      ids.tolist(), [f'Item {i}' for i in ids.tolist()], statuses.tolist(), amounts.tolist(),
+      quantities.tolist(), created.tolist(), categories.tolist(), tags
+    ))
+
+def generate_list(size, seed=0):
+  '''Load and register a list of `size` items with its lookup lists. Returns the list names.'''
+  names = get_list_names(size)
+  n_categories = max(size // 100, 10)
+  load_staging_table(
+    names['categories'], ['"Id" INTEGER PRIMARY KEY', '"Title" TEXT', '"Code" TEXT'],
+    [[(i, f'Category {i}', f'C{i:06d}') for i in range(n_categories)]]
+  )
+  load_staging_table(
+    names['tags'], ['"Id" INTEGER PRIMARY KEY', '"Title" TEXT'],
+    [[(i, f'Tag {i}') for i in range(N_TAGS)]]
+  )
+  load_staging_table(
+    names['items'],
+    ['"Id" INTEGER PRIMARY KEY', '"Title" TEXT', '"Status" TEXT', '"Amount" REAL', '"Quantity" INTEGER',
+     '"CreatedAt" TEXT', '"Category" INTEGER', '"Tags" TEXT'],
+    generate_item_rows(size, n_categories, seed)
+  )
+  indexer.create_relationship_indexes(names['items'], 'Category', names['categories'], False)
+  build_junction_table(names['items'], 'Tags', names['tags'])
+  with app.app_context():
+    for name in names.values():
+      db.session.add(Table(name, name))
+    db.session.add(Relationship(names['items'], 'Category', names['categories'], 'Id', False))
+    db.session.add(Relationship(names['items'], 'Tags', names['tags'], 'Id', True))
+    db.session.commit()
+  catalog.invalidate()
+  return names
+
+def write_items_csv(table_db_name, filepath):
+  '''Export a list to CSV for the upload benchmark.'''
+  with connect() as conn:
+    cursor = conn.execute(f'SELECT * FROM {table_db_name}')
+    with open(filepath, 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow([col[0] for col in cursor.description])
+      while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+          break
+        writer.writerows(rows)
+
+# Clients
+class TestClient:
+  '''Sends requests through the Flask test client, one per thread.'''
+
+  def __init__(self):
+    self._local = threading.local()
+
+  def request(self, method, url, headers=None, body=None):
+    client = getattr(self._local, 'client', None)
+    if client is None:
+      client = self._local.client = app.test_client()
+    response = client.open(url, method=method, headers=headers or {}, data=body)
+    response.get_data()
+    return response.status_code
+
+class ServerClient:
+  '''Sends requests over HTTP to the app running in a threaded WSGI server.'''
+
+  def __init__(self):
+    # Don't log each request to stderr
+    logging.getLogger('werkzeug').setLevel('WARNING')
+    self.server = make_server('127.0.0.1', 0, app, threaded=True)
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+
+  def request(self, method, url, headers=None, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', self.server.port)
+    try:
+      conn.request(method, url, body=body, headers=headers or {})
+      response = conn.getresponse()
+      response.read()
+      return response.status
+    finally:
+      conn.close()
+
+  def close(self):
+    self.server.shutdown()
+
+# Scenarios. Each builds the i-th request as (method, url, headers, body).
+# Reads vary their filter or offset with `i` so they miss the result cache,
+# except `cached`, which repeats one read.
+def build_url(path, query=''):
+  return quote(path, safe="/$()'") + ('?' + quote(query, safe="$=&,/'()") if query else '')
+
+def get_scenarios(names, size):
+  items = names['items']
+  base = f"/ravenpoint/_api/web/lists/GetByTitle('{items}')/items"
+  item_type = f'SP.Data.{items}ListItem'
+  write_headers = {'X-RequestDigest': 'bench', 'Content-Type': 'application/json'}
+
+  def offset(i):
+    return (i * 7919) % max(size // 2, 1)
+
+  def read(query, headers=None):
+    return lambda i: ('GET', build_url(base, query(i)), headers, None)
+
+  def merge(i):
+    body = {'__metadata': {'type': item_type}, 'Title': f'Merged {i}', 'Amount': float(i)}
+    headers = {**write_headers, 'X-HTTP-Method': 'MERGE', 'IF-MATCH': '*'}
+    return 'POST', build_url(f'{base}({(i * 104729) % (size // 2)})'), headers, json.dumps(body)
+
+  def delete(i):
+    # Delete from the end of the list so MERGEs don't hit deleted items
+    headers = {**write_headers, 'X-HTTP-Method': 'DELETE', 'IF-MATCH': '*'}
+    return 'POST', build_url(f'{base}({size - 1 - i})'), headers, None
+
+  def create(i):
+    body = {
+      '__metadata': {'type': item_type}, 'Title': f'Created {i}', 'Status': 'Open',
+      'Amount': 1.5, 'Quantity': i, 'Category': i % 10, 'Tags': '1,2'
+    }
+    return 'POST', build_url(base), write_headers, json.dumps(body)
+
+  return [
+    ('top', 'read', read(lambda i: f'$top=100&$skip={offset(i)}')),
+    ('select', 'read', read(lambda i: f'$select=Id,Title,Amount,Status&$top=1000&$skip={offset(i)}')),
+    ('filter', 'read', read(lambda i: f"$filter=Amount gt {i % 1000} and Status eq 'Open'&$top=1000")),
+    ('orderby', 'read', read(lambda i: f'$orderby=Amount desc&$top=100&$skip={i}')),
+    ('expand', 'read', read(
+      lambda i: f'$select=Id,Title,Category/Title,Category/Code&$expand=Category&$filter=Id ge {offset(i)}&$top=1000'
+    )),
+    ('expand_multi', 'read', read(
+      lambda i: f'$select=Id,Title,Tags/Title&$expand=Tags&$filter=Id ge {offset(i)}&$top=1000'
+    )),
+    ('page', 'read', read(lambda i: f'$skip={offset(i)}')),
+    ('stream', 'read', read(
+      lambda i: f'$top=5000&$skip={offset(i)}', {'Accept': 'application/json;odata.streaming=true'}
+    )),
+    ('cached', 'read', read(lambda i: '$top=1000')),
+    ('create', 'write', create),
+    ('merge', 'write', merge),
+    ('delete', 'write', delete),
+  ]
+
+# Measurement
+def get_max_rss():
+  '''Peak resident memory of this process in bytes, or None where unsupported.'''
+  if resource is None:
+    return None
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def summarize(latencies, wall, statuses):
+  latencies_ms = np.array(latencies) * 1000
+  counts = {}
+  for status in statuses:
+    counts[str(status)] = counts.get(str(status), 0) + 1
+  return {
+    'requests': len(latencies),
+    'errors': sum([1 for status in statuses if status >= 400]),
+    'status_counts': counts,
+    'throughput_rps': len(latencies) / wall if wall else None,
+    'latency_ms': {
+      'min': float(latencies_ms.min()),
+      'mean': float(latencies_ms.mean()),
+      **{f'p{p}': float(np.percentile(latencies_ms, p)) for p in PERCENTILES},
+      'max': float(latencies_ms.max()),
+    },
+  }
+
+def measure_peak_alloc(client, build_request, i):
+  '''Peak Python memory allocated by one request, measured apart from the timed runs.'''
+  tracemalloc.start()
+  try:
+    client.request(*build_request(i))
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+def run_scenario(client, build_request, n_requests, concurrency):
+  def timed_request(i):
+    start = time.perf_counter()
+    status = client.request(*build_request(i))
+    return time.perf_counter() - start, status
+
+  # Warm up caches and connections outside the timed runs
+  client.request(*build_request(n_requests))
+  start = time.perf_counter()
+  if concurrency > 1:
+    with ThreadPoolExecutor(concurrency) as executor:
+      results = list(executor.map(timed_request, range(n_requests)))
+  else:
+    results = [timed_request(i) for i in range(n_requests)]
+  wall = time.perf_counter() - start
+  stats = summarize([r[0] for r in results], wall, [r[1] for r in results])
+  stats['peak_alloc_bytes'] = measure_peak_alloc(client, build_request, n_requests + 1)
+  return stats
+
+def run_uploads(names, size, n_uploads):
+  '''Upload the list as CSV through the admin dashboard and time each load job to completion.'''
+  # Uploads go through the test client, which can send the multipart form directly
+  client = app.test_client()
+  csv_path = os.path.join(DATA_DIR, f"{names['items']}.csv")
+  write_items_csv(names['items'], csv_path)
+  latencies, statuses = [], []
+  start = time.perf_counter()
+  for i in range(n_uploads):
+    table_name = f"bm_upload_{size_label(size)}_{i}"
+    upload_start = time.perf_counter()
+    with open(csv_path, 'rb') as f:
+      response = client.post('/', data={'csv_file': (f, f'{table_name}.csv'), 'table_name': table_name},
+                             content_type='multipart/form-data')
+    status = response.status_code
+    if status < 400:
+      description = f'Load {table_name}.csv as {table_name}'
+      while True:
+        job = next((job for job in client.get('/jobs.json').get_json()['data'] if job['description'] == description), None)
+        if job is not None and job['status'] in ['done', 'failed']:
+          status = 200 if job['status'] == 'done' else 500
+          break
+        time.sleep(0.05)
+    latencies.append(time.perf_counter() - upload_start)
+    statuses.append(status)
+  stats = summarize(latencies, time.perf_counter() - start, statuses)
+  stats['rows_per_second'] = size * len(latencies) / sum(latencies)
+  os.remove(csv_path)
+  return stats
+
+# Reporting
+def get_commit():
+  try:
+    return subprocess.run(
+      ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def print_summary(report):
+  print(f"{'size':>8} {'scenario':>13} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'errors':>6}", file=sys.stderr)
+  for run in report['runs']:
+    for name, stats in run['scenarios'].items():
+      latency = stats['latency_ms']
+      print(
+        f"{size_label(run['size']):>8} {name:>13} {latency['p50']:>9.2f} {latency['p95']:>9.2f} "
+        f"{latency['p99']:>9.2f} {stats['throughput_rps']:>8.1f} {stats['errors']:>6}", file=sys.stderr
+      )
+
+def print_comparison(baseline, report):
+  '''Print the change in p50/p95 latency and throughput from a baseline report.'''
+  def index(r):
+    return {(run['size'], name): stats for run in r['runs'] for name, stats in run['scenarios'].items()}
+
+  def change(old, new):
+    return f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+
+  old_stats = index(baseline)
+  print(f"Compared with {baseline['meta'].get('commit') or 'baseline'}:", file=sys.stderr)
+  print(f"{'size':>8} {'scenario':>13} {'p50':>9} {'p95':>9} {'req/s':>9}", file=sys.stderr)
+  for (size, name), stats in index(report).items():
+    old = old_stats.get((size, name))
+    if old is None:
+      continue
+    print(
+      f"{size_label(size):>8} {name:>13} {change(old['latency_ms']['p50'], stats['latency_ms']['p50']):>9} "
+      f"{change(old['latency_ms']['p95'], stats['latency_ms']['p95']):>9} "
+      f"{change(old['throughput_rps'], stats['throughput_rps']):>9}", file=sys.stderr
+    )
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the RavenPoint API endpoints.')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+  parser.add_argument('--requests', type=int, default=50, help='Timed requests per scenario')
+  parser.add_argument('--concurrency', type=int, default=1, help='Threads sending requests')
+  parser.add_argument('--server', action='store_true', help='Send requests to a real WSGI server over HTTP')
+  parser.add_argument('--uploads', type=int, default=1, help='CSV uploads per size (0 to skip)')
+  parser.add_argument('--scenarios', nargs='+', help='Only run these scenarios')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+  parser.add_argument('--compare', help='Baseline JSON report to compare with')
+  parser.add_argument('--keep', action='store_true', help='Keep the temporary database')
+  args = parser.parse_args()
+
+  # Keep request logs and CSRF checks out of the measurements
+  app.logger.setLevel('WARNING')
+  app.config['WTF_CSRF_ENABLED'] = False
+  app.config['UPLOAD_FOLDER'] = DATA_DIR
+  with app.app_context():
+    db.create_all()
+
+  client = ServerClient() if args.server else TestClient()
+  report = {
+    'meta': {
+      'commit': get_commit(),
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+      'python': platform.python_version(),
+      'sqlite': sqlite3.sqlite_version,
+      'platform': platform.platform(),
+      'client': 'server' if args.server else 'test_client',
+      'args': vars(args),
+    },
+    'runs': [],
+  }
+  try:
+    for size in args.sizes:
+      print(f'Generating {size} items...', file=sys.stderr)
+      start = time.perf_counter()
+      names = generate_list(size, args.seed)
+      run = {'size': size, 'generate_seconds': time.perf_counter() - start, 'scenarios': {}}
+      for name, kind, build_request in get_scenarios(names, size):
+        if args.scenarios and name not in args.scenarios:
+          continue
+        print(f'  {name}', file=sys.stderr)
+        run['scenarios'][name] = {'kind': kind, **run_scenario(client, build_request, args.requests, args.concurrency)}
+      if args.uploads and (not args.scenarios or 'upload' in args.scenarios):
+        print('  upload', file=sys.stderr)
+        run['scenarios']['upload'] = {'kind': 'upload', **run_uploads(names, size, args.uploads)}
+      run['max_rss_bytes'] = get_max_rss()
+      report['runs'].append(run)
+  finally:
+    if args.server:
+      client.close()
+    if not args.keep:
+      shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+  print_summary(report)
+  if args.compare:
+    with open(args.compare) as f:
+      print_comparison(json.load(f), report)
+  output = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(output)
+  else:
+    print(output)
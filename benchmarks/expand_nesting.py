@@ -0,0 +1,64 @@
+# RAVENPOINT BENCHMARK: $expand NESTING
+# Compares the old row-wise `DataFrame.apply` nesting of lookup columns with
+# the column-wise `nest_lookup_columns` for 1, 3 and 5 expanded lookups.
+#
+# Usage: python benchmarks/expand_nesting.py [--rows 50000] [--repeat 3]
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from project.utils import nest_lookup_columns
+
+# Nesting as previously done in the items GET handlers
+def clean_id_and_title(value):
+  if pd.isnull(value) or value is None:
+    return ''
+  if type(value) in [float, int]:
+    return int(value)
+  if type(value) == str:
+    return str(value)
+
+def nest_lookup_columns_apply(data, nested_col):
+  sub_cols = data.columns[data.columns.str.contains(nested_col + '__')]
+  data[nested_col] = data[sub_cols].apply(lambda x: {k.replace(f'{nested_col}__', ''): clean_id_and_title(v) for k, v in zip(x.index, x.values)}, axis=1)
+  return data.drop(sub_cols, axis=1)
+
+def make_data(n_rows, n_lookups):
+  rng = np.random.default_rng(0)
+  data = {'Id': np.arange(n_rows), 'Title': [f'Item {i}' for i in range(n_rows)]}
+  for i in range(n_lookups):
+    ids = rng.integers(0, 1000, n_rows).astype(float)
+    ids[rng.random(n_rows) < 0.1] = np.nan
+    data[f'lookup{i}__Id'] = ids
+    data[f'lookup{i}__Title'] = [None if np.isnan(x) else f'Lookup {int(x)}' for x in ids]
+  return pd.DataFrame(data)
+
+def time_nesting(func, data, n_lookups, repeat):
+  best = float('inf')
+  for _ in range(repeat):
+    df = data.copy()
+    start = time.perf_counter()
+    for i in range(n_lookups):
+      df = func(df, f'lookup{i}')
+    best = min(best, time.perf_counter() - start)
+  return best, df
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark $expand nesting.')
+  parser.add_argument('--rows', type=int, default=50000)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  print(f'Rows: {args.rows}, best of {args.repeat}')
+  print(f"{'lookups':>8} {'apply (s)':>10} {'columnar (s)':>13} {'speedup':>8}")
+  for n_lookups in [1, 3, 5]:
+    data = make_data(args.rows, n_lookups)
+    t_apply, out_apply = time_nesting(nest_lookup_columns_apply, data, n_lookups, args.repeat)
+    t_cols, out_cols = time_nesting(nest_lookup_columns, data, n_lookups, args.repeat)
+    assert out_apply.to_dict('records') == out_cols.to_dict('records')
+    print(f'{n_lookups:>8} {t_apply:>10.3f} {t_cols:>13.3f} {t_apply / t_cols:>7.1f}x')
@@ -1,4 +1,3 @@
-import logging
 import os
 
 from flask import Flask
@@ -10,26 +9,78 @@ from flask_sqlalchemy import SQLAlchemy
 # Initialise app
 app = Flask(__name__)
 
-# logging.basicConfig(filename='logs.log', level=logging.DEBUG, format=f'%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
-
 # Get base directory
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 # App configs
 app.config['SECRET_KEY'] = 'ravenpoint'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'data', 'data.sqlite')
+# SQLite database; RAVENPOINT_DATABASE points the app at another file, e.g. for benchmarks
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.environ.get(
+  'RAVENPOINT_DATABASE', os.path.join(basedir, 'data', 'data.sqlite')
+)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 5}}
+# Pragmas for pooled SQLite connections (see project/connections.py)
+app.config['SQLITE_PRAGMAS'] = {
+  'journal_mode': 'WAL',
+  'synchronous': 'NORMAL',
+  'cache_size': -65536,
+  'mmap_size': 268435456,
+  'busy_timeout': 5000,
+  'temp_store': 'MEMORY'
+}
 app.config['RESTPLUS_MASK_SWAGGER'] = False
 app.config['SWAGGER_UI_DOC_EXPANSION'] = 'list'
 app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'static', 'files')
+# Default page size for list items; requests past it get a `__next` link
+app.config['ITEMS_PAGE_SIZE'] = 5000
+# Rows fetched per chunk for streamed list items (`odata.streaming=true`)
+app.config['ITEMS_STREAM_CHUNK_SIZE'] = 1000
+# Rows per chunk/transaction and rows sampled for type inference in CSV uploads
+app.config['INGEST_CHUNK_SIZE'] = 50000
+app.config['INGEST_SAMPLE_ROWS'] = 10000
+# Uses of a column in $filter/$orderby before it is indexed (None to disable)
+app.config['AUTO_INDEX_THRESHOLD'] = 20
+# Worker threads for background admin jobs (CSV loads, table drops, junction tables)
+app.config['JOB_WORKERS'] = 1
+# LRU cache of list items responses: max entries (0 to disable), total bytes and TTL in seconds
+app.config['RESULT_CACHE_MAX_ENTRIES'] = 256
+app.config['RESULT_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+app.config['RESULT_CACHE_TTL'] = 60
+# Compiled list items query plans to keep, by query shape (0 to disable)
+app.config['PLAN_CACHE_MAX_ENTRIES'] = 512
+# Recent requests per route used for the latency quantiles at `/metrics`
+app.config['METRICS_WINDOW'] = 1024
+# Fraction of requests to profile with cProfile (0 to disable); profiles of
+# requests slower than PROFILE_SLOW_SECONDS are saved to PROFILE_DIR
+app.config['PROFILE_SAMPLE_RATE'] = 0
+app.config['PROFILE_SLOW_SECONDS'] = 1.0
+app.config['PROFILE_DIR'] = os.path.join(basedir, 'data', 'profiles')
+# Log level of the `project` loggers, per-logger overrides (e.g.
+# {'project.api': 'DEBUG'} to log list items SQL) and a file to log to
+# instead of stderr
+app.config['LOG_LEVEL'] = 'INFO'
+app.config['LOG_LEVELS'] = {}
+app.config['LOG_FILE'] = None
+
+# Logging
+from project.logs import setup_logging
+setup_logging(app.config)
 
-print(basedir)
 # CORS
 CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}})
 
 db = SQLAlchemy(app)
 Migrate(app, db)
 
+# Create the tables for list and item versions and row counts
+from project.connections import connect
+from project.versions import create_versions_tables
+from project.rowcounts import create_row_counts_table
+with connect() as conn:
+  create_versions_tables(conn)
+  create_row_counts_table(conn)
+
 # Import blueprints
 from project.api import api, api_namespace
 from project.admin.views import admin
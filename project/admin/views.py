@@ -1,14 +1,24 @@
 import json
+import logging
 import os
 import pandas as pd
-import sqlite3
 
-from flask import render_template, Blueprint, url_for, redirect, request, flash, send_from_directory
+from flask import render_template, Blueprint, url_for, redirect, request, flash, send_from_directory, Response
 from project import db, app
+from project.cache import results
+from project.catalog import catalog
+from project.connections import connect
+from project.indexer import indexer
+from project.ingest import ingest_csv, build_junction_table, get_drop_junction_sync_sql
+from project.jobs import jobs
+from project.metrics import metrics, format_cache_metrics
+from project.plans import plans
+from project.rowcounts import forget_row_count
+from project.versions import bump_list_version
 from project.admin.forms import UploadData, EditRelationship,UploadFile,CreateUser
 from project.models import Table, Relationship
 from project.utils import get_all_table_names, get_all_table_metadata, translate_odata, \
-    get_all_relationships
+    get_all_relationships, get_table_page
 from werkzeug.utils import secure_filename
 
 admin = Blueprint(
@@ -16,8 +26,74 @@ admin = Blueprint(
     template_folder='templates'
 )
 
-# Configure connection string
-conn_string = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
+logger = logging.getLogger(__name__)
+
+# Background jobs for long-running admin operations. Each takes a progress
+# callback and returns a message for the Jobs page.
+def load_table_job(progress, filepath, table_name, table_db_name):
+    try:
+        # Add table to database in chunks, then cleanup. Check the register
+        # first: uploading to a registered list replaces its table, but a new
+        # list must not replace another list's table.
+        try:
+            registered = Table.query.filter_by(table_db_name=table_db_name).first()
+            if registered is not None and registered.table_name != table_name:
+                raise ValueError(f'Table {table_db_name} already belongs to the list {registered.table_name}.')
+            n_rows = ingest_csv(filepath, table_db_name, progress=progress)
+        finally:
+            os.remove(filepath)
+
+        # Replacing the table drops its relationship indexes and the triggers
+        # syncing its junction tables
+        for rship in Relationship.query.filter_by(table_left=table_db_name).all():
+            if rship.is_multi:
+                build_junction_table(rship.table_left, rship.table_left_on, rship.table_lookup)
+            else:
+                indexer.create_relationship_indexes(rship.table_left, rship.table_left_on,
+                                                    rship.table_lookup, False)
+
+        # Add table to register, unless the list was already registered
+        if registered is None:
+            db.session.add(Table(table_name, table_db_name))
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        # The columns may have changed even if a step after the swap failed
+        catalog.invalidate()
+        indexer.forget(table_db_name)
+    action = 'reloaded' if registered is not None else 'loaded'
+    return f'Successfully {action} {n_rows} rows into database as {table_name}.'
+
+def drop_table_job(progress, id, table_db_name):
+    progress(0, 1, force=True)
+    with connect() as conn:
+        conn.execute(f'DROP TABLE {table_db_name}')
+        conn.execute('DELETE FROM tables WHERE id = ?', (id,))
+        forget_row_count(conn, table_db_name)
+    catalog.invalidate()
+    indexer.forget(table_db_name)
+    progress(1, 1, force=True)
+    return f'Deleted {table_db_name}.'
+
+def bump_list_versions(*table_db_names):
+    # Reads that expand a relationship change with it, so their ETags must too
+    with connect() as conn:
+        for table_db_name in set(table_db_names):
+            bump_list_version(conn, table_db_name)
+
+def add_multi_relationship_job(progress, table_left, table_left_on, table_lookup, description):
+    n_rows = build_junction_table(table_left, table_left_on, table_lookup, progress=progress)
+    try:
+        db.session.add(Relationship(table_left, table_left_on, table_lookup, 'Id', True, description))
+        db.session.commit()
+        catalog.invalidate()
+        bump_list_versions(table_left)
+    except Exception:
+        db.session.rollback()
+        raise
+    return f'Built junction table {table_left}_{table_lookup} with {n_rows} rows.'
 
 @admin.route('/', methods=['GET', 'POST'])
 def index():
@@ -30,7 +106,7 @@ def index():
     form = UploadData()
 
     # Get tables metadata
-    with sqlite3.connect(conn_string) as conn:
+    with connect() as conn:
         all_tables = get_all_table_names(conn)
         table_metadata = get_all_table_metadata(conn, all_tables)
 
@@ -42,46 +118,22 @@ def index():
             csv_file = request.files['csv_file']
             filename = secure_filename(csv_file.filename)
             filepath = os.path.join(upload_dir, filename)
-            print(filepath)
+            logger.info('Saving upload to %s', filepath)
             csv_file.save(filepath)
             
-            # Read data and cleanup
-            df = pd.read_csv(filepath)
-            os.remove(filepath)
-
-            # Check that data includes `id` column
-            if 'Id' in df.columns:
-                df = df.rename(columns={'Id': 'Old_Id'})
-                df = df.reset_index().rename(columns={'index': 'Id'})
-            
             table_name = form.table_name.data
             table_db_name = secure_filename(form.table_name.data).lower()
 
-            # Load into sqlite
-            try:
-                # Add table to database
-                with sqlite3.connect(conn_string) as conn:
-                    df.to_sql(table_db_name, con=conn, if_exists='replace', index=False,
-                            dtype={f'{df.columns[0]}': 'INTEGER PRIMARY KEY'})
-
-                # Add table to register
-                new_table = Table(table_name, table_db_name)
-                db.session.add(new_table)
-                db.session.commit()
-
-            except Exception as e:
-                print('Error loading data into database:')
-                print(e)
-                db.session.rollback()
-                flash(f"Failed to load data into database:\n{e}", 'danger')
-                return redirect(url_for('admin.index'))
+            # Load into sqlite in the background
+            jobs.submit('load_table', f'Load {filename} as {table_name}', load_table_job,
+                        filepath, table_name, table_db_name)
 
             # Message
-            flash(f'Successfully loaded data into database as {table_name}.', 'success')
+            flash(f'Loading data into database as {table_name}. Check the Jobs page for progress.', 'success')
             return redirect(url_for('admin.index'))
     
         else:
-            print(form.errors)
+            logger.debug('Upload form errors', extra={'errors': form.errors})
             for field, error_msg in form.errors.items():
                 flash(f'Form submission failed: {" ".join(error_msg)}', 'danger')
     
@@ -93,14 +145,52 @@ def table_view(id):
     # Get table
     table = Table.query.filter_by(id=id).first_or_404()
     
-    # Connect to database
-    with sqlite3.connect(conn_string) as conn:
-        # Get data
-        df = pd.read_sql(f'SELECT * FROM {table.table_db_name}', conn)
+    # Rows are fetched a page at a time from `table_rows`
+    columns = catalog.get_table_by_db_name(table.table_db_name)['columns']
+
+    # Get indexes and column usage in $filter/$orderby
+    indexes = indexer.get_indexes(table.table_db_name)
+    indexed_cols = set([index['columns'][0] for index in indexes if len(index['columns']) == 1])
+    usage = [{'column': col, 'uses': n, 'indexed': col in indexed_cols}
+             for col, n in indexer.get_usage(table.table_db_name)]
     
-    return render_template('table.html', table=df.to_dict('records'), id=id,
-                            columns=df.columns.tolist(), table_name=table.table_name,
-                            table_db_name=table.table_db_name)
+    return render_template('table.html', id=id, columns=columns, table_name=table.table_name,
+                            table_db_name=table.table_db_name, indexes=indexes,
+                            usage=usage)
+
+# Table rows endpoint for the table view, with server-side paging, sorting and filtering
+@admin.route('/table/<string:id>/rows.json', methods=['GET'])
+def table_rows(id):
+    table = Table.query.filter_by(id=id).first_or_404()
+    columns = catalog.get_table_by_db_name(table.table_db_name)['columns']
+    try:
+        with connect() as conn:
+            return get_table_page(conn, table.table_db_name, columns, request.args)
+    except ValueError as e:
+        return {'error': f'Invalid table view parameters: {e}'}, 400
+
+# Create index endpoint
+@admin.route('/table/<string:id>/index', methods=['POST'])
+def table_index_create(id):
+    table = Table.query.filter_by(id=id).first_or_404()
+    column = request.form.get('column', '')
+    try:
+        name = indexer.create_index(table.table_db_name, column)
+        flash(f'Created index {name}.', 'success')
+    except Exception as e:
+        flash(f'Error: Could not create index on {column}. \n{e}', 'danger')
+    return redirect(url_for('admin.table_view', id=id))
+
+# Drop index endpoint
+@admin.route('/table/<string:id>/index/<string:name>/delete', methods=['POST'])
+def table_index_delete(id, name):
+    Table.query.filter_by(id=id).first_or_404()
+    try:
+        indexer.drop_index(name)
+        flash(f'Dropped index {name}.', 'success')
+    except Exception as e:
+        flash(f'Error: Could not drop index {name}. \n{e}', 'danger')
+    return redirect(url_for('admin.table_view', id=id))
 
 # Delete table endpoint
 @admin.route('/table/<string:id>/delete', methods=['POST'])
@@ -108,17 +198,9 @@ def table_delete(id):
     # Delete id
     table = Table.query.filter_by(id=id).first_or_404()
     # print(table)
-    # Run delete query
-    with sqlite3.connect(conn_string) as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute(f'DROP TABLE {table.table_db_name}')
-            cursor.execute(f"DELETE FROM tables WHERE id='{id}'")
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            flash(f'Error: Could not delete {table.table_db_name}. \n{e}', 'danger')
-            return redirect(url_for('admin.table_view', id=id))
+    # Run delete query in the background
+    jobs.submit('drop_table', f'Delete {table.table_name}', drop_table_job, id, table.table_db_name)
+    flash(f'Deleting {table.table_name}. Check the Jobs page for progress.', 'success')
     return redirect(url_for('admin.index'))
         
 
@@ -129,7 +211,7 @@ def relationships():
     form = EditRelationship()
     
     # Get all relationships
-    with sqlite3.connect(conn_string) as conn:
+    with connect() as conn:
         all_relationships = get_all_relationships(conn)
     if request.method == 'POST':
         if form.validate_on_submit():
@@ -145,31 +227,20 @@ def relationships():
             new_rship = Relationship(table_left, table_left_on, table_lookup, 
                                      table_lookup_on, is_multi, description)
 
-            # Create new junction table
+            # Create new junction table in the background, then add the relationship
             if is_multi:
-                # Get left table
-                with sqlite3.connect(conn_string) as conn:
-                    df = pd.read_sql(F'SELECT * FROM {table_left}', con=conn)
-                
-                    # Transform lookup table into a junction table
-                    df[table_left_on] = df[table_left_on].str.split(',')
-                    df = df[['Id', table_left_on]].explode(table_left_on)
-                    
-                    # Clean data format and index and column names
-                    df[table_left_on] = pd.to_numeric(df[table_left_on])
-                    df = df.dropna()
-                    df[table_left_on] = df[table_left_on].astype(int)
-                    df = df.reset_index(drop=True).reset_index()
-                    df = df.rename(columns={'Id': f'{table_left}_pk', table_left_on: f'{table_lookup}_pk', 'index': 'Id'})
-
-                    # Save to database
-                    df.to_sql(f'{table_left}_{table_lookup}', con=conn, if_exists='replace', index=False,
-                                dtype={f'{df.columns[0]}': 'INTEGER PRIMARY KEY'})
-            
+                jobs.submit('build_junction_table', f'Build junction table {table_left}_{table_lookup}',
+                            add_multi_relationship_job, table_left, table_left_on, table_lookup, description)
+                flash(f'Building junction table {table_left}_{table_lookup}. Check the Jobs page for progress.', 'success')
+                return redirect(url_for('admin.relationships'))
+
             # Commit changes
             try:
                 db.session.add(new_rship)
                 db.session.commit()
+                catalog.invalidate()
+                bump_list_versions(table_left)
+                indexer.create_relationship_indexes(table_left, table_left_on, table_lookup, False)
             except Exception as e:
                 db.session.rollback()
                 flash(f"Failed to load data into database:\n{e}", 'danger')
@@ -177,12 +248,14 @@ def relationships():
             
             return redirect(url_for('admin.relationships'))
         else:
-            # Print errors
-            for field, error_msg in form.errors.items():
-                for err in error_msg:
-                    print(f"{field}:  {err}")
-    return render_template('relationships.html', form=form,
-                           relationships=all_relationships.to_dict('records'))
+            logger.debug('Relationship form errors', extra={'errors': form.errors})
+    # Add the status of the indexes backing each relationship
+    relationships = all_relationships.to_dict('records')
+    for rship in relationships:
+        rship['indexes'] = indexer.get_relationship_indexes(
+            rship['table_left'], rship['table_left_on'], rship['table_lookup'], bool(rship['is_multi'])
+        )
+    return render_template('relationships.html', form=form, relationships=relationships)
 
 
 @admin.route('/files', methods=['GET', 'POST'])
@@ -200,7 +273,7 @@ def files():
             file = request.files['file']
             filename = secure_filename(file.filename)
             filepath = os.path.join(fulldir, filename)
-            print(filepath)
+            logger.info('Saving file to %s', filepath)
             file.save(filepath)
             flash(
                 f'Successfully loaded file as {file.filename}.', 'success')
@@ -224,13 +297,12 @@ def file_delete(file_name):
     files = os.listdir(fulldir)
 
     if request.method == 'POST':
-        print(file_name)
         if file_name in files:
 
             # Upload file to server
    
             filepath = os.path.join(fulldir, file_name)
-            print(filepath)
+            logger.info('Deleting file %s', filepath)
             os.remove(filepath)
             flash(
                 f'Successfully deleted file  {file_name}.', 'success')
@@ -246,8 +318,7 @@ def users():
             username = form.username.data
             email = username+"@defencemail.gov.sg"
             df = pd.DataFrame({'Title': [username], 'Email': [email]})
-            print(df)
-            with sqlite3.connect(conn_string) as conn:
+            with connect() as conn:
                 cursor = conn.cursor()
                 try:
                    res = cursor.execute(''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='rpusers' ''')
@@ -260,14 +331,14 @@ def users():
                        df.to_sql('rpusers', con=conn, if_exists='append', index=False)
                        db.session.commit()
                 except Exception as e:
-                    print("user create error:",e)
+                    logger.exception('Could not create user %s', username)
                     db.session.rollback()
                     
                 finally:
                     return redirect(url_for('admin.users'))
     else:
         try:
-            with sqlite3.connect(conn_string) as conn:
+            with connect() as conn:
                 df = pd.read_sql('''SELECT * FROM rpusers''', con=conn)
                 users = df.to_dict('records')
         except Exception as e:
@@ -277,13 +348,13 @@ def users():
 @admin.route('/users/<int:id>/delete', methods=['POST'])
 def user_delete(id):
     if request.method == 'POST':
-        with sqlite3.connect(conn_string) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute('''DELETE FROM rpusers WHERE Id=?''',(id,))
                 db.session.commit()
             except Exception as e:
-                print("user delete error:",e)
+                logger.exception('Could not delete user %s', id)
                 db.session.rollback()
             finally:
                 return redirect(url_for('admin.users'))
@@ -313,6 +384,8 @@ def relationship(id):
         form.description.data = rship.description
 
     if request.method == 'POST' and form.validate_on_submit():
+        old_join = (rship.table_left, rship.table_left_on, rship.table_lookup, rship.is_multi)
+
         # Extract form data
         rship.table_left = form.table_left.data
         rship.table_left_on = form.table_left_on.data
@@ -321,6 +394,14 @@ def relationship(id):
         rship.is_multi = form.is_multi.data
         rship.description = form.description.data
         db.session.commit()
+        catalog.invalidate()
+        bump_list_versions(old_join[0], rship.table_left)
+
+        # Move the join indexes to the new columns
+        new_join = (rship.table_left, rship.table_left_on, rship.table_lookup, rship.is_multi)
+        if new_join != old_join:
+            indexer.drop_relationship_indexes(*old_join)
+        indexer.create_relationship_indexes(*new_join)
         return redirect(url_for('admin.relationships'))
 
     return render_template('relationship.html', form=form, id=id, rship=json.dumps(output))
@@ -338,15 +419,66 @@ def relationship_delete(id):
     try:
             
         if rship.is_multi:
+            for statement in get_drop_junction_sync_sql(rship.table_left, rship.table_lookup):
+                db.session.execute(statement)
             db.session.execute(f'DROP TABLE {rship.table_left}_{rship.table_lookup}')
         db.session.delete(rship)
         db.session.commit()
+        catalog.invalidate()
+        bump_list_versions(rship.table_left)
+        indexer.drop_relationship_indexes(rship.table_left, rship.table_left_on,
+                                          rship.table_lookup, rship.is_multi)
     except Exception as e:
         db.session.rollback()
         flash(f'Error: Could not delete relationship ID={rship.rship_id}. \n{e}', 'danger')
         return redirect(url_for('admin.relationships'))
     return redirect(url_for('admin.relationships'))
 
+@admin.route('/relationship/<int:id>/indexes', methods=['POST'])
+def relationship_indexes(id):
+    # Create missing join indexes, e.g. for relationships added before they were managed
+    rship = Relationship.query.get(id)
+    try:
+        indexer.create_relationship_indexes(rship.table_left, rship.table_left_on,
+                                            rship.table_lookup, rship.is_multi)
+        flash(f'Created indexes for relationship ID={rship.rship_id}.', 'success')
+    except Exception as e:
+        flash(f'Error: Could not create indexes for relationship ID={rship.rship_id}. \n{e}', 'danger')
+    return redirect(url_for('admin.relationships'))
+
+@admin.route('/jobs', methods=['GET'])
+def jobs_view():
+    return render_template('jobs.html', jobs=jobs.get_jobs())
+
+@admin.route('/jobs.json', methods=['GET'])
+def jobs_json():
+    return {'data': jobs.get_jobs()}
+
+@admin.route('/jobs/<string:job_id>.json', methods=['GET'])
+def job_json(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return {'message': 'Job does not exist.'}, 404
+    return job
+
+@admin.route('/cache.json', methods=['GET'])
+def cache_json():
+    return results.get_stats()
+
+@admin.route('/plans.json', methods=['GET'])
+def plans_json():
+    return plans.get_stats()
+
+# Request latency by route and stage, and result and plan cache stats, for Prometheus
+@admin.route('/metrics', methods=['GET'])
+def metrics_text():
+    body = metrics.format_prometheus() + \
+        format_cache_metrics('result_cache', results.get_stats(),
+                             ['hits', 'misses', 'expired', 'evictions', 'skipped'], ['entries', 'bytes']) + \
+        format_cache_metrics('plan_cache', plans.get_stats(),
+                             ['hits', 'misses', 'evictions', 'invalidations'], ['entries'])
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 @admin.route('/guide', methods=['GET'])
 def guide():
     return render_template('guide.html')
@@ -354,7 +486,7 @@ def guide():
 
 @admin.route('/get_tables', methods=['GET'])
 def get_tables():
-    with sqlite3.connect(conn_string) as conn:
+    with connect() as conn:
         all_tables = get_all_table_names(conn)
         table_metadata = get_all_table_metadata(conn, all_tables)
         table_metadata['columns'] = table_metadata['columns'].str.replace(' ', '', regex=False)
@@ -1,17 +1,31 @@
 import json
+import logging
 import os
 import numpy as np
 import pandas as pd
-import sqlite3
 import time
+from urllib.parse import urlencode
 
-from flask import Blueprint, request, jsonify, send_from_directory,Response 
+from flask import Blueprint, request, jsonify, send_from_directory,Response, stream_with_context
 from flask_restx import Namespace, Resource, fields
+from flask_restx.representations import output_json
 from project import db, app
-from project.utils import get_all_table_names, get_all_relationships, parse_odata_filter, \
-  parse_odata_query, validate_create_update_query, validate_delete_query, \
-  validate_create_update_query_listname, validate_delete_query_listname, validate_file_query
-from werkzeug.exceptions import BadRequest
+from project.catalog import catalog
+from project.connections import connect
+from project.utils import parse_odata_filter, parse_odata_query, validate_create_update_query, \
+  validate_delete_query, validate_create_update_query_listname, validate_delete_query_listname, \
+  validate_file_query, build_insert_query, insert_items, build_update_query, build_delete_query, \
+  read_sql, QueryStats, parse_odata_paging, nest_lookup_columns, clean_lookup_value, has_column
+from project.batch import BatchError, parse_batch, run_batch, format_batch_response, get_list_item_type
+from project.cache import results
+from project.indexer import indexer
+from project.rowcounts import adjust_row_count
+from project.versions import bump_list_version, record_item_change, get_list_versions, get_list_etag, \
+  get_item_version, format_item_etag
+from project.metrics import span, timed
+from project.plans import plans
+from project.odata import ODataFilterError, ODataQueryError, parse_orderby, get_filter_shape, fill_params
+from werkzeug.exceptions import BadRequest, PreconditionFailed
 
 # Create blueprint
 api = Blueprint(
@@ -19,12 +33,19 @@ api = Blueprint(
   template_folder='api_templates'
 )
 
-# Connection string
-conn_string = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
-
 # Create namespace
 api_namespace = Namespace('_api', 'RavenPoint REST API endpoints')
 
+logger = logging.getLogger(__name__)
+
+# Serialize a response as flask-restx would, with an ETag of its body, so
+# clients polling with If-None-Match get 304 Not Modified
+def conditional_json(output):
+  with span('serialize'):
+    response = Response(output_json(output, 200).get_data(), mimetype='application/json')
+  response.add_etag()
+  return response.make_conditional(request)
+
 # Hello world example
 hello_world_model = api_namespace.model(
   'Hello World', {
@@ -76,11 +97,10 @@ class ListMetadata(Resource):
   
   def get(self, list_id):
     '''RavenPoint list metadata endpoint'''
-    print(request.args.items())
+    logger.debug('List metadata requested', extra={'args': request.args.to_dict(flat=False)})
     # Check if list exists
-    with sqlite3.connect(conn_string) as conn:
-      all_tables = get_all_table_names(conn)
-    if list_id not in all_tables.id.tolist():
+    curr_table = catalog.get_table(list_id)
+    if curr_table is None:
       raise BadRequest('List does not exist.')
     
     # Extract URL params
@@ -91,15 +111,17 @@ class ListMetadata(Resource):
       params[k] = v
     
     # Get metadata
-    table = all_tables \
-        .rename(columns={'id': 'Id'}) \
-        .loc[all_tables.id.eq(list_id)].to_dict('records')[0]
+    table = {
+      'Id': curr_table['id'],
+      'table_name': curr_table['table_name'],
+      'table_db_name': curr_table['table_db_name']
+    }
     table_pascal = table['table_db_name'].title().replace('_', '')
     table['ListItemEntityTypeFullName'] = f'SP.Data.{table_pascal}ListItem'
 
     # Return all if no specified fields specified
     if '$select' not in params.keys():
-        return {'d': table}
+        return conditional_json({'d': table})
     
     # Extract requested fields
     fields = params['$select'].split(',')
@@ -111,7 +133,7 @@ class ListMetadata(Resource):
     for field in fields:
       output[field] = table[field]
 
-    return {'d': output}
+    return conditional_json({'d': output})
 
 
 # Endpoint for list metadata by GetByTitle
@@ -129,11 +151,10 @@ class ListByTitleMetadata(Resource):
   
   def get(self, list_name):
     '''RavenPoint list metadata endpoint'''
-    print(request.args.items())
+    logger.debug('List metadata requested', extra={'args': request.args.to_dict(flat=False)})
     # Check if list exists
-    with sqlite3.connect(conn_string) as conn:
-      all_tables = get_all_table_names(conn)
-    if list_name not in all_tables.table_name.tolist():
+    curr_table = catalog.get_table_by_title(list_name)
+    if curr_table is None:
       raise BadRequest('List does not exist.')
     
     # Extract URL params
@@ -144,15 +165,17 @@ class ListByTitleMetadata(Resource):
       params[k] = v
     
     # Get metadata
-    table = all_tables \
-        .rename(columns={'id': 'Id'}) \
-        .loc[all_tables.table_name.eq(list_name)].to_dict('records')[0]
+    table = {
+      'Id': curr_table['id'],
+      'table_name': curr_table['table_name'],
+      'table_db_name': curr_table['table_db_name']
+    }
     table_pascal = table['table_db_name'].title().replace('_', '')
     table['ListItemEntityTypeFullName'] = f'SP.Data.{table_pascal}ListItem'
 
     # Return all if no specified fields specified
     if '$select' not in params.keys():
-        return {'d': table}
+        return conditional_json({'d': table})
     
     # Extract requested fields
     fields = params['$select'].split(',')
@@ -164,7 +187,7 @@ class ListByTitleMetadata(Resource):
     for field in fields:
       output[field] = table[field]
 
-    return {'d': output}
+    return conditional_json({'d': output})
 
 # Endpoint for getting list items
 lietfn_model = api_namespace.model(
@@ -218,15 +241,523 @@ create_update_model = api_namespace.model(
   }
 )
 
+# URL params accepted by the list items endpoints
+ITEMS_KEYWORDS = ['$select', '$filter', '$expand', '$orderby', '$top', '$skip', '$skiptoken']
+
+# Hidden columns carrying each row's Id and sort values for keyset paging
+PAGE_ID_COL = 'rp_page_id'
+SORT_COL_PREFIX = 'rp_sort_'
+
+# Resolve `$orderby` into SQL sort terms. Id is always the final tie-breaker
+# so that pages can be keyed on it.
+def resolve_orderby(query, curr_table, joins, used_columns):
+  curr_db_table = curr_table['table_db_name']
+  order_by = []
+  if query:
+    try:
+      terms = parse_orderby(query)
+    except ODataQueryError as e:
+      raise BadRequest(str(e))
+    for column, desc in terms:
+      if column.lookup is None:
+        if column.name not in curr_table['columns']:
+          raise BadRequest(f"Invalid $orderby: column '{column.name}' does not exist.")
+        table = curr_db_table
+        key = 'ID' if column.name == 'Id' else column.name
+      else:
+        join = joins.get(column.lookup)
+        if join is None:
+          raise BadRequest(f'Lookup field {column.lookup} not specified in $expand parameter.')
+        if join['is_multi']:
+          raise BadRequest(f'Invalid $orderby: cannot sort by multi-lookup field {column.lookup}.')
+        table = join['table']
+        if not has_column(table, column.name):
+          raise BadRequest(f"Invalid $orderby: column '{column.lookup}/{column.name}' does not exist.")
+        key = f'{column.lookup}/{column.name}'
+      used_columns.append((table, column.name))
+      order_by.append({'sql': f'{table}.{column.name}', 'desc': desc, 'key': key})
+  if not any([term['key'] == 'ID' for term in order_by]):
+    order_by.append({'sql': f'{curr_db_table}.Id', 'desc': False, 'key': 'ID'})
+  return order_by
+
+# Build the condition for rows that sort after the previous page's last row.
+# NULLs sort first in SQLite, so they are handled explicitly.
+def build_keyset_clause(order_by, paging):
+  clauses, params = [], []
+  equal_clauses, equal_params = [], []
+  for term in order_by:
+    col = term['sql']
+    value = paging['after_id'] if term['key'] == 'ID' else paging['after'].get(term['key'])
+    if value is None:
+      after_sql, after_params = (None, []) if term['desc'] else (f'{col} IS NOT NULL', [])
+      equal_sql, equal_value = f'{col} IS NULL', []
+    else:
+      after_sql = f'({col} < ? OR {col} IS NULL)' if term['desc'] else f'{col} > ?'
+      after_params = [value]
+      equal_sql, equal_value = f'{col} = ?', [value]
+    if after_sql is not None:
+      clauses.append(' AND '.join(equal_clauses + [after_sql]))
+      params.extend(equal_params + after_params)
+    equal_clauses.append(equal_sql)
+    equal_params.extend(equal_value)
+  if not clauses:
+    return '0', []
+  return '(' + ' OR '.join([f'({clause})' for clause in clauses]) + ')', params
+
+# Build the WHERE/ORDER BY/LIMIT clauses for a page of list items. Pages are
+# keyed on the sort values and Id of the last item
+# (`$skiptoken=Paged=TRUE&p_ID=<Id>`), so deep pages cost the same as the
+# first one. One extra row is fetched to tell if there is a next page.
+def build_paging_query(curr_db_table, paging, order_by, where_clauses, where_params, group_by=None):
+  page_clauses = list(where_clauses)
+  if paging['after_id'] is not None:
+    page_clauses.append(build_keyset_clause(order_by, paging)[0])
+  sql = f"WHERE {' AND '.join(page_clauses)} " if page_clauses else ''
+  if group_by:
+    sql += f'GROUP BY {group_by} '
+  sql += 'ORDER BY ' + ', '.join([term['sql'] + (' DESC' if term['desc'] else '') for term in order_by])
+  if has_limit(paging):
+    sql += ' LIMIT ? OFFSET ?'
+  return sql, list(where_params) + get_paging_params(order_by, paging)
+
+def has_limit(paging):
+  return paging['page_size'] is not None or paging['skip'] > 0
+
+# Get the bind values of the keyset and LIMIT clauses from `build_paging_query`
+def get_paging_params(order_by, paging):
+  params = []
+  if paging['after_id'] is not None:
+    params.extend(build_keyset_clause(order_by, paging)[1])
+  if has_limit(paging):
+    params.extend([-1 if paging['page_size'] is None else paging['page_size'] + 1, paging['skip']])
+  return params
+
+# Get the parts of the paging params that change the SQL: whether there is a
+# LIMIT and which sort values the keyset clause compares against
+def get_paging_shape(paging):
+  if paging['after_id'] is None:
+    return has_limit(paging), None
+  return has_limit(paging), tuple(sorted(paging['after']))
+
+# Aggregate the selected fields of a multi-lookup column into a JSON array of
+# objects per item, e.g. `[{"Id": 1, "Title": "A"}, ...]`, with one object per
+# linked lookup item. Each multi-lookup is read by its own subquery, so
+# expanding several of them doesn't multiply each other's values. Items
+# without lookup values get an empty array.
+def get_multi_lookup_alias(curr_db_table, lookup_col, lookup_table, fields):
+  junction_table = f'{curr_db_table}_{lookup_table}'
+  pairs = ', '.join([f"'{field}', ifnull(rp_lookup.{field}, '')" for field in fields])
+  return f"(SELECT json_group_array(json_object({pairs})) " + \
+    f"FROM {junction_table} AS rp_junction JOIN {lookup_table} AS rp_lookup " + \
+    f"ON rp_junction.{lookup_table}_pk = rp_lookup.Id " + \
+    f"WHERE rp_junction.{curr_db_table}_pk = {curr_db_table}.Id) AS '{lookup_col}'"
+
+# Get the hidden select columns carrying the Id and sort values
+def get_paging_aliases(curr_db_table, order_by):
+  aliases = [f"{curr_db_table}.Id AS {PAGE_ID_COL}"]
+  for i, term in enumerate(order_by):
+    if term['key'] != 'ID':
+      aliases.append(f"{term['sql']} AS {SORT_COL_PREFIX}{i}")
+  return aliases
+
+# Drop the extra row fetched by `build_paging_query` and build the `__next`
+# link for the following page
+def split_page(data, paging, order_by, request_args):
+  page_ids = data[PAGE_ID_COL]
+  sort_cols = [col for col in data.columns if col.startswith(SORT_COL_PREFIX)]
+  sort_values = data[sort_cols]
+  data = data.drop([PAGE_ID_COL] + sort_cols, axis=1)
+  page_size = paging['page_size']
+  if page_size is None or page_ids.nunique() <= page_size:
+    return data, None
+  
+  unique_ids = page_ids.drop_duplicates()
+  data = data.loc[page_ids.isin(unique_ids.iloc[:page_size])]
+  if page_size == 0:
+    return data, None
+
+  last_id = int(unique_ids.iloc[page_size - 1])
+  last_row = sort_values.loc[unique_ids.index[page_size - 1]]
+  return data, build_next_url(last_id, last_row, order_by, request_args)
+
+# Build the `__next` link from the last item's Id and its `rp_sort_<n>` values
+def build_next_url(last_id, last_row, order_by, request_args):
+  token = [('Paged', 'TRUE')]
+  for i, term in enumerate(order_by):
+    if term['key'] == 'ID':
+      continue
+    value = last_row[f'{SORT_COL_PREFIX}{i}']
+    if not pd.isnull(value):
+      token.append((f"p_{term['key']}", value))
+  token.append(('p_ID', last_id))
+
+  next_args = [(k, v) for k, v in request_args.items() if k not in ['$skip', '$skiptoken']]
+  next_args.append(('$skiptoken', urlencode(token)))
+  return f"{request.base_url}?{urlencode(next_args, safe='$,/')}"
+
+# Compile the plan for an items GET: its SQL, the slots of the filter's bind
+# values and the layout of the result. Exactly one query is built for each
+# request, with or without URL params.
+def build_list_items_plan(curr_table, request_args, list_key, paging):
+  curr_db_table = curr_table['table_db_name']
+
+  # If no params are given, return all data
+  request_keys = request_args.keys()
+  used_columns = []
+  if '$select' not in request_keys and '$filter' not in request_keys and '$expand' not in request_keys:
+    order_by = resolve_orderby(request_args.get('$orderby'), curr_table, {}, used_columns)
+    paging_sql, _ = build_paging_query(curr_db_table, paging, order_by, [], [])
+    select_aliases = ['*'] + get_paging_aliases(curr_db_table, order_by)
+    return {
+      'sql': f"SELECT {', '.join(select_aliases)} FROM {curr_db_table} " + paging_sql,
+      'filter_slots': [],
+      'used_columns': used_columns,
+      'order_by': order_by,
+      'lookup_cols': [],
+      'multi_cols': [],
+      'envelope': list_key,
+      'diagnostics': {}
+    }
+
+  # Extract URL params
+  params = parse_odata_query(request_args)
+  params.update(list_key)
+  
+  # EXPAND - Get all tables in query
+  joins = {}
+  for col in params['expand_cols']:
+    # Check if the column to expand was included in the selected columns
+    if not any([col in join_col for join_col in params['join_cols']]):
+      raise BadRequest(f"The query to field '{col}' is not valid. The $select query string must specify the target fields and the $expand query string must contain {col}.")
+    
+    # Check if relationship exists
+    rship = catalog.get_relationship(curr_db_table, col)
+    if rship is None:
+      raise BadRequest(f"Relationship from field '{col}' does not exist.")
+    else:
+      joins[col] = {
+        'table': rship['table_lookup'],
+        'table_pk': rship['table_lookup_on'],
+        'is_multi': rship['is_multi']
+      }
+  logger.debug('Resolved joins', extra={'joins': joins})
+
+  # Check selected columns against the catalog
+  for col in params['main_cols']:
+    if col != '*' and col not in curr_table['columns']:
+      raise BadRequest(f"Invalid $select: column '{col}' does not exist.")
+
+  # Process joins data. Fields of multi-lookups are aggregated per item.
+  join_aliases = []
+  multi_fields = {}
+  for col in params['join_cols']:
+    lookup_col, lookup_table_col = col.split('/', 1)
+    if not lookup_col in params['expand_cols']:
+      raise BadRequest(f'Lookup field {lookup_col} not specified in $expand parameter.')
+    if not has_column(joins[lookup_col]['table'], lookup_table_col):
+      raise BadRequest(f"Invalid $select: column '{col}' does not exist.")
+    if joins[lookup_col]['is_multi']:
+      multi_fields.setdefault(lookup_col, []).append(lookup_table_col)
+    else:
+      join_aliases.append(f"{joins[lookup_col]['table']}.{lookup_table_col} AS '{lookup_col}__{lookup_table_col}'")
+  for lookup_col, fields in multi_fields.items():
+    join_aliases.append(get_multi_lookup_alias(curr_db_table, lookup_col, joins[lookup_col]['table'], fields))
+  params['join_cols'] = join_aliases
+
+  # Process filter into a parameterised WHERE clause
+  n_used_columns = len(used_columns)
+  try:
+    filter_sql, filter_params, filter_slots = parse_odata_filter(
+      params['filter_query'], joins, curr_db_table, used_columns
+    )
+  except ODataFilterError as e:
+    raise BadRequest(f'Invalid $filter: {e}')
+  params['filter_query'] = filter_sql
+  params['filter_params'] = filter_params
+  filter_tables = {table for table, _ in used_columns[n_used_columns:]}
+
+  # Process sort order
+  order_by = resolve_orderby(request_args.get('$orderby'), curr_table, joins, used_columns)
+
+  # Add aliases to lookup tables
+  select_aliases = [f"{curr_db_table}.{col}" for col in params['main_cols']] + \
+    params['join_cols']
+  if not select_aliases:
+    select_aliases = ["*"]
+  select_aliases.extend(get_paging_aliases(curr_db_table, order_by))
+  
+  # Prepare SQL query
+  sql_query = []
+  sql_query.append(f"SELECT {', '.join(select_aliases)}")
+  from_clause = [f"FROM {curr_db_table}"]
+
+  # If single lookup, do a left join. Multi-lookups are selected by subqueries,
+  # and only joined through the junction table when the filter uses them.
+  multi_cols = []
+  filter_multi_cols = []
+  for expand_col, lookup_data in joins.items():
+    lookup_table = lookup_data['table']
+    if not lookup_data['is_multi']:
+      from_clause.append(f"LEFT JOIN {lookup_data['table']}" + \
+        f" ON {curr_db_table}.{expand_col} = {lookup_data['table']}.{lookup_data['table_pk']}")
+    else:
+      multi_cols.append(expand_col)
+      if lookup_table not in filter_tables:
+        continue
+      junction_table = f"{curr_db_table}_{lookup_data['table']}"
+      filter_multi_cols.append(expand_col)
+      from_clause.append(
+        f"LEFT JOIN {junction_table} " + 
+        f"ON {curr_db_table}.Id = {junction_table}.{curr_db_table}_pk " +
+        f"LEFT JOIN {lookup_table} " +
+        f"ON {junction_table}.{lookup_table}_pk = {lookup_table}.Id"
+      )
+  sql_query.extend(from_clause)
+
+  # Add filter and paging clauses. Multi-lookups joined for the filter give one
+  # row per lookup value, so rows are grouped back into one per item.
+  where_clauses = [filter_sql] if filter_sql else []
+  paging_sql, _ = build_paging_query(
+    curr_db_table, paging, order_by, where_clauses, filter_params,
+    group_by=f'{curr_db_table}.Id' if filter_multi_cols else None
+  )
+  sql_query.append(paging_sql)
+
+  # Update diagnostic params
+  params['sql_query'] = ' '.join(sql_query)
+  params['joins'] = joins
+
+  return {
+    'sql': ' '.join(sql_query),
+    'filter_slots': filter_slots,
+    'used_columns': used_columns,
+    'order_by': order_by,
+    'lookup_cols': [col for col in joins if col not in multi_cols],
+    'multi_cols': multi_cols,
+    'envelope': {},
+    'diagnostics': params
+  }
+
+# Build the query for the items GET endpoints from the cached plan for its
+# shape, compiling the plan on a miss. Only the filter's literals and the
+# paging params are bound per request.
+@timed('parse')
+def build_list_items_query(curr_table, request_args, list_key):
+  # Extract paging params and the filter's shape
+  try:
+    paging = parse_odata_paging(request_args, app.config['ITEMS_PAGE_SIZE'])
+  except ValueError as e:
+    raise BadRequest(str(e))
+  try:
+    filter_shape, literals = get_filter_shape(request_args.get('$filter', ''))
+  except ODataFilterError as e:
+    raise BadRequest(f'Invalid $filter: {e}')
+
+  key = (
+    curr_table['table_db_name'], tuple(sorted(list_key.items())), request_args.get('$select'),
+    request_args.get('$expand'), filter_shape, request_args.get('$orderby'), get_paging_shape(paging),
+    tuple(sorted(request_args.keys()))
+  )
+  plan = plans.get(key)
+  if plan is None:
+    generation = catalog.generation
+    plan = build_list_items_plan(curr_table, request_args, list_key, paging)
+    plans.put(key, plan, generation)
+
+  # Record filter/sort columns for indexing
+  indexer.record(plan['used_columns'])
+  filter_params = fill_params(plan['filter_slots'], literals)
+  diagnostics = plan['diagnostics']
+  if diagnostics:
+    diagnostics = {**diagnostics, 'filter_params': filter_params}
+  return {
+    'sql': plan['sql'],
+    'params': filter_params + get_paging_params(plan['order_by'], paging),
+    'paging': paging,
+    'order_by': plan['order_by'],
+    'lookup_cols': plan['lookup_cols'],
+    'multi_cols': plan['multi_cols'],
+    'envelope': plan['envelope'],
+    'diagnostics': diagnostics
+  }
+
+# Read list items for the items GET endpoints. The ETag comes from the versions
+# of the list and its lookup tables, so unchanged reads get 304 Not Modified
+# without querying the list, and buffered responses are served from the
+# result cache.
+def read_list_items(curr_table, request_args, list_key):
+  tables = [curr_table['table_db_name']] + catalog.get_lookup_tables(curr_table['table_db_name'])
+  with span('etag'):
+    with connect() as conn:
+      versions = get_list_versions(conn, tables)
+    etag = get_list_etag(request.base_url, request_args, versions)
+  if request.if_none_match.contains(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+  if wants_streaming(request.headers):
+    response = stream_list_items(build_list_items_query(curr_table, request_args, list_key), request_args)
+    response.set_etag(etag)
+    return response
+
+  cache_key = (etag, catalog.generation)
+  body = results.get(cache_key)
+  cache_status = 'HIT'
+  if body is None:
+    # Serialize as flask-restx would, so cached and fresh responses match
+    output = query_list_items(curr_table, request_args, list_key)
+    with span('serialize'):
+      body = output_json(output, 200).get_data()
+    results.put(cache_key, body)
+    cache_status = 'MISS'
+  response = Response(body, mimetype='application/json')
+  response.set_etag(etag)
+  response.headers['X-RavenPoint-Cache'] = cache_status
+  return response
+
+# Query list items into a response dict
+def query_list_items(curr_table, request_args, list_key):
+  query = build_list_items_query(curr_table, request_args, list_key)
+
+  # Query database and process data
+  stats = QueryStats()
+  with connect() as conn:
+    data = read_sql(conn, query['sql'], query['params'], stats)
+  with span('process'):
+    data, next_url = split_page(data, query['paging'], query['order_by'], request_args)
+
+    # Parse multi-lookup values
+    for multi_col in query['multi_cols']:
+      data[multi_col] = [json.loads(values) for values in data[multi_col]]
+
+    # Process single lookup columns
+    for nested_col in query['lookup_cols']:
+      data = nest_lookup_columns(data, nested_col)
+
+    output = {
+      **query['envelope'],
+      'diagnostics': {**query['diagnostics'], **stats.to_dict()},
+      'value': data.replace({np.nan: None}).to_dict('records')
+    }
+  # Next to `value` at the top level, not in a SharePoint-style `d` envelope
+  if next_url:
+    output['__next'] = next_url
+
+  return output
+
+# Read one list item for the single item GET endpoints, with its version as
+# `__metadata.etag` and the ETag header for use in IF-MATCH
+def read_list_item(curr_table, item_id, by):
+  try:
+    item_id = int(item_id)
+  except ValueError:
+    raise BadRequest('Item Id must be an integer.')
+  with connect() as conn:
+    cursor = conn.execute(f"SELECT * FROM {curr_table['table_db_name']} WHERE Id = ?", (item_id,))
+    row = cursor.fetchone()
+    if row is None:
+      raise BadRequest('Item does not exist.')
+    version = get_item_version(conn, curr_table['table_db_name'], item_id)
+
+  item = dict(zip([col[0] for col in cursor.description], row))
+  metadata = {'etag': format_item_etag(version), 'type': get_list_item_type(curr_table, by)}
+  response = Response(output_json({'d': {'__metadata': metadata, **item}}, 200).get_data(), mimetype='application/json')
+  response.set_etag(str(version))
+  return response.make_conditional(request)
+
+# Check for the OData streaming format parameter,
+# e.g. `Accept: application/json;odata.streaming=true`
+def wants_streaming(headers):
+  return 'odata.streaming=true' in headers.get('Accept', '').replace(' ', '').lower()
+
+# Shape a cursor row into an item: nest single lookup fields and parse
+# multi-lookup values, as `read_list_items` does for a whole DataFrame
+def get_item_builder(columns, lookup_cols, multi_cols):
+  main_fields, multi_fields, lookup_fields = [], [], {col: [] for col in lookup_cols}
+  for i, col in enumerate(columns):
+    if col == PAGE_ID_COL or col.startswith(SORT_COL_PREFIX):
+      continue
+    if col in multi_cols:
+      multi_fields.append((col, i))
+    elif col.split('__')[0] in lookup_fields:
+      lookup_col, field = col.split('__', 1)
+      lookup_fields[lookup_col].append((field, i))
+    else:
+      main_fields.append((col, i))
+
+  def build_item(row):
+    item = {col: row[i] for col, i in main_fields}
+    for col, i in multi_fields:
+      item[col] = json.loads(row[i])
+    for lookup_col, fields in lookup_fields.items():
+      item[lookup_col] = {field: clean_lookup_value(row[i]) for field, i in fields}
+    return item
+  return build_item
+
+# Stream list items straight from the cursor, writing the response envelope
+# incrementally so memory use does not grow with the size of the list
+def stream_list_items(query, request_args):
+  page_size = query['paging']['page_size']
+  chunk_size = app.config['ITEMS_STREAM_CHUNK_SIZE']
+
+  def generate():
+    stats = QueryStats()
+    next_url = None
+    yield json.dumps(query['envelope'])[:-1] + (', ' if query['envelope'] else '') + '"value": ['
+    with connect() as conn:
+      logger.debug('Streaming list items query', extra={'sql': query['sql'], 'params': query['params']})
+      cursor = conn.execute(query['sql'], query['params'])
+      stats.queries += 1
+      columns = [col[0] for col in cursor.description]
+      build_item = get_item_builder(columns, query['lookup_cols'], query['multi_cols'])
+      n_items = 0
+      last_row = None
+      while next_url is None:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+          break
+        stats.rows_read += len(rows)
+        items = []
+        for row in rows:
+          # The extra row fetched past the page size means there is a next page
+          if page_size is not None and n_items == page_size:
+            if page_size > 0:
+              last_row = dict(zip(columns, last_row))
+              next_url = build_next_url(last_row[PAGE_ID_COL], last_row, query['order_by'], request_args)
+            break
+          items.append(json.dumps(build_item(row), default=str))
+          last_row = row
+          n_items += 1
+        if items:
+          yield (', ' if n_items > len(items) else '') + ', '.join(items)
+      cursor.close()
+
+    yield ']'
+    if next_url:
+      yield f', "__next": {json.dumps(next_url)}'
+    diagnostics = {**query['diagnostics'], **stats.to_dict()}
+    yield f', "diagnostics": {json.dumps(diagnostics, default=str)}}}'
+
+  return Response(stream_with_context(generate()), mimetype='application/json')
+
+
 @api_namespace.route(
   "/web/Lists(guid'<string:list_id>')/items",
   doc={'description': '''Endpoint for retrieving List items. \
-Currently implemented URL params: `select`, `expand`, and `filter`.
+Currently implemented URL params: `select`, `expand`, `filter`, `orderby`, `top`, `skip` and `skiptoken`.
 
 - Use `$select=ListItemEntityTypeFullName` to get the List item entity type.
 - Use `$select=<columns>` to select columns.
 - Use `$expand=<lookup_table>` to join tables.
 - Use `$filter=<criteria>` to filter items.
+- Use `$orderby=<column> [asc|desc], ...` to sort items.
+- Use `$top=<n>` and `$skip=<n>` to page through items. Responses with more items \
+than the page size include a `__next` link to the next page. Items are returned in a \
+top-level `value` array rather than SharePoint's `d.results`, so the link is at the top \
+level as well (`__next`, not `d.__next`).
+- Send `Accept: application/json;odata.streaming=true` to stream items as they \
+are read instead of building the whole response first.
 
 The URL parameter hierarchy is `select` > `expand` > `filter`. Any other combination may result in an error.
 
@@ -236,6 +767,8 @@ The URL parameter hierarchy is `select` > `expand` > `filter`. Any other combina
 2. An X-RequestDigest value is required. Click the lock to input a value - any value will pass.
 3. The provided payload is for reference only. Choose one of the provided first-level \
 keys as the schema and fill in your own values. Check the models below for more details.
+4. Send a JSON array of items to add them in bulk, in one transaction. The new Ids are \
+returned in the same order.
   '''})
 @api_namespace.doc(params={'list_id': 'Simulated SP List ID'})
 class ListItems(Resource):
@@ -248,143 +781,15 @@ class ListItems(Resource):
     
     # Check for invalid keywords
     request_keys = request.args.keys()
-    if any([key not in ['$select', '$filter', '$expand', '$top'] for key in request_keys]):
-      raise BadRequest('Invalid keyword(s). Use only $select, $filter, or $expand.')
-    
-    # Extract URL params
-    params = parse_odata_query(request.args)
-    if params:
-      params['listId'] = list_id
-
-    # Check if list exists; get all relationships
-    with sqlite3.connect(conn_string) as conn:
-      all_tables = get_all_table_names(conn)
-      all_rships = get_all_relationships(conn)
-    if list_id not in all_tables.id.tolist():
-      raise BadRequest('List does not exist.')
+    if any([key not in ITEMS_KEYWORDS for key in request_keys]):
+      raise BadRequest('Invalid keyword(s). Use only $select, $filter, $expand, $orderby, $top, $skip or $skiptoken.')
 
-    # Extract table metadata
-    curr_table = all_tables.loc[all_tables.id.eq(list_id)].to_dict('records')[0]
-    curr_db_table = curr_table['table_db_name']
-
-    # Extract table
-    with sqlite3.connect(conn_string) as conn:
-        df = pd.read_sql(f"SELECT * FROM {curr_db_table}", conn)
-    
-    # If no params are given, return all data
-    if '$select' not in request_keys and '$filter' not in request_keys and '$expand' not in request_keys:
-      return {
-        'listId': list_id,
-        'value': df.to_dict('records')
-      }
-    
-    # EXPAND - Get all tables in query
-    joins = {}
-    for col in params['expand_cols']:
-      # Check if the column to expand was included in the selected columns
-      if not any([col in join_col for join_col in params['join_cols']]):
-        raise BadRequest(f"The query to field '{col}' is not valid. The $select query string must specify the target fields and the $expand query string must contain {col}.")
-      
-      # Check if relationship exists
-      rship = all_rships.loc[all_rships.table_left.eq(curr_db_table) & \
-        all_rships.table_left_on.eq(col)].to_dict('records')
-      if len(rship) == 0:
-        raise BadRequest(f"Relationship from field '{col}' does not exist.")
-      else:
-        joins[col] = {
-          'table': rship[0]['table_lookup'],
-          'table_pk': rship[0]['table_lookup_on'],
-          'is_multi': rship[0]['is_multi']
-        }
-        print(joins)
-
-    # Process joins data
-    for i, col in enumerate(params['join_cols']):
-      lookup_col, lookup_table_col = col.split('/')
-      if not lookup_col in params['expand_cols']:
-        raise BadRequest(f'Lookup field {lookup_col} not specified in $expand parameter.')
-      params['join_cols'][i] = params['join_cols'][i].replace(
-        lookup_col + '/', joins[lookup_col]['table'] + '.'
-      ) + f" AS '{lookup_col}__{lookup_table_col}'"
-
-    # Process filter
-    params['filter_query'] = parse_odata_filter(params['filter_query'], joins, curr_db_table)
-
-    # Add aliases to lookup tables
-    select_aliases = [f"{curr_db_table}.{col}" for col in params['main_cols']] + \
-      params['join_cols']
-    
-    # Prepare SQL query
-    sql_query = []
-    sql_query.append(f"SELECT {', '.join(select_aliases)}")
-    sql_query.append(f"FROM {curr_db_table}")
-
-    # If single lookup, do a left join; otherwise, left join the junction table first
-    multi_cols = []
-    for expand_col, lookup_data in joins.items():
-      lookup_table = lookup_data['table']
-      if lookup_data['is_multi'] == 0:
-        sql_query.append(f"LEFT JOIN {lookup_data['table']}" + \
-          f" ON {curr_db_table}.{expand_col} = {lookup_data['table']}.{lookup_data['table_pk']}")
-      else:
-        junction_table = f"{curr_db_table}_{lookup_data['table']}"
-        multi_cols.append(expand_col)
-        sql_query.append(
-          f"LEFT JOIN {junction_table} " + 
-          f"ON {curr_db_table}.Id = {junction_table}.{curr_db_table}_pk " +
-          f"LEFT JOIN {lookup_table} " +
-          f"ON {junction_table}.{lookup_table}_pk = {lookup_table}.Id"
-        )
-
-    if params['filter_query']:
-      sql_query.append(f"WHERE {params['filter_query']}")
-
-    # Query database and process data
-    with sqlite3.connect(conn_string) as conn:
-      data = pd.read_sql(' '.join(sql_query), con=conn)
-    nested_cols = data.columns[data.columns.str.contains('__', regex=False)]
-    nested_cols = list(set([col.split('__')[0] for col in nested_cols]))
-    nested_cols = [col for col in nested_cols if not col in multi_cols]
-
-    # Function to handle Id and Title
-    def clean_id_and_title(value):
-      if pd.isnull(value) or value is None:
-        return ''
-      if type(value) in [float, int]:
-        return int(value)
-      if type(value) == str:
-        return str(value)
-
-    # Process multi-lookup columns first
-    if len(multi_cols) > 0:
-      for multi_col in multi_cols:
-        sub_cols = data.columns[data.columns.str.contains(multi_col + '__')]
-        data[multi_col] = data[sub_cols].apply(lambda x: {k.replace(f'{multi_col}__', ''): clean_id_and_title(v) for k, v in zip(x.index, x.values)}, axis=1)
-        data = data.drop(sub_cols, axis=1)
-    
-      # Merge multi-lookup values
-      merge_cols = [col for col in data.columns if not col in multi_cols]
-      data = data.groupby(merge_cols).agg(lambda x: x.tolist()).reset_index()
-      for multi_col in multi_cols:
-        data[multi_col] = data[multi_col].apply(lambda x: [] if all([elem['Id'] == '' for elem in x]) else x)
-    
-    # Process single lookup columns
-    for nested_col in nested_cols:
-      sub_cols = data.columns[data.columns.str.contains(nested_col + '__')]
-      data[nested_col] = data[sub_cols].apply(lambda x: {k.replace(f'{nested_col}__', ''): clean_id_and_title(v) for k, v in zip(x.index, x.values)}, axis=1)
-      data = data.drop(sub_cols, axis=1)
-
-    # Update diagnostic params
-    params['sql_query'] = ' '.join(sql_query)
-    params['joins'] = joins
-
-    # Allow cross-origin
-    output = {
-      'diagnostics': params,
-      'value': data.replace({np.nan: None}).to_dict('records')
-    }
+    # Check if list exists
+    curr_table = catalog.get_table(list_id)
+    if curr_table is None:
+      raise BadRequest('List does not exist.')
 
-    return output
+    return read_list_items(curr_table, request.args, {'listId': list_id})
   
   # Update item
   @api_namespace.expect(create_update_model, validate=False)
@@ -401,35 +806,33 @@ class ListItems(Resource):
     if check_reqs.get('BadRequest'):
       raise BadRequest(check_reqs.get('BadRequest'))
     
-    # Get data types
-    df = check_reqs['data']
-    df = df.drop('Id', axis=1)
-    dtypes_lookup = df.dtypes.astype(str).to_dict()
-
-    # Prepare INSERT query
-    colnames = []
-    values_clause = []
-    for k, v in data.items():
-      if k in ['Id', '__metadata']:
-        continue
-      # Convert implicit lookup column Id
-      if (len(k) > 2) and ('/' not in k) and (k[-2:] == 'Id') and (k != 'parentKrId'):
-        k = k[:-2]
-      data_type = dtypes_lookup.get(k, 'object')
-      colnames.append(k)
-      values_clause.append(f"{v}" if ('int' in data_type or 'float' in data_type) else f"'{v}'")
-    query = f'''INSERT INTO {check_reqs.get('table')} ({', '.join(colnames)}) \
-VALUES ({', '.join(values_clause)})'''
+    # Bulk insert a list of items in one transaction
+    if isinstance(data, list):
+      with connect() as conn:
+        try:
+          ids = insert_items(conn, check_reqs['table'], check_reqs['column_types'], data)
+          conn.commit()
+        except Exception as e:
+          conn.rollback()
+          raise BadRequest(f'Invalid request - data does not match table schema: {e}')
+      return {
+        'd': {'results': [{'Id': Id} for Id in ids]},
+        'message': f'Successfully added {len(ids)} items.',
+      }
 
     # Run update
-    with sqlite3.connect(conn_string) as conn:
+    with connect() as conn, span('write'):
       cursor = conn.cursor()
       try:
-        cursor.execute(query)
+        query, query_params = build_insert_query(check_reqs['table'], check_reqs['column_types'], data)
+        cursor.execute(query, query_params)
         Id = cursor.lastrowid
+        adjust_row_count(conn, check_reqs['table'], 1)
+        bump_list_version(conn, check_reqs['table'])
+        version = get_item_version(conn, check_reqs['table'], Id)
         conn.commit()
       except Exception as e:
-        print(e)
+        logger.info('Could not add item to %s: %s', check_reqs['table'], e)
         conn.rollback()
         raise BadRequest(f'Invalid request - data does not match table schema: {e}')
     return {
@@ -439,17 +842,26 @@ VALUES ({', '.join(values_clause)})'''
       'query': query,
       "d": {'Id': Id},
       'message': f'Successfully added item.',
-    }
+    }, 200, {'ETag': format_item_etag(version)}
 
 @api_namespace.route(
   "/web/Lists(guid'<string:list_id>')/items(<string:item_id>)",
-  doc={'description': '''Endpoint for updating List items.'''})
+  doc={'description': '''Endpoint for reading, updating and deleting List items. \
+Updates and deletes take `IF-MATCH: *` or the item's ETag, as returned by GET in \
+`__metadata.etag`; if the item has changed since, they fail with 412 Precondition Failed.'''})
 @api_namespace.doc(params={
   'list_id': 'Simulated SP List ID',
   'item_id': 'Item to update'
 })
 
 class UpdateListItems(Resource):
+  def get(self, list_id, item_id):
+    '''RavenPoint list item endpoint (Read)'''
+    curr_table = catalog.get_table(list_id)
+    if curr_table is None:
+      raise BadRequest('List does not exist.')
+    return read_list_item(curr_table, item_id, 'guid')
+
   # Update item
   @api_namespace.expect(create_update_model, validate=False)
   @api_namespace.doc(security='X-RequestDigest')
@@ -466,41 +878,29 @@ class UpdateListItems(Resource):
       if check_reqs.get('BadRequest'):
         raise BadRequest(check_reqs.get('BadRequest'))
       
-      # Get data types
-      df = check_reqs['data']
-      df = df.drop('Id', axis=1)
-      dtypes_lookup = df.dtypes.astype(str).to_dict()
-
-      # Prepare UPDATE query
-      set_clause = []
-      for k, v in data.items():
-        if k in ['Id', '__metadata']:
-          continue
-        # Convert implicit lookup column Id
-        if (len(k) > 2) and ('/' not in k) and (k[-2:] == 'Id') and (k != 'parentKrId'):
-          k = k[:-2]
-        data_type = dtypes_lookup.get(k, 'object')
-        set_clause.append(f"{k} = {v}" if ('int' in data_type or 'float' in data_type) else f"{k} = '{v}'")
-      query = f'''UPDATE {check_reqs.get('table')} \
-  SET {', '.join(set_clause)} \
-  WHERE Id = {item_id}'''
-
       # Run update
-      with sqlite3.connect(conn_string) as conn:
+      with connect() as conn, span('write'):
         cursor = conn.cursor()
         try:
-          cursor.execute(query)
-          conn.commit()
+          query, query_params = build_update_query(check_reqs['table'], check_reqs['column_types'], item_id, data)
+          cursor.execute(query, query_params)
+          version = record_item_change(conn, check_reqs['table'], item_id, check_reqs['etag'])
+          if version is None:
+            conn.rollback()
+          else:
+            conn.commit()
         except Exception as e:
           conn.rollback()
           raise BadRequest(f'Invalid request - data does not match table schema: {e}')
+      if version is None:
+        raise PreconditionFailed(f'Item {item_id} has changed since it was read (ETag mismatch).')
       return {
         # 'data': data,
         # 'token': headers.get('X-RequestDigest'),
         # 'table': check_reqs.get('table'),
         # 'query': query,
         'message': f'Successfully updated item {item_id}',
-      }
+      }, 200, {'ETag': format_item_etag(version)}
     else:
       # Run checks on List, ListItemEntityTypeFullName, and item
       check_reqs = validate_delete_query(headers, list_id, item_id)
@@ -508,16 +908,23 @@ class UpdateListItems(Resource):
         raise BadRequest(check_reqs.get('BadRequest'))
 
       # Create query
-      query = f'''DELETE FROM {check_reqs.get('table')} WHERE Id = {item_id}'''
+      query, query_params = build_delete_query(check_reqs['table'], item_id)
       # Run update
-      with sqlite3.connect(conn_string) as conn:
+      with connect() as conn, span('write'):
         cursor = conn.cursor()
         try:
-          cursor.execute(query)
-          conn.commit()
+          cursor.execute(query, query_params)
+          adjust_row_count(conn, check_reqs['table'], -cursor.rowcount)
+          version = record_item_change(conn, check_reqs['table'], item_id, check_reqs['etag'])
+          if version is None:
+            conn.rollback()
+          else:
+            conn.commit()
         except Exception as e:
           conn.rollback()
           raise BadRequest(f'Invalid request - could not delete item: {e}')
+      if version is None:
+        raise PreconditionFailed(f'Item {item_id} has changed since it was read (ETag mismatch).')
       return {
         # 'data': data,
         # 'token': headers.get('X-RequestDigest'),
@@ -530,12 +937,19 @@ class UpdateListItems(Resource):
 @api_namespace.route(
   "/web/lists/GetByTitle('<string:list_name>')/items",
   doc={'description': '''Endpoint for retrieving List items. \
-Currently implemented URL params: `select`, `expand`, and `filter`.
+Currently implemented URL params: `select`, `expand`, `filter`, `orderby`, `top`, `skip` and `skiptoken`.
 
 - Use `$select=ListItemEntityTypeFullName` to get the List item entity type.
 - Use `$select=<columns>` to select columns.
 - Use `$expand=<lookup_table>` to join tables.
 - Use `$filter=<criteria>` to filter items.
+- Use `$orderby=<column> [asc|desc], ...` to sort items.
+- Use `$top=<n>` and `$skip=<n>` to page through items. Responses with more items \
+than the page size include a `__next` link to the next page. Items are returned in a \
+top-level `value` array rather than SharePoint's `d.results`, so the link is at the top \
+level as well (`__next`, not `d.__next`).
+- Send `Accept: application/json;odata.streaming=true` to stream items as they \
+are read instead of building the whole response first.
 
 The URL parameter hierarchy is `select` > `expand` > `filter`. Any other combination may result in an error.
 
@@ -545,6 +959,8 @@ The URL parameter hierarchy is `select` > `expand` > `filter`. Any other combina
 2. An X-RequestDigest value is required. Click the lock to input a value - any value will pass.
 3. The provided payload is for reference only. Choose one of the provided first-level \
 keys as the schema and fill in your own values. Check the models below for more details.
+4. Send a JSON array of items to add them in bulk, in one transaction. The new Ids are \
+returned in the same order.
   '''})
 @api_namespace.doc(params={'list_name': 'Simulated SP List ID'})
 class ListByTitleItems(Resource):
@@ -557,151 +973,15 @@ class ListByTitleItems(Resource):
     
     # Check for invalid keywords
     request_keys = request.args.keys()
-    if any([key not in ['$select', '$filter', '$expand', '$top'] for key in request_keys]):
-      raise BadRequest('Invalid keyword(s). Use only $select, $filter, or $expand.')
-    
-    # Extract URL params
-    params = parse_odata_query(request.args)
-    if params:
-      params['listTitle'] = list_name
-
-    # Check if list exists; get all relationships
-    with sqlite3.connect(conn_string) as conn:
-      all_tables = get_all_table_names(conn)
-      all_rships = get_all_relationships(conn)
-    if list_name not in all_tables.table_name.tolist():
-      raise BadRequest('List does not exist.')
-
-    # Extract table metadata
-    curr_table = all_tables.loc[all_tables.table_name.eq(list_name)].to_dict('records')[0]
-    curr_db_table = curr_table['table_db_name']
-
-    # Extract table
-    with sqlite3.connect(conn_string) as conn:
-        df = pd.read_sql(f"SELECT * FROM {curr_db_table}", conn)
-    
-    # If no params are given, return all data
-    if '$select' not in request_keys and '$filter' not in request_keys and '$expand' not in request_keys:
-      return {
-        'listTitle': list_name,
-        'value': df.to_dict('records')
-      }
-    
-    # EXPAND - Get all tables in query
-    joins = {}
-    print('tables to join',joins)
-    for col in params['expand_cols']:
-      # Check if the column to expand was included in the selected columns
-      if not any([col in join_col for join_col in params['join_cols']]):
-        raise BadRequest(f"The query to field '{col}' is not valid. The $select query string must specify the target fields and the $expand query string must contain {col}.")
-      
-      # Check if relationship exists
-      print(col)
-      print('all_rships',all_rships)
-      print(all_rships.loc[all_rships.table_left.eq(curr_db_table) & \
-        all_rships.table_left_on.eq(col)].to_dict('records'))
-      rship = all_rships.loc[all_rships.table_left.eq(curr_db_table) & \
-        all_rships.table_left_on.eq(col)].to_dict('records')
-      if len(rship) == 0 or rship == []:
-        raise BadRequest(f"Relationship from field '{col}' does not exist.")
-      else:
-        joins[col] = {
-          'table': rship[0]['table_lookup'],
-          'table_pk': rship[0]['table_lookup_on'],
-          'is_multi': rship[0]['is_multi']
-        }
-
-    # Process joins data
-    for i, col in enumerate(params['join_cols']):
-      lookup_col, lookup_table_col = col.split('/')
-      if not lookup_col in params['expand_cols']:
-        raise BadRequest(f'Lookup field {lookup_col} not specified in $expand parameter.')
-      params['join_cols'][i] = params['join_cols'][i].replace(
-        lookup_col + '/', joins[lookup_col]['table'] + '.'
-      ) + f" AS '{lookup_col}__{lookup_table_col}'"
-
-    # Process filter
-    params['filter_query'] = parse_odata_filter(params['filter_query'], joins, curr_db_table)
-
-    # Add aliases to lookup tables
-    select_aliases = [f"{curr_db_table}.{col}" for col in params['main_cols']] + \
-      params['join_cols']
-    if not select_aliases :
-      select_aliases = ["*"]
-    print("",select_aliases)
-    # Prepare SQL query
-    sql_query = []
-    sql_query.append(f"SELECT {', '.join(select_aliases)}")
-    sql_query.append(f"FROM {curr_db_table}")
-
-    # If single lookup, do a left join; otherwise, left join the junction table first
-    multi_cols = []
-    for expand_col, lookup_data in joins.items():
-      lookup_table = lookup_data['table']
-      if lookup_data['is_multi'] == 0:
-        sql_query.append(f"LEFT JOIN {lookup_data['table']}" + \
-          f" ON {curr_db_table}.{expand_col} = {lookup_data['table']}.{lookup_data['table_pk']}")
-      else:
-        junction_table = f"{curr_db_table}_{lookup_data['table']}"
-        multi_cols.append(expand_col)
-        sql_query.append(
-          f"LEFT JOIN {junction_table} " + 
-          f"ON {curr_db_table}.Id = {junction_table}.{curr_db_table}_pk " +
-          f"LEFT JOIN {lookup_table} " +
-          f"ON {junction_table}.{lookup_table}_pk = {lookup_table}.Id"
-        )
-
-    if params['filter_query']:
-      sql_query.append(f"WHERE {params['filter_query']}")
-
-    # Query database and process data
-    print("conn tr",conn_string)
-    with sqlite3.connect(conn_string) as conn:
-      print(' '.join(sql_query))
-      data = pd.read_sql(' '.join(sql_query), con=conn)
-    nested_cols = data.columns[data.columns.str.contains('__', regex=False)]
-    nested_cols = list(set([col.split('__')[0] for col in nested_cols]))
-    nested_cols = [col for col in nested_cols if not col in multi_cols]
-
-    # Function to handle Id and Title
-    def clean_id_and_title(value):
-      if pd.isnull(value) or value is None:
-        return ''
-      if type(value) in [float, int]:
-        return int(value)
-      if type(value) == str:
-        return str(value)
-
-    # Process multi-lookup columns first
-    if len(multi_cols) > 0:
-      for multi_col in multi_cols:
-        sub_cols = data.columns[data.columns.str.contains(multi_col + '__')]
-        data[multi_col] = data[sub_cols].apply(lambda x: {k.replace(f'{multi_col}__', ''): clean_id_and_title(v) for k, v in zip(x.index, x.values)}, axis=1)
-        data = data.drop(sub_cols, axis=1)
-    
-      # Merge multi-lookup values
-      merge_cols = [col for col in data.columns if not col in multi_cols]
-      data = data.groupby(merge_cols).agg(lambda x: x.tolist()).reset_index()
-      for multi_col in multi_cols:
-        data[multi_col] = data[multi_col].apply(lambda x: [] if all([elem['Id'] == '' for elem in x]) else x)
-    
-    # Process single lookup columns
-    for nested_col in nested_cols:
-      sub_cols = data.columns[data.columns.str.contains(nested_col + '__')]
-      data[nested_col] = data[sub_cols].apply(lambda x: {k.replace(f'{nested_col}__', ''): clean_id_and_title(v) for k, v in zip(x.index, x.values)}, axis=1)
-      data = data.drop(sub_cols, axis=1)
-
-    # Update diagnostic params
-    params['sql_query'] = ' '.join(sql_query)
-    params['joins'] = joins
+    if any([key not in ITEMS_KEYWORDS for key in request_keys]):
+      raise BadRequest('Invalid keyword(s). Use only $select, $filter, $expand, $orderby, $top, $skip or $skiptoken.')
 
-    # Allow cross-origin
-    output = {
-      'diagnostics': params,
-      'value': data.replace({np.nan: None}).to_dict('records')
-    }
+    # Check if list exists
+    curr_table = catalog.get_table_by_title(list_name)
+    if curr_table is None:
+      raise BadRequest('List does not exist.')
 
-    return output
+    return read_list_items(curr_table, request.args, {'listTitle': list_name})
   
   # Update item
   @api_namespace.expect(create_update_model, validate=False)
@@ -718,36 +998,33 @@ class ListByTitleItems(Resource):
     if check_reqs.get('BadRequest'):
       raise BadRequest(check_reqs.get('BadRequest'))
     
-    # Get data types
-    df = check_reqs['data']
-    df = df.drop('Id', axis=1)
-    dtypes_lookup = df.dtypes.astype(str).to_dict()
-
-    # Prepare INSERT query
-    colnames = []
-    values_clause = []
-    for k, v in data.items():
-      if k in ['Id', '__metadata']:
-        continue
-      # Convert implicit lookup column Id
-      if (len(k) > 2) and ('/' not in k) and (k[-2:] == 'Id') and (k != 'parentKrId'):
-        k = k[:-2]
-      data_type = dtypes_lookup.get(k, 'object')
-      colnames.append(k)
-      values_clause.append(f"{v}" if ('int' in data_type or 'float' in data_type) else f"'{v}'")
-    query = f'''INSERT INTO {check_reqs.get('table')} ({', '.join(colnames)}) \
-VALUES ({', '.join(values_clause)})'''
+    # Bulk insert a list of items in one transaction
+    if isinstance(data, list):
+      with connect() as conn:
+        try:
+          ids = insert_items(conn, check_reqs['table'], check_reqs['column_types'], data)
+          conn.commit()
+        except Exception as e:
+          conn.rollback()
+          raise BadRequest(f'Invalid request - data does not match table schema: {e}')
+      return {
+        'd': {'results': [{'Id': Id} for Id in ids]},
+        'message': f'Successfully added {len(ids)} items.',
+      }
 
     # Run update
-    with sqlite3.connect(conn_string) as conn:
+    with connect() as conn, span('write'):
       cursor = conn.cursor()
       try:
-        cursor.execute(query)
+        query, query_params = build_insert_query(check_reqs['table'], check_reqs['column_types'], data)
+        cursor.execute(query, query_params)
         Id = cursor.lastrowid
+        adjust_row_count(conn, check_reqs['table'], 1)
+        bump_list_version(conn, check_reqs['table'])
+        version = get_item_version(conn, check_reqs['table'], Id)
         conn.commit()
-        print(Id)
       except Exception as e:
-        print(e)
+        logger.info('Could not add item to %s: %s', check_reqs['table'], e)
         conn.rollback()
         raise BadRequest(f'Invalid request - data does not match table schema: {e}')
     return {
@@ -757,17 +1034,26 @@ VALUES ({', '.join(values_clause)})'''
       'query': query,
       "d":{'Id':Id,**data},
       'message': f'Successfully added item.',
-    }
+    }, 200, {'ETag': format_item_etag(version)}
 
 @api_namespace.route(
   "/web/lists/GetByTitle('<string:list_name>')/items(<string:item_id>)",
-  doc={'description': '''Endpoint for updating List items.'''})
+  doc={'description': '''Endpoint for reading, updating and deleting List items. \
+Updates and deletes take `IF-MATCH: *` or the item's ETag, as returned by GET in \
+`__metadata.etag`; if the item has changed since, they fail with 412 Precondition Failed.'''})
 @api_namespace.doc(params={
   'list_name': 'Simulated SP List Name',
   'item_id': 'Item to update'
 })
 
 class UpdateListItems(Resource):
+  def get(self, list_name, item_id):
+    '''RavenPoint list item endpoint (Read)'''
+    curr_table = catalog.get_table_by_title(list_name)
+    if curr_table is None:
+      raise BadRequest('List does not exist.')
+    return read_list_item(curr_table, item_id, 'title')
+
   # Update item
   @api_namespace.expect(create_update_model, validate=False)
   @api_namespace.doc(security='X-RequestDigest')
@@ -784,44 +1070,30 @@ class UpdateListItems(Resource):
       if check_reqs.get('BadRequest'):
         raise BadRequest(check_reqs.get('BadRequest'))
       
-      # Get data types
-      df = check_reqs['data']
-      df = df.drop('Id', axis=1)
-      dtypes_lookup = df.dtypes.astype(str).to_dict()
-
-      # Prepare UPDATE query
-      set_clause = []
-      for k, v in data.items():
-        if k in ['Id', '__metadata']:
-          continue
-        # Convert implicit lookup column Id
-        if (len(k) > 2) and ('/' not in k) and (k[-2:] == 'Id') and (k != 'parentKrId'):
-          k = k[:-2]
-        data_type = dtypes_lookup.get(k, 'object')
-        set_clause.append(f"{k} = {v}" if ('int' in data_type or 'float' in data_type) else f"{k} = '{v}'")
-      query = f'''UPDATE {check_reqs.get('table')} \
-  SET {', '.join(set_clause)} \
-  WHERE Id = {item_id}'''
-
       # Run update
-      with sqlite3.connect(conn_string) as conn:
+      with connect() as conn, span('write'):
         cursor = conn.cursor()
         try:
-          cursor.execute(query)
-          Id = cursor.lastrowid
-          conn.commit()
-
+          query, query_params = build_update_query(check_reqs['table'], check_reqs['column_types'], item_id, data)
+          cursor.execute(query, query_params)
+          version = record_item_change(conn, check_reqs['table'], item_id, check_reqs['etag'])
+          if version is None:
+            conn.rollback()
+          else:
+            conn.commit()
         except Exception as e:
           conn.rollback()
           raise BadRequest(f'Invalid request - data does not match table schema: {e}')
+      if version is None:
+        raise PreconditionFailed(f'Item {item_id} has changed since it was read (ETag mismatch).')
       return {
         # 'data': data,
         # 'token': headers.get('X-RequestDigest'),
         # 'table': check_reqs.get('table'),
         # 'query': query,
-        "d":{'Id':Id,**data},
+        "d":{'Id':int(item_id),**data},
         'message': f'Successfully updated item {item_id}',
-      }
+      }, 200, {'ETag': format_item_etag(version)}
     else:
       # Run checks on List, ListItemEntityTypeFullName, and item
       check_reqs = validate_delete_query_listname(headers, list_name, item_id)
@@ -829,16 +1101,23 @@ class UpdateListItems(Resource):
         raise BadRequest(check_reqs.get('BadRequest'))
 
       # Create query
-      query = f'''DELETE FROM {check_reqs.get('table')} WHERE Id = {item_id}'''
+      query, query_params = build_delete_query(check_reqs['table'], item_id)
       # Run update
-      with sqlite3.connect(conn_string) as conn:
+      with connect() as conn, span('write'):
         cursor = conn.cursor()
         try:
-          cursor.execute(query)
-          conn.commit()
+          cursor.execute(query, query_params)
+          adjust_row_count(conn, check_reqs['table'], -cursor.rowcount)
+          version = record_item_change(conn, check_reqs['table'], item_id, check_reqs['etag'])
+          if version is None:
+            conn.rollback()
+          else:
+            conn.commit()
         except Exception as e:
           conn.rollback()
           raise BadRequest(f'Invalid request - could not delete item: {e}')
+      if version is None:
+        raise PreconditionFailed(f'Item {item_id} has changed since it was read (ETag mismatch).')
       return {
         # 'data': data,
         # 'token': headers.get('X-RequestDigest'),
@@ -848,6 +1127,30 @@ class UpdateListItems(Resource):
       }
     
 
+@api_namespace.route(
+  '/$batch',
+  doc={'description': '''Endpoint for running several list item requests in one round trip.
+
+The body is a `multipart/mixed` OData batch. Each changeset (a nested `multipart/mixed` part) \
+holds creates, updates (`MERGE`) and deletes for list items and runs in a single transaction: \
+if any request in it fails, none of its changes are kept. `GET` requests may be sent as parts \
+outside changesets.
+  '''})
+class Batch(Resource):
+  @api_namespace.response(200, 'Success: Returns a multipart batch response.')
+  @api_namespace.response(400, 'Bad request: Invalid batch.')
+  @api_namespace.doc(security='X-RequestDigest')
+  def post(self):
+    '''RavenPoint batch endpoint'''
+    if request.headers.get('X-RequestDigest') is None:
+      raise BadRequest("No token provided. Unable to 'authenticate' request.")
+    try:
+      entries = parse_batch(request.content_type, request.get_data(as_text=True))
+    except BatchError as e:
+      raise BadRequest(str(e))
+    body, boundary = format_batch_response(run_batch(entries))
+    return Response(body, content_type=f'multipart/mixed; boundary={boundary}')
+
 @api_namespace.route("/web/GetFolderByServerRelativeUrl('Shared Documents')/Files('<string:file_name>')/$value",doc={"description":'''Endpoint for retrieving files form ravenpoint'''})
 @api_namespace.doc(params={
   "file_name":"Name of simulated file in ravenpoint"
@@ -876,7 +1179,7 @@ class GetFile(Resource):
 class getuserbyid(Resource):
   @api_namespace.doc(security='X-RequestDigest')
   def get(self,Id):
-      with sqlite3.connect(conn_string) as conn:
+      with connect() as conn:
         try:
           df = pd.read_sql_query("SELECT * FROM rpusers WHERE Id = {}".format(Id),conn)
           data = df.to_dict('records')
@@ -893,7 +1196,7 @@ class getuserbyid(Resource):
 class currentUser(Resource):
   @api_namespace.doc(security='X-RequestDigest')
   def get(self):
-      with sqlite3.connect(conn_string) as conn:
+      with connect() as conn:
         try:
           df = pd.read_sql_query("SELECT * FROM rpusers WHERE Id = {}".format(1),conn)
           data = df.to_dict('records')
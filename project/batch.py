@@ -0,0 +1,247 @@
+# RAVENPOINT $BATCH REQUESTS
+# Parses OData `multipart/mixed` batch requests into changesets of list item
+# writes and single reads, runs each changeset in one SQLite transaction and
+# formats the multipart batch response.
+import json
+import re
+import sqlite3
+import uuid
+from collections import namedtuple
+from http import HTTPStatus
+from urllib.parse import unquote, urlsplit
+from project import app
+from project.catalog import catalog
+from project.connections import connect
+from project.metrics import timed
+from project.rowcounts import adjust_row_count
+from project.utils import build_insert_query, build_update_query, build_delete_query
+from project.versions import bump_list_version, record_item_change, parse_if_match, format_item_etag
+
+class BatchError(ValueError):
+  '''Raised when a batch request or one of its operations is invalid.'''
+  pass
+
+# One HTTP request or response inside a batch
+BatchRequest = namedtuple('BatchRequest', ['method', 'url', 'headers', 'body'])
+BatchResponse = namedtuple('BatchResponse', ['status', 'headers', 'body'])
+
+# Parsing
+BOUNDARY_PATTERN = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+
+def get_boundary(content_type):
+  match = BOUNDARY_PATTERN.search(content_type or '')
+  if match is None or not (content_type or '').lower().startswith('multipart/mixed'):
+    raise BatchError('Batch requests must be multipart/mixed with a boundary.')
+  return match.group(1)
+
+def split_headers(text):
+  '''Split `text` into a dict of headers and the content after the blank line.'''
+  head, _, content = text.partition('\n\n')
+  headers = {}
+  for line in head.split('\n'):
+    if ':' in line:
+      name, value = line.split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+  return headers, content
+
+def split_parts(body, boundary):
+  delimiter = f'--{boundary}'
+  chunks = body.split(delimiter)
+  if len(chunks) < 2:
+    raise BatchError(f'Boundary {boundary} not found in batch body.')
+  parts = []
+  for chunk in chunks[1:]:
+    if chunk.startswith('--'):
+      break
+    parts.append(chunk.strip('\n'))
+  return parts
+
+def parse_http_request(text):
+  '''Parse an `application/http` part into a BatchRequest.'''
+  request_line, _, rest = text.strip('\n').partition('\n')
+  tokens = request_line.split()
+  if len(tokens) < 2:
+    raise BatchError(f"Invalid request line in batch: '{request_line}'")
+  headers, body = split_headers(rest)
+  return BatchRequest(tokens[0].upper(), tokens[1], headers, body.strip('\n'))
+
+@timed('parse')
+def parse_batch(content_type, body):
+  '''
+  Parse a batch request body into a list of entries. Each entry is either a
+  list of BatchRequests (a changeset) or a single BatchRequest.
+  '''
+  body = body.replace('\r\n', '\n')
+  entries = []
+  for part in split_parts(body, get_boundary(content_type)):
+    headers, content = split_headers(part)
+    part_type = headers.get('content-type', '').lower()
+    if part_type.startswith('multipart/mixed'):
+      changeset = []
+      for change in split_parts(content, get_boundary(headers['content-type'])):
+        change_headers, change_content = split_headers(change)
+        if not change_headers.get('content-type', '').lower().startswith('application/http'):
+          raise BatchError('Changeset parts must be application/http.')
+        changeset.append(parse_http_request(change_content))
+      entries.append(changeset)
+    elif part_type.startswith('application/http'):
+      entries.append(parse_http_request(content))
+    else:
+      raise BatchError(f"Unsupported batch part type: '{part_type}'")
+  return entries
+
+# Formatting
+def format_http_response(response):
+  lines = [
+    'Content-Type: application/http',
+    'Content-Transfer-Encoding: binary',
+    '',
+    f'HTTP/1.1 {response.status} {HTTPStatus(response.status).phrase}'
+  ]
+  lines.extend([f'{name}: {value}' for name, value in response.headers.items()])
+  lines.extend(['', response.body or ''])
+  return '\r\n'.join(lines)
+
+@timed('serialize')
+def format_batch_response(results):
+  '''
+  Format the results of `run_batch` as a multipart body. Returns the body and
+  its boundary.
+  '''
+  boundary = f'batchresponse_{uuid.uuid4()}'
+  parts = []
+  for result in results:
+    if isinstance(result, list):
+      changeset_boundary = f'changesetresponse_{uuid.uuid4()}'
+      changeset = ''.join([f'--{changeset_boundary}\r\n{format_http_response(r)}\r\n' for r in result])
+      parts.append(
+        f'Content-Type: multipart/mixed; boundary={changeset_boundary}\r\n\r\n' +
+        f'{changeset}--{changeset_boundary}--'
+      )
+    else:
+      parts.append(format_http_response(result))
+  body = ''.join([f'--{boundary}\r\n{part}\r\n' for part in parts]) + f'--{boundary}--\r\n'
+  return body, boundary
+
+def json_response(status, data):
+  return BatchResponse(status, {'Content-Type': 'application/json;odata=verbose;charset=utf-8'}, json.dumps(data))
+
+def error_response(status, message):
+  return json_response(status, {'error': {'code': str(status), 'message': {'lang': 'en-US', 'value': message}}})
+
+# Execution
+ITEMS_URL_PATTERNS = [
+  ('guid', re.compile(r"/_api/web/lists\(guid'([^']+)'\)/items(?:\((\d+)\))?/?$", re.IGNORECASE)),
+  ('title', re.compile(r"/_api/web/lists/getbytitle\('([^']+)'\)/items(?:\((\d+)\))?/?$", re.IGNORECASE)),
+]
+
+def resolve_items_url(url, lists):
+  '''
+  Get `(table, item_id, by)` for a list items URL. Lists are looked up once per
+  batch and kept in `lists`.
+  '''
+  path = unquote(urlsplit(url).path)
+  for by, pattern in ITEMS_URL_PATTERNS:
+    match = pattern.search(path)
+    if match is None:
+      continue
+    list_key, item_id = match.groups()
+    if (by, list_key) not in lists:
+      table = catalog.get_table(list_key) if by == 'guid' else catalog.get_table_by_title(list_key)
+      if table is None:
+        raise BatchError('List does not exist.')
+      lists[(by, list_key)] = table
+    return lists[(by, list_key)], item_id, by
+  raise BatchError(f"Unsupported URL in changeset: '{url}'")
+
+def get_list_item_type(table, by):
+  # Entity types follow the single item endpoints for each kind of URL
+  if by == 'guid':
+    return f"SP.Data.{table['table_db_name'].title().replace('_', '')}ListItem"
+  return f"SP.Data.{table['table_name']}ListItem"
+
+def run_change(conn, request, lists):
+  '''Run one write in a changeset on `conn`, without committing.'''
+  table, item_id, by = resolve_items_url(request.url, lists)
+
+  method = request.headers.get('x-http-method', request.method).upper()
+  etag = None
+  if method in ['MERGE', 'PATCH', 'PUT', 'DELETE']:
+    try:
+      etag = parse_if_match(request.headers.get('if-match') or '')
+    except ValueError:
+      raise BatchError('Incorrect value for IF-MATCH header.')
+
+  if method == 'DELETE':
+    if item_id is None:
+      raise BatchError('Item Id is required to delete an item.')
+    query, params = build_delete_query(table['table_db_name'], item_id)
+  else:
+    try:
+      data = json.loads(request.body or '{}')
+    except ValueError as e:
+      raise BatchError(f'Invalid JSON body: {e}')
+    if not isinstance(data, dict):
+      raise BatchError('Request body must be a JSON object.')
+    metadata = data.get('__metadata') or {}
+    if metadata.get('type') != get_list_item_type(table, by):
+      raise BatchError('Incorrect ListItemEntityTypeFullName.')
+    if method == 'POST' and item_id is None:
+      query, params = build_insert_query(table['table_db_name'], table['column_types'], data)
+    elif method in ['MERGE', 'PATCH', 'PUT'] and item_id is not None:
+      query, params = build_update_query(table['table_db_name'], table['column_types'], item_id, data)
+    else:
+      raise BatchError(f'Unsupported method in changeset: {method}')
+
+  cursor = conn.execute(query, params)
+  if method == 'POST' and item_id is None:
+    adjust_row_count(conn, table['table_db_name'], 1)
+    bump_list_version(conn, table['table_db_name'])
+    return json_response(201, {'d': {'Id': cursor.lastrowid, **data}})
+  if cursor.rowcount == 0:
+    raise BatchError(f'Item {item_id} does not exist.')
+  if method == 'DELETE':
+    adjust_row_count(conn, table['table_db_name'], -cursor.rowcount)
+  version = record_item_change(conn, table['table_db_name'], item_id, etag)
+  if version is None:
+    raise BatchError(f'Item {item_id} has changed since it was read (ETag mismatch).')
+  return BatchResponse(204, {} if method == 'DELETE' else {'ETag': format_item_etag(version)}, '')
+
+def run_changeset(changeset, lists):
+  '''Run a changeset in one transaction. Any failure rolls back all of it.'''
+  conn = connect()
+  responses = []
+  try:
+    with conn:
+      for request in changeset:
+        responses.append(run_change(conn, request, lists))
+  except (BatchError, ValueError, sqlite3.Error) as e:
+    return error_response(400, f'Changeset failed and was rolled back: {e}')
+  return responses
+
+def run_query(request):
+  '''Run a read outside a changeset through the app's own routes.'''
+  if request.method != 'GET':
+    return error_response(400, 'Only GET requests are allowed outside changesets.')
+  url = urlsplit(request.url)
+  # A fresh app context keeps the read's `g`, e.g. its timings, separate from the batch's
+  with app.app_context(), app.test_request_context(url.path, query_string=url.query, headers=request.headers):
+    response = app.full_dispatch_request()
+  return BatchResponse(
+    response.status_code,
+    {'Content-Type': response.headers.get('Content-Type', 'application/json')},
+    response.get_data(as_text=True)
+  )
+
+@timed('write')
+def run_batch(entries):
+  '''
+  Run parsed batch entries in order. Returns a list with a list of
+  BatchResponses for each changeset (or one error response if it was rolled
+  back) and a BatchResponse for each read.
+  '''
+  lists = {}
+  results = []
+  for entry in entries:
+    results.append(run_changeset(entry, lists) if isinstance(entry, list) else run_query(entry))
+  return results
@@ -0,0 +1,83 @@
+# RAVENPOINT RESULT CACHE
+# Bounded LRU cache of serialized list items responses. Callers key entries on
+# the read's ETag, which covers the versions of the list and its lookup tables
+# (see `project.versions`), and the catalog generation. Writes change the key
+# rather than purging entries, so stale entries are never hit and age out of
+# the LRU.
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from project import app
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'created_at'])
+
+class ResultCache:
+  '''LRU cache of response bytes with entry, size and TTL limits.'''
+
+  def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, ttl=60):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._entries = OrderedDict()
+    self._size = 0
+    self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'skipped': 0}
+
+  def get(self, key):
+    '''Get cached response bytes, or None.'''
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self._stats['misses'] += 1
+        return None
+      if time.time() - entry.created_at > self.ttl:
+        self._remove(key)
+        self._stats['expired'] += 1
+        self._stats['misses'] += 1
+        return None
+      self._entries.move_to_end(key)
+      self._stats['hits'] += 1
+      return entry.body
+
+  def put(self, key, body):
+    '''Cache response bytes, evicting the least recently used entries.'''
+    if not self.max_entries:
+      return
+    if len(body) > self.max_bytes:
+      with self._lock:
+        self._stats['skipped'] += 1
+      return
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = CacheEntry(body, time.time())
+      self._size += len(body)
+      while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+        self._remove(next(iter(self._entries)))
+        self._stats['evictions'] += 1
+
+  def _remove(self, key):
+    self._size -= len(self._entries.pop(key).body)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
+
+  def get_stats(self):
+    '''Get hit/miss counts and the current size of the cache.'''
+    with self._lock:
+      lookups = self._stats['hits'] + self._stats['misses']
+      return {
+        **self._stats,
+        'hit_rate': self._stats['hits'] / lookups if lookups else None,
+        'entries': len(self._entries),
+        'bytes': self._size,
+        'max_entries': self.max_entries,
+        'max_bytes': self.max_bytes,
+        'ttl': self.ttl,
+      }
+
+results = ResultCache(
+  app.config['RESULT_CACHE_MAX_ENTRIES'], app.config['RESULT_CACHE_MAX_BYTES'], app.config['RESULT_CACHE_TTL']
+)
@@ -0,0 +1,132 @@
+# RAVENPOINT METADATA CATALOG
+# In-memory copy of the `tables` and `relationships` registries, plus the
+# columns of every registered table. Loaded lazily on first use and rebuilt
+# after the admin views change the registry. The catalog's generation is a
+# counter in SQLite, so a change made by one worker process is seen by the
+# others on their next lookup.
+import threading
+from flask import g, has_request_context
+from project.connections import connect
+from project.metrics import timed
+from project.versions import bump_list_version, get_list_versions
+
+# Row of `rp_list_versions` holding the catalog generation. Table names from
+# uploads can't contain ':', so it can't clash with a list.
+CATALOG_VERSION_KEY = 'rp:catalog'
+
+class Catalog:
+  '''
+  Metadata catalog keyed by list GUID, list title and
+  `(table_left, table_left_on)` for relationships.
+  '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._snapshot = None
+    self._generation = None
+
+  @property
+  def generation(self):
+    '''
+    The stored generation, bumped on every invalidation in any process, so
+    caches can tell the metadata changed.
+    '''
+    return self.refresh()
+
+  def refresh(self):
+    '''Drop the cached metadata if another generation is stored. Returns the stored generation.'''
+    # Read once per request
+    if has_request_context() and 'catalog_generation' in g:
+      return g.catalog_generation
+    with connect() as conn:
+      generation = get_list_versions(conn, [CATALOG_VERSION_KEY])[0]
+    if has_request_context():
+      g.catalog_generation = generation
+    if generation != self._generation:
+      with self._lock:
+        self._snapshot = None
+        self._generation = generation
+    return generation
+
+  def invalidate(self):
+    '''Drop the cached metadata in all processes; the next lookup reloads it.'''
+    with connect() as conn:
+      bump_list_version(conn, CATALOG_VERSION_KEY)
+    with self._lock:
+      self._snapshot = None
+    if has_request_context():
+      g.pop('catalog_generation', None)
+
+  def _load(self):
+    with connect() as conn:
+      tables = conn.execute('SELECT id, table_name, table_db_name FROM tables').fetchall()
+      rships = conn.execute(
+        '''SELECT rship_id, table_left, table_left_on, table_lookup, table_lookup_on,
+        is_multi, description FROM relationships'''
+      ).fetchall()
+
+      by_id, by_title, by_db_name = {}, {}, {}
+      for table_id, table_name, table_db_name in tables:
+        table_info = conn.execute(f"PRAGMA table_info('{table_db_name}')").fetchall()
+        table = {
+          'id': table_id,
+          'table_name': table_name,
+          'table_db_name': table_db_name,
+          'columns': [col[1] for col in table_info],
+          'column_types': {col[1]: (col[2] or '').upper() for col in table_info},
+        }
+        by_id[table_id] = table
+        by_title[table_name] = table
+        by_db_name[table_db_name] = table
+
+    by_join = {}
+    for rship_id, table_left, table_left_on, table_lookup, table_lookup_on, is_multi, description in rships:
+      by_join[(table_left, table_left_on)] = {
+        'rship_id': rship_id,
+        'table_left': table_left,
+        'table_left_on': table_left_on,
+        'table_lookup': table_lookup,
+        'table_lookup_on': table_lookup_on,
+        'is_multi': bool(is_multi),
+        'description': description,
+      }
+
+    return {'by_id': by_id, 'by_title': by_title, 'by_db_name': by_db_name, 'by_join': by_join}
+
+  @timed('catalog')
+  def snapshot(self):
+    self.refresh()
+    snapshot = self._snapshot
+    if snapshot is None:
+      with self._lock:
+        if self._snapshot is None:
+          self._snapshot = self._load()
+        snapshot = self._snapshot
+    return snapshot
+
+  def get_table(self, list_id):
+    '''Get a registered table by list GUID, or None.'''
+    return self.snapshot()['by_id'].get(list_id)
+
+  def get_table_by_title(self, list_name):
+    '''Get a registered table by list title, or None.'''
+    return self.snapshot()['by_title'].get(list_name)
+
+  def get_table_by_db_name(self, table_db_name):
+    '''Get a registered table by its database table name, or None.'''
+    return self.snapshot()['by_db_name'].get(table_db_name)
+
+  def get_relationship(self, table_left, table_left_on):
+    '''Get the relationship for a lookup column, or None.'''
+    return self.snapshot()['by_join'].get((table_left, table_left_on))
+
+  def get_relationships(self):
+    return list(self.snapshot()['by_join'].values())
+
+  def get_lookup_tables(self, table_db_name):
+    '''Get the tables that a table's lookup columns join to.'''
+    return sorted(set([
+      rship['table_lookup'] for rship in self.get_relationships() if rship['table_left'] == table_db_name
+    ]))
+
+catalog = Catalog()
@@ -0,0 +1,145 @@
+# RAVENPOINT SQLITE CONNECTIONS
+# Long-lived SQLite connections, one per thread. Connections are opened in WAL
+# mode so readers don't block behind writers, and are handed to a new thread
+# once the thread that owned them exits. Every `connect()` on a thread returns
+# the same connection, so `with` blocks on it nest: only the outermost block
+# commits, and inner blocks run in savepoints.
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from project import app
+
+# Configure connection string
+conn_string = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
+
+class _ConnectionHolder:
+  def __init__(self, conn):
+    self.conn = conn
+
+class PooledConnection(sqlite3.Connection):
+  '''
+  SQLite connection whose `with` blocks nest. The outermost block commits on
+  success and rolls back on errors, as with `sqlite3.connect`. Inner blocks
+  run in a SAVEPOINT that is released on success and rolled back on errors,
+  so they never commit the transaction of the block around them. Code inside
+  an inner block must not call `commit()`/`rollback()` itself.
+  '''
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.depth = 0
+
+  def __enter__(self):
+    self.depth += 1
+    if self.depth > 1:
+      # Inner work belongs to the outermost block's transaction, even if
+      # nothing has been written yet
+      if not self.in_transaction:
+        self.execute('BEGIN')
+      self.execute(f'SAVEPOINT rp_nested_{self.depth}')
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    depth = self.depth
+    self.depth -= 1
+    if depth == 1:
+      return super().__exit__(exc_type, exc_value, traceback)
+    # The transaction may already be gone, e.g. after an error that rolled it back
+    if self.in_transaction:
+      if exc_type is not None:
+        self.execute(f'ROLLBACK TO rp_nested_{depth}')
+      self.execute(f'RELEASE rp_nested_{depth}')
+    return False
+
+class ConnectionPool:
+  '''
+  Per-thread SQLite connections with tuned pragmas. Use the connection as a
+  context manager (`with pool.connect() as conn:`) to commit on success and
+  roll back on errors, as with `sqlite3.connect`; nested blocks on the same
+  thread are savepoints within the outermost block's transaction.
+  '''
+
+  def __init__(self, conn_string, pragmas, max_idle=8, cached_statements=256):
+    self.conn_string = conn_string
+    self.pragmas = pragmas
+    self.max_idle = max_idle
+    self.cached_statements = cached_statements
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._idle = []
+
+  def _open(self):
+    conn = sqlite3.connect(
+      self.conn_string,
+      timeout=self.pragmas.get('busy_timeout', 5000) / 1000,
+      check_same_thread=False,
+      cached_statements=self.cached_statements,
+      factory=PooledConnection
+    )
+    for pragma, value in self.pragmas.items():
+      conn.execute(f'PRAGMA {pragma}={value}')
+    return conn
+
+  def _take(self):
+    with self._lock:
+      conn = self._idle.pop() if self._idle else None
+    return conn if conn is not None else self._open()
+
+  def _release(self, conn):
+    # Called when the owning thread exits or a borrowed connection is returned
+    conn.depth = 0
+    try:
+      if conn.in_transaction:
+        conn.rollback()
+    except sqlite3.Error:
+      return
+    with self._lock:
+      if len(self._idle) < self.max_idle:
+        self._idle.append(conn)
+        return
+    conn.close()
+
+  def connect(self):
+    '''Get this thread's connection, opening or recycling one if needed.'''
+    holder = getattr(self._local, 'holder', None)
+    if holder is None:
+      conn = self._take()
+      holder = _ConnectionHolder(conn)
+      weakref.finalize(holder, self._release, conn)
+      self._local.holder = holder
+    return holder.conn
+
+  @contextmanager
+  def borrow(self):
+    '''
+    Borrow a connection other than this thread's for a `with` block, e.g. to
+    hold a read snapshot while this thread's connection commits. The block
+    commits on success and rolls back on errors.
+    '''
+    conn = self._take()
+    try:
+      with conn:
+        yield conn
+    finally:
+      self._release(conn)
+
+  def close_all(self):
+    '''Close idle connections and this thread's connection.'''
+    holder = getattr(self._local, 'holder', None)
+    if holder is not None:
+      del self._local.holder
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for conn in idle:
+      conn.close()
+
+pool = ConnectionPool(conn_string, app.config['SQLITE_PRAGMAS'])
+
+def connect():
+  '''Get the current thread's pooled SQLite connection.'''
+  return pool.connect()
+
+def connect_separately():
+  '''Borrow a pooled SQLite connection other than the current thread's, as a context manager.'''
+  return pool.borrow()
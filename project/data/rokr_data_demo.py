@@ -163,6 +163,9 @@ with sqlite3.connect(conn_string) as conn:
       table_hash_id = md5(tablename.encode()).hexdigest()
       cursor.execute(f"INSERT OR REPLACE INTO tables (id, table_name, table_db_name) \
         VALUES ('{table_hash_id}', '{tablename}', '{table_db_name}')")
+
+    # Row counts for the replaced tables are recounted by the admin dashboard
+    conn.execute('DROP TABLE IF EXISTS rp_row_counts')
   except Exception as e:
     print(e)
     conn.rollback()
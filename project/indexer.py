@@ -0,0 +1,162 @@
+# RAVENPOINT COLUMN INDEXER
+# Counts how often each column is used in `$filter` and `$orderby` and creates
+# SQLite indexes on the hot ones, either automatically once a column reaches
+# `AUTO_INDEX_THRESHOLD` uses or from the admin table view. Also keeps the
+# indexes backing each relationship's `$expand` joins.
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from project import app
+from project.catalog import catalog
+from project.connections import connect
+
+logger = logging.getLogger(__name__)
+
+# Prefix for indexes managed by RavenPoint
+INDEX_PREFIX = 'rp_ix'
+
+def get_index_name(table_db_name, column):
+  return f'{INDEX_PREFIX}_{table_db_name}_{column}'
+
+def get_relationship_index_specs(table_left, table_left_on, table_lookup, is_multi):
+  '''
+  Get `(index_name, table, columns)` for the indexes backing a relationship's
+  joins. Lookup tables are joined on `Id`, which is already the primary key.
+  '''
+  if is_multi:
+    junction_table = f'{table_left}_{table_lookup}'
+    left_pk, lookup_pk = f'{table_left}_pk', f'{table_lookup}_pk'
+    return [
+      (get_index_name(junction_table, f'{left_pk}_{lookup_pk}'), junction_table, [left_pk, lookup_pk]),
+      (get_index_name(junction_table, lookup_pk), junction_table, [lookup_pk]),
+    ]
+  return [(get_index_name(table_left, table_left_on), table_left, [table_left_on])]
+
+def get_create_index_sql(name, table_db_name, columns):
+  return f'''CREATE INDEX IF NOT EXISTS "{name}" ON "{table_db_name}" ({', '.join([f'"{col}"' for col in columns])})'''
+
+class ColumnIndexer:
+  '''Tracks column usage per table and creates single-column indexes.'''
+
+  def __init__(self, threshold=None):
+    self.threshold = threshold
+    self._lock = threading.Lock()
+    self._usage = Counter()
+
+  def record(self, columns):
+    '''Record one use of each `(table_db_name, column)` pair.'''
+    to_index = []
+    with self._lock:
+      for key in set(columns):
+        if key[1] == 'Id':
+          continue
+        self._usage[key] += 1
+        if self.threshold and self._usage[key] == self.threshold:
+          to_index.append(key)
+
+    # Build indexes outside the request thread
+    for table_db_name, column in to_index:
+      threading.Thread(
+        target=self._auto_create_index, args=(table_db_name, column), daemon=True
+      ).start()
+
+  def _auto_create_index(self, table_db_name, column):
+    try:
+      self.create_index(table_db_name, column)
+    except (ValueError, sqlite3.Error) as e:
+      logger.warning('Could not index %s.%s: %s', table_db_name, column, e)
+
+  def forget(self, table_db_name):
+    '''Reset usage counts for a table, e.g. after it is replaced or dropped.'''
+    with self._lock:
+      for key in [key for key in self._usage if key[0] == table_db_name]:
+        del self._usage[key]
+
+  def get_usage(self, table_db_name):
+    '''Get `(column, uses)` pairs for a table, most used first.'''
+    with self._lock:
+      usage = [(col, n) for (table, col), n in self._usage.items() if table == table_db_name]
+    return sorted(usage, key=lambda x: -x[1])
+
+  def get_indexes(self, table_db_name):
+    '''Get the indexes on a table with their columns.'''
+    output = []
+    with connect() as conn:
+      for row in conn.execute(f"PRAGMA index_list('{table_db_name}')").fetchall():
+        name = row[1]
+        columns = [col[2] for col in conn.execute(f"PRAGMA index_info('{name}')").fetchall()]
+        output.append({
+          'name': name,
+          'columns': columns,
+          'managed': name.startswith(INDEX_PREFIX)
+        })
+    return output
+
+  def create_index(self, table_db_name, column):
+    '''Create an index on a table column. Returns the index name.'''
+    table = catalog.get_table_by_db_name(table_db_name)
+    if table is None or column not in table['columns']:
+      raise ValueError(f"Column '{column}' does not exist in {table_db_name}.")
+    if column == 'Id':
+      raise ValueError('Id is the primary key and is already indexed.')
+    name = get_index_name(table_db_name, column)
+    with connect() as conn:
+      conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table_db_name}" ("{column}")')
+      conn.commit()
+    return name
+
+  def drop_index(self, name):
+    '''Drop an index created by RavenPoint.'''
+    if not name.startswith(INDEX_PREFIX):
+      raise ValueError(f'{name} is not managed by RavenPoint.')
+    with connect() as conn:
+      conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+      conn.commit()
+
+  def create_relationship_indexes(self, table_left, table_left_on, table_lookup, is_multi):
+    '''Create the indexes for a relationship's joins on the tables that exist.'''
+    specs = get_relationship_index_specs(table_left, table_left_on, table_lookup, is_multi)
+    with connect() as conn:
+      for name, table_db_name, columns in specs:
+        exists = conn.execute(
+          "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_db_name,)
+        ).fetchone()
+        if exists:
+          conn.execute(get_create_index_sql(name, table_db_name, columns))
+      conn.commit()
+
+  def drop_relationship_indexes(self, table_left, table_left_on, table_lookup, is_multi):
+    '''Drop the indexes for a relationship's joins.'''
+    with connect() as conn:
+      for name, _, _ in get_relationship_index_specs(table_left, table_left_on, table_lookup, is_multi):
+        conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+      conn.commit()
+
+  def get_relationship_indexes(self, table_left, table_left_on, table_lookup, is_multi):
+    '''
+    Get the indexes for a relationship's joins, whether they exist and their
+    size in bytes (None if SQLite was built without `dbstat`).
+    '''
+    output = []
+    with connect() as conn:
+      for name, table_db_name, columns in get_relationship_index_specs(table_left, table_left_on, table_lookup, is_multi):
+        exists = conn.execute(
+          "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)
+        ).fetchone() is not None
+        size = None
+        if exists:
+          try:
+            size = conn.execute('SELECT SUM(pgsize) FROM dbstat WHERE name = ?', (name,)).fetchone()[0]
+          except sqlite3.OperationalError:
+            pass
+        output.append({
+          'name': name,
+          'table': table_db_name,
+          'columns': columns,
+          'exists': exists,
+          'size': size
+        })
+    return output
+
+indexer = ColumnIndexer(app.config['AUTO_INDEX_THRESHOLD'])
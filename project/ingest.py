@@ -0,0 +1,259 @@
+# RAVENPOINT CSV INGESTION
+# Loads uploaded CSVs and builds multi-lookup junction tables in chunks so
+# memory use stays bounded regardless of table size. Rows are written to a
+# staging table in batched transactions, then the staging table replaces the
+# target table in one transaction, so readers see either the old table or the
+# complete new one.
+import json
+import pandas as pd
+from project import app
+from project.connections import connect, connect_separately
+from project.indexer import get_relationship_index_specs, get_create_index_sql
+from project.rowcounts import get_count_rows_sql
+from project.versions import get_bump_list_version_sql, get_item_versions
+
+# SQLite column types for inferred pandas types, as used by `DataFrame.to_sql`
+SQLITE_TYPES = {
+  'integer': 'INTEGER',
+  'floating': 'REAL',
+  'mixed-integer-float': 'REAL',
+  'boolean': 'INTEGER',
+  'datetime64': 'TIMESTAMP',
+  'datetime': 'TIMESTAMP',
+  'date': 'DATE',
+}
+
+def get_staging_table_name(table_db_name):
+  return f'rp_staging_{table_db_name}'
+
+def count_csv_rows(filepath):
+  '''Estimate the rows in a CSV from its line count, for progress reporting.'''
+  n_lines = 0
+  with open(filepath, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      n_lines += block.count(b'\n')
+  return max(n_lines - 1, 0)
+
+def load_staging_table(table_db_name, column_defs, chunks, progress=None, rows_total=None,
+                       pre_swap=(), post_swap=(), on_swap=None):
+  '''
+  Create a staging table, insert each chunk of rows in its own transaction
+  and swap it into place as `table_db_name`. `chunks` yields lists of row
+  tuples. Statements in `pre_swap`/`post_swap` run in the swap transaction
+  before/after the swap. If given, `on_swap(conn, staging_table)` is called
+  first in the swap transaction, which holds the write lock. Returns the
+  number of rows loaded. Commits as it goes, so it must not be called inside
+  a `with connect()` block.
+  '''
+  staging_table = get_staging_table_name(table_db_name)
+  n_rows = 0
+  with connect() as conn:
+    try:
+      conn.execute(f'DROP TABLE IF EXISTS "{staging_table}"')
+      conn.execute(f'CREATE TABLE "{staging_table}" ({", ".join(column_defs)})')
+      insert_query = f'INSERT INTO "{staging_table}" VALUES ({", ".join(["?"] * len(column_defs))})'
+      for rows in chunks:
+        conn.executemany(insert_query, rows)
+        n_rows += len(rows)
+        # Progress updates join the chunk's transaction
+        if progress is not None:
+          progress(n_rows, rows_total)
+        conn.commit()
+
+      # Swap the staging table into place. Progress reported while reading the
+      # last chunk may still be pending.
+      conn.commit()
+      conn.execute('BEGIN IMMEDIATE')
+      if on_swap is not None:
+        on_swap(conn, staging_table)
+      for statement in pre_swap:
+        conn.execute(statement)
+      conn.execute(f'DROP TABLE IF EXISTS "{table_db_name}"')
+      conn.execute(f'ALTER TABLE "{staging_table}" RENAME TO "{table_db_name}"')
+      for statement in post_swap:
+        conn.execute(statement)
+      conn.commit()
+    except Exception:
+      conn.rollback()
+      conn.execute(f'DROP TABLE IF EXISTS "{staging_table}"')
+      conn.commit()
+      raise
+  if progress is not None:
+    progress(n_rows, n_rows, force=True)
+  return n_rows
+
+def infer_column_types(sample):
+  '''Get the SQLite type of each column in a sample of rows.'''
+  return {
+    col: SQLITE_TYPES.get(pd.api.types.infer_dtype(sample[col], skipna=True), 'TEXT')
+    for col in sample.columns
+  }
+
+def prepare_chunk(chunk, has_id, first_id):
+  '''
+  Give a chunk a new 0-based `Id` if the CSV has its own `Id` column (kept as
+  `Old_Id`), and convert it to rows of Python values with NULLs.
+  '''
+  if has_id:
+    chunk = chunk.rename(columns={'Id': 'Old_Id'})
+    chunk.insert(0, 'Id', range(first_id, first_id + len(chunk)))
+  chunk = chunk.astype(object).where(chunk.notna(), None)
+  return list(chunk.itertuples(index=False, name=None))
+
+def ingest_csv(filepath, table_db_name, chunk_size=None, sample_rows=None, progress=None):
+  '''
+  Load a CSV file into `table_db_name`, replacing any existing table. The
+  first column is the primary key; a CSV `Id` column is renamed to `Old_Id`
+  and new Ids are numbered from 0. Returns the number of rows loaded.
+  '''
+  chunk_size = chunk_size or app.config['INGEST_CHUNK_SIZE']
+  sample_rows = sample_rows or app.config['INGEST_SAMPLE_ROWS']
+
+  # Infer column types from a sample
+  sample = pd.read_csv(filepath, nrows=sample_rows)
+  has_id = 'Id' in sample.columns
+  if has_id:
+    sample = sample.rename(columns={'Id': 'Old_Id'})
+    sample.insert(0, 'Id', range(len(sample)))
+  column_types = infer_column_types(sample)
+  columns = list(column_types)
+  column_defs = [
+    f'"{col}" INTEGER PRIMARY KEY' if i == 0 else f'"{col}" {column_types[col]}'
+    for i, col in enumerate(columns)
+  ]
+
+  def chunks():
+    n_rows = 0
+    for chunk in pd.read_csv(filepath, chunksize=chunk_size):
+      yield prepare_chunk(chunk, has_id, n_rows)
+      n_rows += len(chunk)
+
+  rows_total = count_csv_rows(filepath) if progress is not None else None
+  return load_staging_table(
+    table_db_name, column_defs, chunks(), progress, rows_total,
+    post_swap=get_count_rows_sql(table_db_name) + get_bump_list_version_sql(table_db_name)
+  )
+
+def split_lookup_ids(value):
+  '''Split a multi-lookup cell such as `"1,2"` into integer Ids.'''
+  if value is None:
+    return []
+  ids = []
+  for part in str(value).split(','):
+    part = part.strip()
+    if part:
+      ids.append(int(float(part)))
+  return ids
+
+# Junction tables are kept in sync with the multi-lookup column by triggers on
+# the left table, so every write path (single items, bulk, $batch) updates
+# them. The column holds comma-separated Ids, which are split with json_each.
+JUNCTION_TRIGGER_EVENTS = ['insert', 'update', 'delete']
+
+def get_lookup_ids_sql(value_sql):
+  '''Get a json_each table of the Ids in a multi-lookup value; invalid values have none.'''
+  ids_json = f"'[' || {value_sql} || ']'"
+  return f"json_each(CASE WHEN json_valid({ids_json}) THEN {ids_json} ELSE '[]' END)"
+
+def get_junction_trigger_names(table_left, table_lookup):
+  return [f'rp_sync_{table_left}_{table_lookup}_{event}' for event in JUNCTION_TRIGGER_EVENTS]
+
+def get_drop_junction_sync_sql(table_left, table_lookup):
+  return [f'DROP TRIGGER IF EXISTS "{name}"' for name in get_junction_trigger_names(table_left, table_lookup)]
+
+def get_create_junction_sync_sql(table_left, table_left_on, table_lookup):
+  '''Get the statements creating the junction table's indexes and sync triggers.'''
+  junction_table = f'{table_left}_{table_lookup}'
+  left_pk, lookup_pk = f'{table_left}_pk', f'{table_lookup}_pk'
+  insert_sql = f'''INSERT INTO {junction_table} ({left_pk}, {lookup_pk})
+    SELECT NEW.Id, CAST(value AS INTEGER)
+    FROM {get_lookup_ids_sql(f'NEW."{table_left_on}"')}
+    WHERE value IS NOT NULL;'''
+  delete_sql = f'DELETE FROM {junction_table} WHERE {left_pk} = OLD.Id;'
+  insert_name, update_name, delete_name = get_junction_trigger_names(table_left, table_lookup)
+  index_specs = get_relationship_index_specs(table_left, table_left_on, table_lookup, True)
+  return [get_create_index_sql(*spec) for spec in index_specs] + [
+    f'''CREATE TRIGGER "{insert_name}" AFTER INSERT ON {table_left}
+    BEGIN {insert_sql} END''',
+    f'''CREATE TRIGGER "{update_name}" AFTER UPDATE OF Id, "{table_left_on}" ON {table_left}
+    BEGIN {delete_sql} {insert_sql} END''',
+    f'''CREATE TRIGGER "{delete_name}" AFTER DELETE ON {table_left}
+    BEGIN {delete_sql} END''',
+  ]
+
+def resync_junction_rows(conn, junction_table, table_left, table_left_on, table_lookup, max_id, item_ids):
+  '''Replace the junction rows of items above `max_id` or in `item_ids` with their current lookup Ids.'''
+  left_pk, lookup_pk = f'{table_left}_pk', f'{table_lookup}_pk'
+  ids_json = json.dumps(sorted(item_ids))
+  conn.execute(
+    f'''DELETE FROM "{junction_table}"
+    WHERE {left_pk} > ? OR {left_pk} IN (SELECT value FROM json_each(?))''',
+    (max_id, ids_json)
+  )
+  conn.execute(
+    f'''INSERT INTO "{junction_table}" ({left_pk}, {lookup_pk})
+    SELECT {table_left}.Id, CAST(value AS INTEGER)
+    FROM {table_left}, {get_lookup_ids_sql(f'{table_left}."{table_left_on}"')}
+    WHERE value IS NOT NULL
+    AND ({table_left}.Id > ? OR {table_left}.Id IN (SELECT value FROM json_each(?)))''',
+    (max_id, ids_json)
+  )
+
+def get_junction_chunks(cursor, chunk_size, progress=None, rows_total=None):
+  '''Yield chunks of junction rows for the `(Id, lookup value)` rows of a cursor.'''
+  n_rows, n_items = 0, 0
+  while True:
+    items = cursor.fetchmany(chunk_size)
+    if not items:
+      break
+    rows = []
+    for item_id, value in items:
+      for lookup_id in split_lookup_ids(value):
+        rows.append((n_rows + len(rows), item_id, lookup_id))
+    n_rows += len(rows)
+    yield rows
+    # Progress is counted in items of the left table
+    n_items += len(items)
+    if progress is not None:
+      progress(n_items, rows_total)
+
+def build_junction_table(table_left, table_left_on, table_lookup, chunk_size=None, progress=None):
+  '''
+  Build the junction table `<table_left>_<table_lookup>` for a multi-lookup
+  column, with one row per item and lookup Id, and the triggers that keep it
+  in sync. Returns the number of rows.
+
+  The left table is read from one snapshot while the staging table is loaded,
+  so writers aren't blocked. Items created, changed or deleted after the
+  snapshot (those above its max Id, or whose version in `rp_item_versions`
+  changed) are synced again in the swap transaction, before the triggers take
+  over.
+  '''
+  chunk_size = chunk_size or app.config['INGEST_CHUNK_SIZE']
+  column_defs = ['"Id" INTEGER PRIMARY KEY', f'"{table_left}_pk" INTEGER', f'"{table_lookup}_pk" INTEGER']
+  junction_table = f'{table_left}_{table_lookup}'
+
+  with connect_separately() as reader:
+    # Take the snapshot: its max Id, item versions and items
+    reader.execute('BEGIN')
+    max_id, rows_total = reader.execute(f'SELECT ifnull(MAX(Id), -1), COUNT(*) FROM {table_left}').fetchone()
+    versions = get_item_versions(reader, table_left)
+    cursor = reader.execute(f'SELECT Id, {table_left_on} FROM {table_left} ORDER BY Id')
+
+    def catch_up(conn, staging_table):
+      changed = [
+        item_id for item_id, version in get_item_versions(conn, table_left).items()
+        if versions.get(item_id) != version
+      ]
+      resync_junction_rows(conn, staging_table, table_left, table_left_on, table_lookup, max_id, changed)
+
+    n_rows = load_staging_table(
+      junction_table, column_defs, get_junction_chunks(cursor, chunk_size, progress, rows_total),
+      on_swap=catch_up,
+      pre_swap=get_drop_junction_sync_sql(table_left, table_lookup),
+      post_swap=get_create_junction_sync_sql(table_left, table_left_on, table_lookup) +
+        get_bump_list_version_sql(table_left)
+    )
+  if progress is not None:
+    progress(rows_total, rows_total, force=True)
+  return n_rows
@@ -0,0 +1,137 @@
+# RAVENPOINT BACKGROUND JOBS
+# Runs long admin operations (CSV loads, table drops, junction table builds)
+# on a worker thread instead of inside the request. Job state and progress are
+# kept in the `rp_jobs` table so they can be polled from the admin dashboard.
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from project import app
+from project.connections import connect
+
+logger = logging.getLogger(__name__)
+
+JOBS_TABLE = 'rp_jobs'
+JOB_COLUMNS = [
+  'id', 'kind', 'description', 'status', 'rows_done', 'rows_total',
+  'message', 'created_at', 'started_at', 'finished_at'
+]
+
+class JobProgress:
+  '''
+  Passed to job functions as their first argument. Call it with the rows
+  processed so far (and the expected total, if known); writes to `rp_jobs`
+  are throttled to one per `interval` seconds. Inside a `with connect()`
+  block, the write is committed with the rest of the block's transaction.
+  '''
+
+  def __init__(self, queue, job_id, interval):
+    self.queue = queue
+    self.job_id = job_id
+    self.interval = interval
+    self._last_write = 0
+
+  def __call__(self, rows_done, rows_total=None, force=False):
+    now = time.time()
+    if not force and now - self._last_write < self.interval:
+      return
+    self._last_write = now
+    fields = {'rows_done': rows_done}
+    if rows_total is not None:
+      fields['rows_total'] = rows_total
+    self.queue._update(self.job_id, **fields)
+
+class JobQueue:
+  '''Runs jobs on a thread pool and records their state in SQLite.'''
+
+  def __init__(self, max_workers=1, progress_interval=0.5):
+    self.progress_interval = progress_interval
+    self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rp-job')
+    self._lock = threading.Lock()
+    self._ready = False
+
+  def _ensure_table(self):
+    if self._ready:
+      return
+    with self._lock:
+      if self._ready:
+        return
+      with connect() as conn:
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+          id TEXT PRIMARY KEY, kind TEXT, description TEXT, status TEXT,
+          rows_done INTEGER DEFAULT 0, rows_total INTEGER, message TEXT,
+          created_at REAL, started_at REAL, finished_at REAL)''')
+        # Jobs from a previous run of the app will never finish
+        conn.execute(
+          f"UPDATE {JOBS_TABLE} SET status = 'failed', message = 'Interrupted by a restart.' " +
+          "WHERE status IN ('queued', 'running')"
+        )
+      self._ready = True
+
+  def _update(self, job_id, **fields):
+    with connect() as conn:
+      conn.execute(
+        f"UPDATE {JOBS_TABLE} SET {', '.join([f'{k} = ?' for k in fields])} WHERE id = ?",
+        list(fields.values()) + [job_id]
+      )
+
+  def submit(self, kind, description, func, *args, **kwargs):
+    '''
+    Queue `func(progress, *args, **kwargs)` and return the job Id. The
+    function runs in an app context; its return value is kept as the job's
+    message.
+    '''
+    self._ensure_table()
+    job_id = uuid.uuid4().hex
+    with connect() as conn:
+      conn.execute(
+        f"INSERT INTO {JOBS_TABLE} (id, kind, description, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+        (job_id, kind, description, time.time())
+      )
+    self._executor.submit(self._run, job_id, func, args, kwargs)
+    return job_id
+
+  def _run(self, job_id, func, args, kwargs):
+    self._update(job_id, status='running', started_at=time.time())
+    progress = JobProgress(self, job_id, self.progress_interval)
+    try:
+      with app.app_context():
+        message = func(progress, *args, **kwargs)
+    except Exception as e:
+      logger.exception('Job %s failed', job_id)
+      # Don't commit half of the job's work with the status update
+      connect().rollback()
+      self._update(job_id, status='failed', message=str(e), finished_at=time.time())
+    else:
+      self._update(job_id, status='done', message=message, finished_at=time.time())
+
+  def _to_dict(self, row):
+    job = dict(zip(JOB_COLUMNS, row))
+    now = time.time()
+    job['elapsed'] = (job['finished_at'] or now) - job['started_at'] if job['started_at'] else None
+    job['eta'] = None
+    if job['status'] == 'running' and job['rows_done'] and job['rows_total']:
+      remaining = max(job['rows_total'] - job['rows_done'], 0)
+      job['eta'] = job['elapsed'] / job['rows_done'] * remaining
+    return job
+
+  def get_job(self, job_id):
+    '''Get a job with its elapsed time and ETA in seconds, or None.'''
+    self._ensure_table()
+    with connect() as conn:
+      row = conn.execute(
+        f"SELECT {', '.join(JOB_COLUMNS)} FROM {JOBS_TABLE} WHERE id = ?", (job_id,)
+      ).fetchone()
+    return self._to_dict(row) if row else None
+
+  def get_jobs(self, limit=50):
+    '''Get the most recent jobs, newest first.'''
+    self._ensure_table()
+    with connect() as conn:
+      rows = conn.execute(
+        f"SELECT {', '.join(JOB_COLUMNS)} FROM {JOBS_TABLE} ORDER BY created_at DESC LIMIT ?", (limit,)
+      ).fetchall()
+    return [self._to_dict(row) for row in rows]
+
+jobs = JobQueue(app.config['JOB_WORKERS'])
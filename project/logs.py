@@ -0,0 +1,74 @@
+# RAVENPOINT LOGGING
+# Structured logs for the `project` loggers. Records go through a queue to a
+# listener thread that formats them as JSON lines and writes them out, so
+# request threads never block on log I/O. Messages use logging's lazy
+# %-formatting, so disabled levels cost no formatting; fields passed in
+# `extra` become top-level keys of the JSON line.
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+
+# Attributes of every LogRecord; anything else on a record came from `extra`
+RECORD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+class JSONFormatter(logging.Formatter):
+  '''Format records as one JSON object per line.'''
+
+  def format(self, record):
+    entry = {
+      'time': self.formatTime(record),
+      'level': record.levelname,
+      'logger': record.name,
+      'thread': record.threadName,
+      'message': record.getMessage(),
+    }
+    entry.update({key: value for key, value in record.__dict__.items() if key not in RECORD_ATTRS})
+    if record.exc_info:
+      entry['exc_info'] = self.formatException(record.exc_info)
+    elif record.exc_text:
+      entry['exc_info'] = record.exc_text
+    return json.dumps(entry, default=str)
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+  '''
+  Queue handler that passes records with their `extra` fields to the
+  listener, resolving only the message and any traceback on the calling
+  thread.
+  '''
+
+  def prepare(self, record):
+    record = logging.makeLogRecord(record.__dict__)
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+      # Tracebacks can't be passed on, so format them now
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+    return record
+
+def setup_logging(config):
+  '''
+  Send `project` logs through a queue to stderr (or `LOG_FILE`), at
+  `LOG_LEVEL` with per-logger overrides from `LOG_LEVELS`. Returns the
+  queue listener.
+  '''
+  if config['LOG_FILE']:
+    handler = logging.FileHandler(config['LOG_FILE'])
+  else:
+    handler = logging.StreamHandler()
+  handler.setFormatter(JSONFormatter())
+
+  log_queue = queue.SimpleQueue()
+  listener = logging.handlers.QueueListener(log_queue, handler)
+  listener.start()
+  atexit.register(listener.stop)
+
+  logger = logging.getLogger('project')
+  logger.handlers = [StructuredQueueHandler(log_queue)]
+  logger.setLevel(config['LOG_LEVEL'])
+  logger.propagate = False
+  for name, level in config['LOG_LEVELS'].items():
+    logging.getLogger(name).setLevel(level)
+  return listener
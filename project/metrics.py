@@ -0,0 +1,182 @@
+# RAVENPOINT REQUEST METRICS
+# Times the stages of each request (catalog lookup, parsing, SQL, processing,
+# serialization, writes) with `span`/`timed`. The stage timings go out as a
+# `Server-Timing` header and are aggregated, with total request times, into
+# per-route latency summaries served as Prometheus text at `/metrics`. A
+# sample of requests can also be profiled with cProfile, keeping the profiles
+# of slow ones.
+import cProfile
+import functools
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from project import app
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+logger = logging.getLogger(__name__)
+
+# Stage timings
+@contextmanager
+def span(name):
+  '''Time a block as stage `name` of the current request. Repeated stages add up.'''
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    if has_request_context():
+      timings = g.setdefault('timings', {})
+      timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+def timed(name):
+  '''Decorator timing each call of a function as stage `name`.'''
+  def decorator(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return f(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def format_server_timing(timings, total):
+  return ', '.join([f'{name};dur={duration * 1000:.2f}' for name, duration in timings.items()] +
+                   [f'total;dur={total * 1000:.2f}'])
+
+class LatencySummary:
+  '''Count and sum of observations, with quantiles over the most recent ones.'''
+
+  def __init__(self, window):
+    self.count = 0
+    self.sum = 0.0
+    self.recent = deque(maxlen=window)
+
+  def observe(self, value):
+    self.count += 1
+    self.sum += value
+    self.recent.append(value)
+
+  def get_quantiles(self):
+    values = sorted(self.recent)
+    if not values:
+      return {q: None for q in QUANTILES}
+    return {q: values[min(int(q * len(values)), len(values) - 1)] for q in QUANTILES}
+
+class RequestMetrics:
+  '''Latency summaries of requests by route and of their stages.'''
+
+  def __init__(self, window=1024):
+    self.window = window
+    self._lock = threading.Lock()
+    self._requests = {}
+    self._stages = {}
+    self._statuses = {}
+
+  def record(self, method, route, status, total, timings):
+    with self._lock:
+      key = (method, route)
+      self._requests.setdefault(key, LatencySummary(self.window)).observe(total)
+      for stage, duration in timings.items():
+        self._stages.setdefault(key + (stage,), LatencySummary(self.window)).observe(duration)
+      status_key = key + (str(status),)
+      self._statuses[status_key] = self._statuses.get(status_key, 0) + 1
+
+  def format_prometheus(self):
+    '''Format the metrics in the Prometheus text exposition format.'''
+    lines = []
+    with self._lock:
+      lines.append('# HELP ravenpoint_requests_total Requests by route and status.')
+      lines.append('# TYPE ravenpoint_requests_total counter')
+      for (method, route, status), count in sorted(self._statuses.items()):
+        lines.append(f'ravenpoint_requests_total{format_labels(method=method, route=route, status=status)} {count}')
+      families = [
+        ('ravenpoint_request_duration_seconds', 'Request latency by route.', self._requests, ['method', 'route']),
+        ('ravenpoint_stage_duration_seconds', 'Request stage latency by route.', self._stages, ['method', 'route', 'stage']),
+      ]
+      for name, description, summaries, label_names in families:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} summary')
+        for key, summary in sorted(summaries.items()):
+          labels = dict(zip(label_names, key))
+          for q, value in summary.get_quantiles().items():
+            if value is not None:
+              lines.append(f'{name}{format_labels(**labels, quantile=str(q))} {value:.6f}')
+          lines.append(f'{name}_sum{format_labels(**labels)} {summary.sum:.6f}')
+          lines.append(f'{name}_count{format_labels(**labels)} {summary.count}')
+    return '\n'.join(lines) + '\n'
+
+def format_labels(**labels):
+  escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"') for key, value in labels.items()}
+  return '{' + ','.join([f'{key}="{value}"' for key, value in escaped.items()]) + '}'
+
+def format_cache_metrics(name, stats, counters, gauges):
+  '''Format a cache's stats in the Prometheus text exposition format.'''
+  lines = []
+  for key in counters:
+    lines.append(f'# TYPE ravenpoint_{name}_{key}_total counter')
+    lines.append(f'ravenpoint_{name}_{key}_total {stats[key]}')
+  for key in gauges:
+    lines.append(f'# TYPE ravenpoint_{name}_{key} gauge')
+    lines.append(f'ravenpoint_{name}_{key} {stats[key]}')
+  return '\n'.join(lines) + '\n'
+
+metrics = RequestMetrics(app.config['METRICS_WINDOW'])
+
+# Profiling
+def start_profile():
+  '''Start profiling a sample of requests, as set by `PROFILE_SAMPLE_RATE`.'''
+  if random.random() >= app.config['PROFILE_SAMPLE_RATE']:
+    return
+  profile = cProfile.Profile()
+  try:
+    profile.enable()
+  except ValueError:
+    # Another request in this process is being profiled
+    return
+  g.profile = profile
+
+def stop_profile(total):
+  '''Stop profiling, and dump the profile if the request took longer than `PROFILE_SLOW_SECONDS`.'''
+  profile = g.pop('profile', None)
+  if profile is None:
+    return
+  profile.disable()
+  if total < app.config['PROFILE_SLOW_SECONDS']:
+    return
+  os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+  filename = f"{time.strftime('%Y%m%d-%H%M%S')}_{request.method}_{request.endpoint}_{total * 1000:.0f}ms.prof"
+  profile.dump_stats(os.path.join(app.config['PROFILE_DIR'], filename))
+
+# Request hooks
+@app.before_request
+def start_request_timer():
+  g.request_start = time.perf_counter()
+  if app.config['PROFILE_SAMPLE_RATE']:
+    start_profile()
+
+@app.after_request
+def record_request_metrics(response):
+  if 'request_start' not in g:
+    return response
+  total = time.perf_counter() - g.request_start
+  stop_profile(total)
+  timings = g.get('timings', {})
+  response.headers['Server-Timing'] = format_server_timing(timings, total)
+  route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+  metrics.record(request.method, route, response.status_code, total, timings)
+  if logger.isEnabledFor(logging.DEBUG):
+    logger.debug('%s %s %s', request.method, request.full_path, response.status_code, extra={
+      'route': route, 'total_ms': total * 1000, 'timings_ms': {name: duration * 1000 for name, duration in timings.items()}
+    })
+  return response
+
+@app.teardown_request
+def stop_request_profile(exc):
+  # Requests that failed before `after_request` still stop profiling
+  profile = g.pop('profile', None)
+  if profile is not None:
+    profile.disable()
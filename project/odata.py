@@ -0,0 +1,351 @@
+# RAVENPOINT ODATA QUERY COMPILER
+# Tokenizes an OData `$filter` string, parses it into a small AST and emits a
+# SQLite WHERE clause with `?` placeholders plus the matching bind values.
+# Each bind value records which literal it came from, so filters with the same
+# shape can reuse the SQL with new literals. Also parses `$orderby`.
+import re
+from collections import namedtuple
+
+class ODataQueryError(ValueError):
+  '''Raised when an OData query option cannot be parsed.'''
+  pass
+
+class ODataFilterError(ODataQueryError):
+  '''Raised when a `$filter` expression cannot be tokenized or parsed.'''
+  pass
+
+# Tokens
+Token = namedtuple('Token', ['kind', 'value', 'pos'])
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<datetime>datetime'(?:[^']|'')*')
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<name>[A-Za-z_]\w*(?:/[A-Za-z_]\w*)?)
+  | (?P<lparen>\()
+  | (?P<rparen>\))
+  | (?P<comma>,)
+""", re.VERBOSE)
+
+def tokenize(query):
+  tokens = []
+  pos = 0
+  while pos < len(query):
+    match = TOKEN_PATTERN.match(query, pos)
+    if match is None:
+      raise ODataFilterError(f"Invalid character in $filter at position {pos}: '{query[pos]}'")
+    kind = match.lastgroup
+    if kind != 'ws':
+      tokens.append(Token(kind, match.group(kind), pos))
+    pos = match.end()
+  return tokens
+
+LITERAL_KINDS = ('string', 'datetime', 'number')
+
+def _unquote(text):
+  return text[1:-1].replace("''", "'")
+
+def get_literal_value(token):
+  if token.kind == 'string':
+    return _unquote(token.value)
+  if token.kind == 'datetime':
+    return _unquote(token.value[len('datetime'):])
+  return float(token.value) if '.' in token.value else int(token.value)
+
+def get_filter_shape(query):
+  '''
+  Split a `$filter` string into its shape, with each literal replaced by its
+  kind, and the values of its literals in order. Filters with the same shape
+  compile to the same SQL.
+  '''
+  tokens = tokenize(query)
+  shape = ' '.join([f'<{token.kind}>' if token.kind in LITERAL_KINDS else token.value for token in tokens])
+  return shape, [get_literal_value(token) for token in tokens if token.kind in LITERAL_KINDS]
+
+# AST nodes. `slot` is the position of a literal among the filter's literals,
+# or None for `true`, `false` and `null`.
+Literal = namedtuple('Literal', ['value', 'slot'], defaults=[None])
+Column = namedtuple('Column', ['lookup', 'name'])
+Compare = namedtuple('Compare', ['op', 'left', 'right'])
+BoolOp = namedtuple('BoolOp', ['op', 'operands'])
+Not = namedtuple('Not', ['operand'])
+Call = namedtuple('Call', ['name', 'args'])
+
+COMPARISON_OPS = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+KEYWORDS = {'and', 'or', 'not', 'true', 'false', 'null'} | set(COMPARISON_OPS)
+BOOLEAN_FUNCTIONS = {'startswith', 'endswith', 'substringof'}
+
+def is_predicate(node):
+  '''Check if a node is a boolean expression, i.e. can be used as a filter condition.'''
+  if isinstance(node, Call):
+    return node.name in BOOLEAN_FUNCTIONS
+  return isinstance(node, (Compare, BoolOp, Not))
+
+class Parser:
+  '''
+  Recursive descent parser for OData filters. Precedence (lowest first):
+  `or`, `and`, `not`, comparisons, then literals/columns/function calls.
+  The filter and the operands of `and`, `or` and `not` must be predicates:
+  comparisons, boolean functions or parenthesised boolean expressions.
+  '''
+
+  def __init__(self, query):
+    self.query = query
+    self.tokens = tokenize(query)
+    self.index = 0
+    self.n_literals = 0
+
+  def parse(self):
+    if not self.tokens:
+      raise ODataFilterError('Empty $filter expression.')
+    node = self.parse_predicate(self.parse_or)
+    if self.peek() is not None:
+      self.error('Unexpected token')
+    return node
+
+  def peek(self):
+    if self.index < len(self.tokens):
+      return self.tokens[self.index]
+    return None
+
+  def advance(self):
+    token = self.peek()
+    if token is None:
+      raise ODataFilterError('Unexpected end of $filter expression.')
+    self.index += 1
+    return token
+
+  def expect(self, kind):
+    token = self.advance()
+    if token.kind != kind:
+      self.error(f'Expected {kind}', token)
+    return token
+
+  def error(self, message, token=None):
+    token = token or self.peek()
+    if token is None:
+      raise ODataFilterError(f'{message} at end of $filter expression.')
+    raise ODataFilterError(f"{message} at position {token.pos}: '{token.value}'")
+
+  def is_keyword(self, *words):
+    token = self.peek()
+    return token is not None and token.kind == 'name' and token.value.lower() in words
+
+  def parse_predicate(self, parse):
+    '''Parse with `parse`, checking that the result is a predicate.'''
+    token = self.peek()
+    node = parse()
+    if not is_predicate(node):
+      self.error('Expected a comparison or boolean function', token)
+    return node
+
+  def parse_bool_op(self, op, parse_operand):
+    # A lone operand may be a value, e.g. in parentheses or a function argument
+    start = self.index
+    node = parse_operand()
+    if not self.is_keyword(op.lower()):
+      return node
+    if not is_predicate(node):
+      self.error('Expected a comparison or boolean function', self.tokens[start])
+    operands = [node]
+    while self.is_keyword(op.lower()):
+      self.advance()
+      operands.append(self.parse_predicate(parse_operand))
+    return BoolOp(op, tuple(operands))
+
+  def parse_or(self):
+    return self.parse_bool_op('OR', self.parse_and)
+
+  def parse_and(self):
+    return self.parse_bool_op('AND', self.parse_not)
+
+  def parse_not(self):
+    if self.is_keyword('not'):
+      self.advance()
+      return Not(self.parse_predicate(self.parse_not))
+    return self.parse_comparison()
+
+  def parse_comparison(self):
+    left = self.parse_operand()
+    if self.is_keyword(*COMPARISON_OPS):
+      op = self.advance().value.lower()
+      right = self.parse_operand()
+      return Compare(op, left, right)
+    return left
+
+  def parse_operand(self):
+    token = self.advance()
+    if token.kind == 'lparen':
+      node = self.parse_or()
+      self.expect('rparen')
+      return node
+    if token.kind in LITERAL_KINDS:
+      self.n_literals += 1
+      return Literal(get_literal_value(token), self.n_literals - 1)
+    if token.kind == 'name':
+      word = token.value.lower()
+      if word == 'true':
+        return Literal(True)
+      if word == 'false':
+        return Literal(False)
+      if word == 'null':
+        return Literal(None)
+      if word in KEYWORDS:
+        self.error('Unexpected keyword', token)
+      # Function call
+      nxt = self.peek()
+      if nxt is not None and nxt.kind == 'lparen' and '/' not in token.value:
+        self.advance()
+        args = []
+        if self.peek() is not None and self.peek().kind != 'rparen':
+          args.append(self.parse_or())
+          while self.peek() is not None and self.peek().kind == 'comma':
+            self.advance()
+            args.append(self.parse_or())
+        self.expect('rparen')
+        return Call(word, tuple(args))
+      # Column reference, optionally through a lookup column
+      if '/' in token.value:
+        lookup, name = token.value.split('/')
+        return Column(lookup, name)
+      return Column(None, token.value)
+    self.error('Unexpected token', token)
+
+def parse_filter(query):
+  '''Parse an OData `$filter` string into an AST.'''
+  return Parser(query).parse()
+
+# SQL emitter
+DATE_PART_FORMATS = {
+  'year': '%Y', 'month': '%m', 'day': '%d',
+  'hour': '%H', 'minute': '%M', 'second': '%S'
+}
+SCALAR_FUNCTIONS = {'tolower': 'lower', 'toupper': 'upper', 'length': 'length', 'trim': 'trim'}
+
+def escape_like(value):
+  '''Escape `\\`, `%` and `_` in a LIKE pattern, for use with `ESCAPE '\\'`.'''
+  return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Where a bind value comes from: literal `literal` of the filter, wrapped in
+# `prefix`/`suffix` for LIKE patterns, or the constant `value` if `literal` is None
+ParamSlot = namedtuple('ParamSlot', ['literal', 'prefix', 'suffix', 'value'])
+
+def fill_params(slots, literals):
+  '''Get the bind values for a compiled filter's `slots` from another filter of the same shape.'''
+  params = []
+  for slot in slots:
+    if slot.literal is None:
+      params.append(slot.value)
+    elif slot.prefix is None:
+      params.append(literals[slot.literal])
+    else:
+      params.append(slot.prefix + escape_like(literals[slot.literal]) + slot.suffix)
+  return params
+
+class SQLEmitter:
+  '''
+  Emits SQL for a parsed filter. `resolve_column(lookup, name)` must return
+  the SQL reference for a column; literals are collected in `params`, and
+  where each came from in `slots`.
+  '''
+
+  def __init__(self, resolve_column):
+    self.resolve_column = resolve_column
+    self.params = []
+    self.slots = []
+
+  def bind(self, value, literal=None, prefix=None, suffix=None):
+    if isinstance(value, bool):
+      value = int(value)
+    self.params.append(value)
+    self.slots.append(ParamSlot(literal, prefix, suffix, value))
+    return '?'
+
+  def emit(self, node):
+    if isinstance(node, Literal):
+      if node.value is None:
+        return 'NULL'
+      return self.bind(node.value, node.slot)
+    if isinstance(node, Column):
+      return self.resolve_column(node.lookup, node.name)
+    if isinstance(node, BoolOp):
+      return '(' + f' {node.op} '.join(self.emit(operand) for operand in node.operands) + ')'
+    if isinstance(node, Not):
+      return f'NOT ({self.emit(node.operand)})'
+    if isinstance(node, Compare):
+      return self.emit_compare(node)
+    if isinstance(node, Call):
+      return self.emit_call(node)
+    raise ODataFilterError(f'Unsupported $filter node: {node!r}')
+
+  def emit_compare(self, node):
+    # Comparisons against null become IS [NOT] NULL
+    for this, other in [(node.left, node.right), (node.right, node.left)]:
+      if isinstance(other, Literal) and other.value is None:
+        if node.op not in ('eq', 'ne'):
+          raise ODataFilterError(f"Operator '{node.op}' cannot be used with null.")
+        return f"{self.emit(this)} IS {'NOT ' if node.op == 'ne' else ''}NULL"
+    return f'{self.emit(node.left)} {COMPARISON_OPS[node.op]} {self.emit(node.right)}'
+
+  def emit_like(self, column, pattern, prefix, suffix):
+    if isinstance(pattern, Literal) and isinstance(pattern.value, str):
+      column_sql = self.emit(column)
+      param = self.bind(prefix + escape_like(pattern.value) + suffix, pattern.slot, prefix, suffix)
+      return f"{column_sql} LIKE {param} ESCAPE '\\'"
+    # Non-literal patterns fall back to a case-insensitive substring search
+    position = f'instr(lower({self.emit(column)}), lower({self.emit(pattern)}))'
+    return f'{position} = 1' if not prefix else f'{position} > 0'
+
+  def emit_call(self, node):
+    name, args = node.name, node.args
+    def check_arity(n):
+      if len(args) != n:
+        raise ODataFilterError(f'{name}() takes {n} argument(s), got {len(args)}.')
+
+    if name == 'startswith':
+      check_arity(2)
+      return self.emit_like(args[0], args[1], '', '%')
+    if name == 'endswith':
+      check_arity(2)
+      if isinstance(args[1], Literal) and isinstance(args[1].value, str):
+        return self.emit_like(args[0], args[1], '%', '')
+      return f'substr(lower({self.emit(args[0])}), -length({self.emit(args[1])})) = lower({self.emit(args[1])})'
+    if name == 'substringof':
+      check_arity(2)
+      return self.emit_like(args[1], args[0], '%', '%')
+    if name in DATE_PART_FORMATS:
+      check_arity(1)
+      return f"CAST(strftime('{DATE_PART_FORMATS[name]}', {self.emit(args[0])}) AS INTEGER)"
+    if name in SCALAR_FUNCTIONS:
+      check_arity(1)
+      return f'{SCALAR_FUNCTIONS[name]}({self.emit(args[0])})'
+    raise ODataFilterError(f"Unsupported $filter function: '{name}'.")
+
+def compile_filter(query, resolve_column):
+  '''
+  Compile an OData `$filter` string into `(sql, params, slots)`, where `sql`
+  uses `?` placeholders for every literal. Pass `slots` to `fill_params` to
+  bind another filter of the same shape.
+  '''
+  emitter = SQLEmitter(resolve_column)
+  sql = emitter.emit(parse_filter(query))
+  return sql, emitter.params, emitter.slots
+
+# $orderby
+ORDERBY_PATTERN = re.compile(r'^([A-Za-z_]\w*(?:/[A-Za-z_]\w*)?)(?:\s+(asc|desc))?$', re.IGNORECASE)
+
+def parse_orderby(query):
+  '''
+  Parse an OData `$orderby` string such as `Title, parentTable/Title desc`
+  into a list of `(Column, descending)` tuples.
+  '''
+  output = []
+  for term in query.split(','):
+    match = ORDERBY_PATTERN.match(term.strip())
+    if match is None:
+      raise ODataQueryError(f"Invalid $orderby term: '{term.strip()}'.")
+    name, direction = match.groups()
+    lookup, name = name.split('/') if '/' in name else (None, name)
+    output.append((Column(lookup, name), (direction or 'asc').lower() == 'desc'))
+  return output
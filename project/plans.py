@@ -0,0 +1,74 @@
+# RAVENPOINT QUERY PLANS
+# Caches how list items reads are compiled, keyed on their query shape: the
+# list, `$select`, `$expand`, `$orderby`, the `$filter` with its literals
+# abstracted and the kind of paging. A plan holds the final parameterised SQL,
+# where the filter's bind values come from, the lookup column layout and the
+# response envelope, so repeat reads skip straight to binding and executing.
+# Plans are dropped when the catalog changes, i.e. when a table is loaded or
+# dropped or a relationship is added, edited or removed.
+import threading
+from collections import OrderedDict
+from project import app
+from project.catalog import catalog
+
+class PlanCache:
+  '''LRU cache of compiled list items query plans.'''
+
+  def __init__(self, max_entries=512):
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+    self._plans = OrderedDict()
+    self._generation = None
+    self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+  def _check_generation(self):
+    # Plans refer to the columns and relationships of the catalog they were built from
+    generation = catalog.generation
+    if generation != self._generation:
+      if self._plans:
+        self._stats['invalidations'] += 1
+      self._plans.clear()
+      self._generation = generation
+
+  def get(self, key):
+    '''Get a plan, or None.'''
+    with self._lock:
+      self._check_generation()
+      plan = self._plans.get(key)
+      if plan is None:
+        self._stats['misses'] += 1
+        return None
+      self._plans.move_to_end(key)
+      self._stats['hits'] += 1
+      return plan
+
+  def put(self, key, plan, generation):
+    '''Cache a plan built from catalog `generation`, evicting the least recently used plans.'''
+    if not self.max_entries:
+      return
+    with self._lock:
+      self._check_generation()
+      if generation != self._generation:
+        return
+      self._plans[key] = plan
+      self._plans.move_to_end(key)
+      while len(self._plans) > self.max_entries:
+        self._plans.popitem(last=False)
+        self._stats['evictions'] += 1
+
+  def clear(self):
+    with self._lock:
+      self._plans.clear()
+
+  def get_stats(self):
+    '''Get hit/miss counts and the current size of the cache.'''
+    with self._lock:
+      lookups = self._stats['hits'] + self._stats['misses']
+      return {
+        **self._stats,
+        'hit_rate': self._stats['hits'] / lookups if lookups else None,
+        'entries': len(self._plans),
+        'max_entries': self.max_entries,
+      }
+
+plans = PlanCache(app.config['PLAN_CACHE_MAX_ENTRIES'])
@@ -0,0 +1,62 @@
+# RAVENPOINT ROW COUNTS
+# Keeps the number of rows in each registered table in `rp_row_counts`, so the
+# admin dashboard doesn't count every table on each page load. Counts are set
+# when a table is loaded and adjusted by the item create/delete paths in the
+# same transaction as the write. Per-row triggers would also work, but they
+# slow bulk inserts down by about half. The table is created once when the app
+# starts.
+from project.connections import connect_separately
+
+ROW_COUNTS_TABLE = 'rp_row_counts'
+CREATE_ROW_COUNTS_TABLE = f'CREATE TABLE IF NOT EXISTS {ROW_COUNTS_TABLE} (table_db_name TEXT PRIMARY KEY, nrows INTEGER)'
+
+def create_row_counts_table(conn):
+  '''Create `rp_row_counts` if it doesn't exist, on app startup.'''
+  conn.execute(CREATE_ROW_COUNTS_TABLE)
+
+def get_count_rows_sql(table_db_name):
+  '''Get the statements that (re)count a table's rows into `rp_row_counts`.'''
+  return [
+    f'''INSERT OR REPLACE INTO {ROW_COUNTS_TABLE} (table_db_name, nrows)
+    SELECT '{table_db_name}', COUNT(*) FROM "{table_db_name}"''',
+  ]
+
+def adjust_row_count(conn, table_db_name, delta):
+  '''Add `delta` to a table's row count on `conn`, without committing.'''
+  if not delta:
+    return
+  conn.execute(
+    f'UPDATE {ROW_COUNTS_TABLE} SET nrows = nrows + ? WHERE table_db_name = ?', (delta, table_db_name)
+  )
+
+def count_missing_rows(table_db_names):
+  '''
+  Count tables into `rp_row_counts` in a short transaction of their own, on a
+  separate connection, and return their counts. The write lock is taken
+  first, so no writes are missed between a count and saving it.
+  '''
+  with connect_separately() as conn:
+    conn.execute('BEGIN IMMEDIATE')
+    for table_db_name in table_db_names:
+      for statement in get_count_rows_sql(table_db_name):
+        conn.execute(statement)
+    return dict(conn.execute(
+      f"SELECT table_db_name, nrows FROM {ROW_COUNTS_TABLE} WHERE table_db_name IN ({', '.join(['?'] * len(table_db_names))})",
+      table_db_names
+    ).fetchall())
+
+def get_row_counts(conn, table_db_names):
+  '''
+  Get `{table_db_name: nrows}` for registered tables. Tables without a count,
+  e.g. those loaded by the scripts in `project/data`, are counted once with
+  `count_missing_rows`; `conn` is only read from.
+  '''
+  counts = dict(conn.execute(f'SELECT table_db_name, nrows FROM {ROW_COUNTS_TABLE}').fetchall())
+  missing = [name for name in table_db_names if name not in counts]
+  if missing:
+    counts.update(count_missing_rows(missing))
+  return {name: counts[name] for name in table_db_names}
+
+def forget_row_count(conn, table_db_name):
+  '''Remove the count for a dropped table.'''
+  conn.execute(f'DELETE FROM {ROW_COUNTS_TABLE} WHERE table_db_name = ?', (table_db_name,))
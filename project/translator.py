@@ -0,0 +1,108 @@
+# RAVENPOINT ODATA TRANSLATOR
+# Translates OData queries into SQLite statements with odata-query. Keeps one
+# SQLAlchemy engine per database, an LRU of reflected tables and their mapped
+# classes, and an LRU of translated statements keyed on `(table, query)`. Both
+# are cleared when the catalog changes, e.g. after a table is re-uploaded with
+# different columns. This is an admin helper only: the items endpoints parse
+# `$filter` with `project.odata` and cache their statements in `project.plans`.
+import threading
+from collections import OrderedDict
+from project.catalog import catalog
+
+class ODataTranslator:
+  '''Translates OData queries against the tables of one database, with caching.'''
+
+  def __init__(self, database_uri, max_tables=64, max_queries=1024):
+    self.database_uri = database_uri
+    self.max_tables = max_tables
+    self.max_queries = max_queries
+    self._lock = threading.Lock()
+    self._engine = None
+    self._models = OrderedDict()
+    self._statements = OrderedDict()
+    self._generation = None
+    self._stats = {'hits': 0, 'misses': 0, 'reflections': 0}
+
+  def _check_generation(self):
+    # Reflected columns may be stale once the catalog changes
+    generation = catalog.generation
+    if generation != self._generation:
+      self._models.clear()
+      self._statements.clear()
+      self._generation = generation
+
+  def _get_model(self, table_name):
+    '''Get a class mapped to the reflected table, reflecting it if needed.'''
+    from sqlalchemy import create_engine, MetaData, Table
+    from sqlalchemy.orm import registry
+
+    model = self._models.get(table_name)
+    if model is not None:
+      self._models.move_to_end(table_name)
+      return model
+
+    if self._engine is None:
+      self._engine = create_engine(self.database_uri)
+    # Each table gets its own metadata and registry, so evicted tables can be
+    # reflected and mapped again
+    metadata = MetaData()
+    table = Table(table_name, metadata, autoload_with=self._engine)
+    model = type(f'{table_name}_model', (), {})
+    registry(metadata=metadata).map_imperatively(model, table)
+    self._stats['reflections'] += 1
+
+    self._models[table_name] = model
+    while len(self._models) > self.max_tables:
+      self._models.popitem(last=False)
+    return model
+
+  def translate(self, table_name, odata_query):
+    '''Translate an OData `$filter` query on a table into a SELECT statement with literal values.'''
+    from odata_query.sqlalchemy import apply_odata_query
+    from sqlalchemy import select
+    from sqlalchemy.dialects import sqlite
+
+    key = (table_name, odata_query)
+    with self._lock:
+      self._check_generation()
+      statement = self._statements.get(key)
+      if statement is not None:
+        self._statements.move_to_end(key)
+        self._stats['hits'] += 1
+        return statement
+      self._stats['misses'] += 1
+
+      model = self._get_model(table_name)
+      translated_query = apply_odata_query(select(model), odata_query)
+      statement = str(translated_query.compile(
+        dialect=sqlite.dialect(),
+        compile_kwargs={'literal_binds': True}))
+
+      self._statements[key] = statement
+      while len(self._statements) > self.max_queries:
+        self._statements.popitem(last=False)
+      return statement
+
+  def clear(self):
+    with self._lock:
+      self._models.clear()
+      self._statements.clear()
+
+  def get_stats(self):
+    with self._lock:
+      return {
+        **self._stats,
+        'tables': len(self._models),
+        'statements': len(self._statements),
+      }
+
+_translators = {}
+_translators_lock = threading.Lock()
+
+def get_translator(database_uri):
+  '''Get the shared translator for a database.'''
+  with _translators_lock:
+    translator = _translators.get(database_uri)
+    if translator is None:
+      translator = _translators[database_uri] = ODataTranslator(database_uri)
+    return translator
@@ -1,11 +1,21 @@
 # RAVENPOINT UTILITIES
+import logging
 import pandas as pd
-import re
-import sqlite3
 import os
+import time
+from urllib.parse import parse_qs
 from project import app
+from project.catalog import catalog
+from project.connections import connect
+from project.metrics import timed
+from project.odata import ODataFilterError, compile_filter, escape_like
+from project.rowcounts import get_row_counts, adjust_row_count
+from project.translator import get_translator
+from project.versions import bump_list_version, is_valid_if_match, parse_if_match
 from wtforms import ValidationError
 
+logger = logging.getLogger(__name__)
+
 # Get all tables in database
 def get_all_table_names(conn):
   df = pd.read_sql(
@@ -14,23 +24,15 @@ def get_all_table_names(conn):
   )
   return df
 
-# Get all table metadata
+# Get all table metadata: columns from the catalog, row counts from `rp_row_counts`
 def get_all_table_metadata(conn, tables):
-  nrows = []
-  all_columns = []
-  for table_name in tables.table_db_name:
-      # Get columns
-      cursor = conn.execute(f"SELECT * FROM {table_name}")
-      columns = ', '.join(list(map(lambda x: x[0], cursor.description)))
-      all_columns.append(columns)
-
-      # Get no. of rows
-      cursor = conn.execute(f"SELECT COUNT(*) FROM {table_name}")
-      table_nrows = cursor.fetchone()[0]
-      nrows.append(table_nrows)
+  nrows = get_row_counts(conn, list(tables.table_db_name))
   output = tables.copy()
-  output['nrows'] = nrows
-  output['columns'] = all_columns
+  output['nrows'] = [nrows[table_name] for table_name in tables.table_db_name]
+  output['columns'] = [
+    ', '.join(catalog.get_table_by_db_name(table_name)['columns'])
+    for table_name in tables.table_db_name
+  ]
   return output
 
 # Get all relationships in database
@@ -41,38 +43,60 @@ def get_all_relationships(conn):
   )
   return df
 
-def translate_odata(database_uri, table_name, odata_query):
-  from odata_query.sqlalchemy import apply_odata_query
-  from sqlalchemy import create_engine, MetaData, Table
-  from sqlalchemy.orm import mapper, sessionmaker
-  from sqlalchemy.dialects import sqlite
-
-  # Autoload model
-  class TempTable():
-    pass
-
-  engine = create_engine(database_uri)
-  metadata = MetaData(engine)
-  tbl = Table(table_name, metadata, autoload=True)
-  mapper(TempTable, tbl)
-
-  # Create a session
-  Session = sessionmaker(bind=engine)
-  session = Session()
-
-  # Create a fake query and translate
-  orm_query = session.query(TempTable)
-  translated_query = apply_odata_query(orm_query, odata_query)
-  
-  # Extract full statement
-  statement = str(translated_query.statement.compile(
-    dialect=sqlite.dialect(),
-    compile_kwargs={"literal_binds": True}))
-  
-  # Cleanup
-  session.close()
+# Get one page of a table for the admin table viewer. `args` are DataTables
+# server-side parameters: `start`/`length` for paging, `order[0][...]` for
+# sorting and `search[value]`/`columns[i][search][value]` for filtering.
+def get_table_page(conn, table_db_name, columns, args):
+  records_total = get_row_counts(conn, [table_db_name])[table_db_name]
+  start = max(int(args.get('start', 0)), 0)
+  length = int(args.get('length', 10))
+  max_length = app.config['ITEMS_PAGE_SIZE']
+  length = max_length if length < 0 else min(length, max_length)
+
+  # Global search on any column, and searches on single columns. Search terms
+  # are matched literally, so `%` and `_` are escaped.
+  like_sql = 'CAST("{}" AS TEXT) LIKE ? ESCAPE \'\\\''
+  where_clauses, where_params = [], []
+  search = args.get('search[value]', '').strip()
+  if search:
+    where_clauses.append('(' + ' OR '.join([like_sql.format(col) for col in columns]) + ')')
+    where_params.extend([f'%{escape_like(search)}%'] * len(columns))
+  for i, col in enumerate(columns):
+    col_search = args.get(f'columns[{i}][search][value]', '').strip()
+    if col_search:
+      where_clauses.append(like_sql.format(col))
+      where_params.append(f'%{escape_like(col_search)}%')
+  where = f" WHERE {' AND '.join(where_clauses)}" if where_clauses else ''
+
+  # Sort on one column, breaking ties by rowid so pages don't overlap
+  order_by = 'rowid'
+  sort_index = int(args.get('order[0][column]', -1))
+  if 0 <= sort_index < len(columns):
+    direction = 'DESC' if args.get('order[0][dir]') == 'desc' else 'ASC'
+    order_by = f'"{columns[sort_index]}" {direction}, rowid'
+
+  select_cols = ', '.join([f'"{col}"' for col in columns])
+  rows = conn.execute(
+    f'SELECT {select_cols} FROM "{table_db_name}"{where} ORDER BY {order_by} LIMIT ? OFFSET ?',
+    where_params + [length, start]
+  ).fetchall()
+  if where_clauses:
+    records_filtered = conn.execute(f'SELECT COUNT(*) FROM "{table_db_name}"{where}', where_params).fetchone()[0]
+  else:
+    records_filtered = records_total
+  return {
+    'draw': int(args.get('draw', 0)),
+    'recordsTotal': records_total,
+    'recordsFiltered': records_filtered,
+    'data': [list(row) for row in rows],
+  }
 
-  return statement
+# Translate an OData query on a table into SQL with odata-query. Engines,
+# reflected tables and translated statements are cached (see
+# `project.translator`). Not used by the items endpoints, which compile
+# `$filter` with `project.odata`.
+def translate_odata(database_uri, table_name, odata_query):
+  return get_translator(database_uri).translate(table_name, odata_query)
 
 
 # Validator: NotEqualTo
@@ -112,68 +136,90 @@ class NotEqualTo:
 
       raise ValidationError(message % d)
 
-# Function to parse OData filters
-def parse_odata_filter(query, joins, curr_db_table):
-  # Replace ID columns
-  query = re.sub('^Id', f'{curr_db_table}.Id', query)
-  # Replace lookup column with the associated table
-  main_col_matches = re.findall('\w+\/', query)
-  main_col_replacements = []
-  for match in main_col_matches:
-    main_col_replacements.append(joins[match[:-1]]['table'])
-  for match, replacement in zip(main_col_matches, main_col_replacements):
-    query = re.sub(match, replacement + '.', query)
-  
-  # Replace slashes with dots
-  # query = query.replace('/', '.')
-  # lt
-  query = query.replace(' lt ', ' < ')
-  # le
-  query = query.replace(' le ', ' <= ')
-  # gt
-  query = query.replace(' gt ', ' > ')
-  # ge
-  query = query.replace(' ge ', ' >= ')
-  # eq
-  query = query.replace(' eq ', ' = ')
-  # ne
-  query = query.replace(' ne ', ' != ')
-  # startswith(column, string)
-  query = re.sub('startsWith', 'startswith', query, re.IGNORECASE)
-  matches_sw = re.findall('startswith\(.*?\)', query)
-  if len(matches_sw) > 0:
-    for match in matches_sw:
-      # Extract text between brackets
-      sw_terms = re.sub('.*\(', '', match)
-      sw_terms = re.sub('\).*', '', sw_terms)
-      sw_terms = [s.strip() for s in sw_terms.split(',')]
-      sw_terms[1] = re.sub('[^a-zA-Z0-9]', '', sw_terms[1])
-      query = re.sub(match.replace('(', '\(').replace(')', '\)'), f"{sw_terms[0]} LIKE '{sw_terms[1]}%'", query)
-      
-  # substringof(string, column)
-  matches_so = re.findall('substringof\(.*?\)', query, re.IGNORECASE)
-  if len(matches_so) > 0:
-    for match in matches_so:
-      # Extract text between brackets
-      so_terms = re.sub('.*\(', '', match)
-      so_terms = re.sub('\).*', '', so_terms)
-      so_terms = [s.strip() for s in so_terms.split(',')]
-      so_terms[0] = re.sub('[^a-zA-Z0-9]', '', so_terms[0])
-      query = re.sub(match.replace('(', '\(').replace(')', '\)'), f"{so_terms[1]} LIKE '%{so_terms[0]}%'", query)
-  
-  # day()
+# Query statistics reported in request diagnostics
+class QueryStats:
+  def __init__(self):
+    self.queries = 0
+    self.rows_read = 0
+
+  def to_dict(self):
+    return {'queries': self.queries, 'rows_read': self.rows_read}
+
+# Run a parameterised query and load the results into a DataFrame
+@timed('sql')
+def read_sql(conn, sql, params, stats=None):
+  start = time.perf_counter()
+  cursor = conn.execute(sql, params)
+  columns = [col[0] for col in cursor.description]
+  rows = cursor.fetchall()
+  logger.debug('Query', extra={
+    'sql': sql, 'params': params, 'rows': len(rows), 'elapsed_ms': (time.perf_counter() - start) * 1000
+  })
+  if stats is not None:
+    stats.queries += 1
+    stats.rows_read += len(rows)
+  return pd.DataFrame.from_records(rows, columns=columns)
+
+# Coerce a lookup field value: nulls become '' and numbers become integers
+def clean_lookup_value(value):
+  if value is None:
+    return ''
+  if isinstance(value, (int, float)) and not isinstance(value, bool):
+    return int(value)
+  return value
+
+# Coerce a lookup field column: nulls become '' and numbers become integers
+def clean_lookup_values(series):
+  if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+    isnull = series.isna().to_numpy()
+    values = series.fillna(0).astype('int64').astype(object).to_numpy()
+    values[isnull] = ''
+    return values.tolist()
+  return series.where(series.notna(), '').tolist()
+
+# Nest `<lookup_col>__<field>` columns into one column of dicts
+def nest_lookup_columns(data, lookup_col):
+  prefix = f'{lookup_col}__'
+  sub_cols = [col for col in data.columns if col.startswith(prefix)]
+  keys = [col[len(prefix):] for col in sub_cols]
+  values = [clean_lookup_values(data[col]) for col in sub_cols]
+  data = data.drop(sub_cols, axis=1)
+  data[lookup_col] = [dict(zip(keys, row)) for row in zip(*values)] if values else [{}] * len(data)
+  return data
+
+# Check if a registered table has a column
+def has_column(table_db_name, column):
+  table = catalog.get_table_by_db_name(table_db_name)
+  return table is not None and column in table['columns']
 
-  # month()
-  
-  # year()
-  
-  # hour()
-  
-  # minute()
-  
-  # second()
+# Function to parse OData filters
+def parse_odata_filter(query, joins, curr_db_table, used_columns=None):
+  '''
+  Compile an OData filter into a parameterised WHERE clause. Returns a tuple of
+  the SQL (with `?` placeholders), the list of bind values and their slots
+  (see `project.odata.fill_params`). If given, `used_columns` is extended
+  with the `(table, column)` pairs referenced.
+  '''
+  if not query:
+    return '', [], []
+
+  # Resolve main table columns and `lookupColumn/field` references, checking
+  # them against the catalog so unknown columns are rejected before any SQL runs
+  def resolve_column(lookup, name):
+    if lookup is None:
+      table = curr_db_table
+    elif lookup not in joins:
+      raise ODataFilterError(f'Lookup field {lookup} not specified in $expand parameter.')
+    else:
+      table = joins[lookup]['table']
+    if not has_column(table, name):
+      field = name if lookup is None else f'{lookup}/{name}'
+      raise ODataFilterError(f"Column '{field}' does not exist.")
+    if used_columns is not None:
+      used_columns.append((table, name))
+    return f'{table}.{name}'
 
-  return query
+  return compile_filter(query, resolve_column)
 
 
 # Function to parse OData query
@@ -201,8 +247,116 @@ def parse_odata_query(query):
         output['expand_cols'].extend(columns)
   return output
 
+# Function to parse paging params
+def parse_odata_paging(query, default_page_size=None):
+  '''
+  Extract `$top`, `$skip` and `$skiptoken` into a page size, an offset, the
+  last Id of the previous page (`p_ID`) and its sort values. Raises ValueError
+  on bad input.
+  '''
+  output = {
+    'page_size': default_page_size,
+    'skip': 0,
+    'after_id': None,
+    'after': {}
+  }
+  for key, name in [('$top', 'page_size'), ('$skip', 'skip')]:
+    value = query.get(key)
+    if value is None:
+      continue
+    try:
+      output[name] = int(value)
+    except ValueError:
+      raise ValueError(f'{key} must be an integer.')
+    if output[name] < 0:
+      raise ValueError(f'{key} must not be negative.')
+
+  # Sort values of the last item are passed as `p_<column>`
+  skiptoken = query.get('$skiptoken')
+  if skiptoken:
+    token = parse_qs(skiptoken, keep_blank_values=True)
+    try:
+      output['after_id'] = int(token['p_ID'][0])
+    except (KeyError, ValueError):
+      raise ValueError("Invalid $skiptoken. Expected 'Paged=TRUE&p_ID=<Id>'.")
+    output['after'] = {k[2:]: v[0] for k, v in token.items() if k.startswith('p_') and k != 'p_ID'}
+  return output
+
+# Check if an item exists with a primary key lookup
+def item_exists(table_db_name, item_id):
+  try:
+    item_id = int(item_id)
+  except (TypeError, ValueError):
+    return False
+  with connect() as conn:
+    cursor = conn.execute(f'SELECT 1 FROM {table_db_name} WHERE Id = ?', (item_id,))
+    return cursor.fetchone() is not None
+
+# Check if a declared SQLite column type holds integers or floats
+def is_numeric_type(declared_type):
+  declared_type = (declared_type or '').upper()
+  return any(name in declared_type for name in ['INT', 'REAL', 'FLOA', 'DOUB'])
+
+# Map the fields of a create/update payload to table columns. Lookup columns
+# may be given by their implicit Id field, e.g. `parentTableId`.
+def get_item_values(data, column_types):
+  values = {}
+  for k, v in data.items():
+    if k in ['Id', '__metadata']:
+      continue
+    # Convert implicit lookup column Id
+    if (len(k) > 2) and ('/' not in k) and (k[-2:] == 'Id') and (k != 'parentKrId'):
+      k = k[:-2]
+    if k not in column_types:
+      raise ValueError(f'no such column: {k}')
+    values[k] = v
+  return values
+
+# Build parameterised INSERT/UPDATE/DELETE queries for list items
+def build_insert_query(table_db_name, column_types, data):
+  values = get_item_values(data, column_types)
+  if not values:
+    return f'INSERT INTO {table_db_name} DEFAULT VALUES', []
+  query = f"INSERT INTO {table_db_name} ({', '.join(values)}) VALUES ({', '.join(['?'] * len(values))})"
+  return query, list(values.values())
+
+# Insert many items on `conn` without committing, with one `executemany` for
+# each run of items with the same fields. Returns the new Ids in order.
+@timed('write')
+def insert_items(conn, table_db_name, column_types, items):
+  runs = []
+  for item in items:
+    values = get_item_values(item, column_types)
+    if not runs or runs[-1][0] != tuple(values):
+      runs.append((tuple(values), []))
+    runs[-1][1].append(list(values.values()))
+
+  ids = []
+  for columns, rows in runs:
+    if columns:
+      query = f"INSERT INTO {table_db_name} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+    else:
+      query = f'INSERT INTO {table_db_name} (Id) VALUES (NULL)'
+    conn.executemany(query, rows)
+    # Rowids are assigned consecutively within the write transaction
+    last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    ids.extend(range(last_id - len(rows) + 1, last_id + 1))
+  adjust_row_count(conn, table_db_name, len(ids))
+  bump_list_version(conn, table_db_name)
+  return ids
+
+def build_update_query(table_db_name, column_types, item_id, data):
+  values = get_item_values(data, column_types)
+  if not values:
+    raise ValueError('no fields to update')
+  query = f"UPDATE {table_db_name} SET {', '.join([f'{k} = ?' for k in values])} WHERE Id = ?"
+  return query, list(values.values()) + [int(item_id)]
+
+def build_delete_query(table_db_name, item_id):
+  return f'DELETE FROM {table_db_name} WHERE Id = ?', [int(item_id)]
+
 # Function to validate create/update query
-conn_string = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
+@timed('validate')
 def validate_create_update_query(headers, data, list_id, update=False, item_id=None):
   # 1. Check headers
   xRequestDigest = headers.get('X-RequestDigest')
@@ -211,49 +365,48 @@ def validate_create_update_query(headers, data, list_id, update=False, item_id=N
   if update:
     # Check IF-MATCH
     ifMatch = headers.get('IF-MATCH')
-    if ifMatch is None or ifMatch != '*':
+    if ifMatch is None or not is_valid_if_match(ifMatch):
       return { 'BadRequest': f"Incorrect value for IF-MATCH header." }
     # Check X-HTTP-METHOD
     xHttpMethod = headers.get('X-HTTP-METHOD')
     if xHttpMethod is None or xHttpMethod != 'MERGE':
       return { 'BadRequest': f"Incorrect value for X-HTTP-METHOD header." }
   
-  # 2. Check for metadata
-  metadata = data.get('__metadata')
-  if metadata is None:
+  # 2. Check for metadata. Items may be created in bulk from a list.
+  items = data if isinstance(data, list) and not update else [data]
+  if not items:
+    return { 'BadRequest': 'No items to add.' }
+  if any([not isinstance(item, dict) or item.get('__metadata') is None for item in items]):
     return { 'BadRequest': 'Missing JSON item: `__metadata`' }
 
   # 3. Check ListItemEntityTypeFullName (LIETFN)
   # Check if list exists
-  with sqlite3.connect(conn_string) as conn:
-    all_tables = get_all_table_names(conn)
-  if list_id not in all_tables.id.tolist():
+  table = catalog.get_table(list_id)
+  if table is None:
     return { 'BadRequest': 'List does not exist.' }
-  # Get metadata
-  table = all_tables \
-      .rename(columns={'id': 'Id'}) \
-      .loc[all_tables.id.eq(list_id)].to_dict('records')[0]
   table_pascal = table['table_db_name'].title().replace('_', '')
   lietfn = f'SP.Data.{table_pascal}ListItem'
   # Retrieve metadata from request
-  request_lietfn = metadata.get('type')
-  if request_lietfn is None:
-    return { 'BadRequest': 'Missing ListItemEntityTypeFullName.' }
-  if request_lietfn != lietfn:
-    return { 'BadRequest': 'Incorrect ListItemEntityTypeFullName.' }
+  for item in items:
+    request_lietfn = item['__metadata'].get('type')
+    if request_lietfn is None:
+      return { 'BadRequest': 'Missing ListItemEntityTypeFullName.' }
+    if request_lietfn != lietfn:
+      return { 'BadRequest': 'Incorrect ListItemEntityTypeFullName.' }
 
   # Check if item exists
-  with sqlite3.connect(conn_string) as conn:
-    df = pd.read_sql(f"SELECT * FROM {table['table_db_name']}", conn)
-  if update and int(item_id) not in df.Id.values:
+  if update and not item_exists(table['table_db_name'], item_id):
     return { 'BadRequest': 'Item does not exist.' }
   
   return { 
     'Success': True,
     'table': table['table_db_name'],
-    'data': df
+    'column_types': table['column_types'],
+    # Item version to check, from IF-MATCH (None for `*`)
+    'etag': parse_if_match(headers.get('IF-MATCH')) if update else None
   }
 
+@timed('validate')
 def validate_delete_query(headers, list_id, item_id=None):
   # 1. Check headers
   xRequestDigest = headers.get('X-RequestDigest')
@@ -262,7 +415,7 @@ def validate_delete_query(headers, list_id, item_id=None):
   
   # Check IF-MATCH
   ifMatch = headers.get('IF-MATCH')
-  if ifMatch is None or ifMatch != '*':
+  if ifMatch is None or not is_valid_if_match(ifMatch):
     return { 'BadRequest': f"Incorrect value for IF-MATCH header." }
   # Check X-HTTP-METHOD
   xHttpMethod = headers.get('X-HTTP-METHOD')
@@ -271,27 +424,23 @@ def validate_delete_query(headers, list_id, item_id=None):
 
   # 3. Check ListItemEntityTypeFullName (LIETFN)
   # Check if list exists
-  with sqlite3.connect(conn_string) as conn:
-    all_tables = get_all_table_names(conn)
-  if list_id not in all_tables.id.tolist():
+  table = catalog.get_table(list_id)
+  if table is None:
     return { 'BadRequest': 'List does not exist.' }
-  # Get metadata
-  table = all_tables \
-      .rename(columns={'id': 'Id'}) \
-      .loc[all_tables.id.eq(list_id)].to_dict('records')[0]
 
   # Check if item exists
-  with sqlite3.connect(conn_string) as conn:
-    df = pd.read_sql(f"SELECT * FROM {table['table_db_name']}", conn)
-  if int(item_id) not in df.Id.values:
+  if not item_exists(table['table_db_name'], item_id):
     return { 'BadRequest': 'Item does not exist.' }
   
   return { 
     'Success': True,
     'table': table['table_db_name'],
-    'data': df
+    'column_types': table['column_types'],
+    # Item version to check, from IF-MATCH (None for `*`)
+    'etag': parse_if_match(ifMatch)
   }
 
+@timed('validate')
 def validate_create_update_query_listname(headers, data, list_name, update=False, item_id=None):
   # 1. Check headers
   xRequestDigest = headers.get('X-RequestDigest')
@@ -300,53 +449,52 @@ def validate_create_update_query_listname(headers, data, list_name, update=False
   if update:
     # Check IF-MATCH
     ifMatch = headers.get('IF-MATCH')
-    if ifMatch is None or ifMatch != '*':
+    if ifMatch is None or not is_valid_if_match(ifMatch):
       return { 'BadRequest': f"Incorrect value for IF-MATCH header." }
     # Check X-HTTP-METHOD
     xHttpMethod = headers.get('X-HTTP-METHOD')
     if xHttpMethod is None or xHttpMethod != 'MERGE':
       return { 'BadRequest': f"Incorrect value for X-HTTP-METHOD header." }
   
-  # 2. Check for metadata
-  metadata = data.get('__metadata')
-  if metadata is None:
+  # 2. Check for metadata. Items may be created in bulk from a list.
+  items = data if isinstance(data, list) and not update else [data]
+  if not items:
+    return { 'BadRequest': 'No items to add.' }
+  if any([not isinstance(item, dict) or item.get('__metadata') is None for item in items]):
     return { 'BadRequest': 'Missing JSON item: `__metadata`' }
 
   # 3. Check ListItemEntityTypeFullName (LIETFN)
   # Check if list exists
-  with sqlite3.connect(conn_string) as conn:
-    all_tables = get_all_table_names(conn)
-  if list_name not in all_tables.table_name.tolist():
+  table = catalog.get_table_by_title(list_name)
+  if table is None:
     return { 'BadRequest': 'List does not exist.' }
-  # Get metadata
-  table = all_tables \
-      .rename(columns={'id': 'Id'}) \
-      .loc[all_tables.table_name.eq(list_name)].to_dict('records')[0]
   # table_pascal = table['table_db_name'].title().replace('_', '')
   table_pascal = table['table_name']
   lietfn = f'SP.Data.{table_pascal}ListItem'
   # Retrieve metadata from request
-  request_lietfn = metadata.get('type')
-  if request_lietfn is None:
-    return { 'BadRequest': 'Missing ListItemEntityTypeFullName.' }
-  if request_lietfn != lietfn:
-    return { 'BadRequest': 'Incorrect ListItemEntityTypeFullName.' }
+  for item in items:
+    request_lietfn = item['__metadata'].get('type')
+    if request_lietfn is None:
+      return { 'BadRequest': 'Missing ListItemEntityTypeFullName.' }
+    if request_lietfn != lietfn:
+      return { 'BadRequest': 'Incorrect ListItemEntityTypeFullName.' }
 
   # Check if item exists
-  with sqlite3.connect(conn_string) as conn:
-    df = pd.read_sql(f"SELECT * FROM {table['table_db_name']}", conn)
-  if update and int(item_id) not in df.Id.values:
+  if update and not item_exists(table['table_db_name'], item_id):
     return { 'BadRequest': 'Item does not exist.' }
   
   return { 
     'Success': True,
     'table': table['table_db_name'],
-    'data': df
+    'column_types': table['column_types'],
+    # Item version to check, from IF-MATCH (None for `*`)
+    'etag': parse_if_match(headers.get('IF-MATCH')) if update else None
   }
 
 
 
 
+@timed('validate')
 def validate_delete_query_listname(headers, list_name, item_id=None):
 
   # 1. Check headers
@@ -356,7 +504,7 @@ def validate_delete_query_listname(headers, list_name, item_id=None):
   
   # Check IF-MATCH
   ifMatch = headers.get('IF-MATCH')
-  if ifMatch is None or ifMatch != '*':
+  if ifMatch is None or not is_valid_if_match(ifMatch):
     return { 'BadRequest': f"Incorrect value for IF-MATCH header." }
   # Check X-HTTP-METHOD
   xHttpMethod = headers.get('X-HTTP-METHOD')
@@ -365,25 +513,20 @@ def validate_delete_query_listname(headers, list_name, item_id=None):
 
   # 3. Check ListItemEntityTypeFullName (LIETFN)
   # Check if list exists
-  with sqlite3.connect(conn_string) as conn:
-    all_tables = get_all_table_names(conn)
-  if list_name not in all_tables.table_name.tolist():
+  table = catalog.get_table_by_title(list_name)
+  if table is None:
     return { 'BadRequest': 'List does not exist.' }
-  # Get metadata
-  table = all_tables \
-      .rename(columns={'id': 'Id'}) \
-      .loc[all_tables.table_name.eq(list_name)].to_dict('records')[0]
 
   # Check if item exists
-  with sqlite3.connect(conn_string) as conn:
-    df = pd.read_sql(f"SELECT * FROM {table['table_db_name']}", conn)
-  if int(item_id) not in df.Id.values:
+  if not item_exists(table['table_db_name'], item_id):
     return { 'BadRequest': 'Item does not exist.' }
   
   return { 
     'Success': True,
     'table': table['table_db_name'],
-    'data': df
+    'column_types': table['column_types'],
+    # Item version to check, from IF-MATCH (None for `*`)
+    'etag': parse_if_match(ifMatch)
   }
 
 
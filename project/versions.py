@@ -0,0 +1,107 @@
+# RAVENPOINT CHANGE VERSIONS
+# Change versions for lists and list items, bumped by the write paths in the
+# same transaction as the write. They are kept in SQLite, so they survive
+# restarts and are shared by all worker processes. List versions key the
+# result cache and list ETags; item versions are the item ETags checked
+# against IF-MATCH. Items that were never changed are at version 1. The tables
+# are created once when the app starts.
+import hashlib
+import json
+
+LIST_VERSIONS_TABLE = 'rp_list_versions'
+ITEM_VERSIONS_TABLE = 'rp_item_versions'
+CREATE_VERSIONS_TABLES = [
+  f'CREATE TABLE IF NOT EXISTS {LIST_VERSIONS_TABLE} (table_db_name TEXT PRIMARY KEY, version INTEGER)',
+  f'''CREATE TABLE IF NOT EXISTS {ITEM_VERSIONS_TABLE} (
+    table_db_name TEXT, item_id INTEGER, version INTEGER,
+    PRIMARY KEY (table_db_name, item_id)) WITHOUT ROWID''',
+]
+
+def create_versions_tables(conn):
+  '''Create the version tables if they don't exist, on app startup.'''
+  for statement in CREATE_VERSIONS_TABLES:
+    conn.execute(statement)
+
+def get_bump_list_version_sql(table_db_name):
+  '''Get the statements bumping a list's version, for DDL transactions.'''
+  return [
+    f'''INSERT INTO {LIST_VERSIONS_TABLE} (table_db_name, version) VALUES ('{table_db_name}', 1)
+    ON CONFLICT (table_db_name) DO UPDATE SET version = version + 1'''
+  ]
+
+def bump_list_version(conn, table_db_name):
+  '''Bump a list's version on `conn`, without committing.'''
+  for statement in get_bump_list_version_sql(table_db_name):
+    conn.execute(statement)
+
+def get_list_versions(conn, table_db_names):
+  '''Get the versions of lists as a tuple in the same order.'''
+  rows = conn.execute(
+    f"SELECT table_db_name, version FROM {LIST_VERSIONS_TABLE} WHERE table_db_name IN ({', '.join(['?'] * len(table_db_names))})",
+    list(table_db_names)
+  ).fetchall()
+  versions = dict(rows)
+  return tuple([versions.get(name, 0) for name in table_db_names])
+
+def bump_item_version(conn, table_db_name, item_id):
+  '''Bump an item's version on `conn`, without committing. Returns the new version.'''
+  conn.execute(
+    f'''INSERT INTO {ITEM_VERSIONS_TABLE} (table_db_name, item_id, version) VALUES (?, ?, 2)
+    ON CONFLICT (table_db_name, item_id) DO UPDATE SET version = version + 1''',
+    (table_db_name, int(item_id))
+  )
+  return get_item_version(conn, table_db_name, item_id)
+
+def record_item_change(conn, table_db_name, item_id, etag=None):
+  '''
+  After updating or deleting an item on `conn`, check that it was at version
+  `etag` (if given) and bump its version and its list's. The write holds the
+  database lock, so the item can't change in between. Returns the new item
+  version, or None if the item had changed and the caller should roll back.
+  '''
+  if etag is not None and get_item_version(conn, table_db_name, item_id) != etag:
+    return None
+  bump_list_version(conn, table_db_name)
+  return bump_item_version(conn, table_db_name, item_id)
+
+def get_item_versions(conn, table_db_name):
+  '''Get `{item_id: version}` for the items of a list that were ever changed.'''
+  return dict(conn.execute(
+    f'SELECT item_id, version FROM {ITEM_VERSIONS_TABLE} WHERE table_db_name = ?', (table_db_name,)
+  ).fetchall())
+
+def get_item_version(conn, table_db_name, item_id):
+  row = conn.execute(
+    f'SELECT version FROM {ITEM_VERSIONS_TABLE} WHERE table_db_name = ? AND item_id = ?',
+    (table_db_name, int(item_id))
+  ).fetchone()
+  return row[0] if row else 1
+
+# ETags
+def format_item_etag(version):
+  '''Format an item version as an ETag header value, e.g. `"2"`.'''
+  return f'"{version}"'
+
+def parse_if_match(value):
+  '''
+  Get the item version in an IF-MATCH header, or None for `*`. Raises
+  ValueError for anything else.
+  '''
+  value = value.strip()
+  if value == '*':
+    return None
+  if value.startswith('W/'):
+    value = value[2:]
+  return int(value.strip('"'))
+
+def is_valid_if_match(value):
+  try:
+    parse_if_match(value)
+  except ValueError:
+    return False
+  return True
+
+def get_list_etag(url, args, versions):
+  '''Get an (unquoted) ETag for a read from its URL, query parameters and list versions.'''
+  params = sorted([(key, value.strip()) for key, value in args.items(multi=True)])
+  return hashlib.md5(json.dumps([url, params, versions]).encode()).hexdigest()
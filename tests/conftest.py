@@ -0,0 +1,8 @@
+# Point the app at a temporary database before it is imported
+import os
+import sys
+import tempfile
+
+DATA_DIR = tempfile.mkdtemp(prefix='ravenpoint-tests-')
+os.environ['RAVENPOINT_DATABASE'] = os.path.join(DATA_DIR, 'test.sqlite')
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
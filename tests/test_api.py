@@ -0,0 +1,59 @@
+import pytest
+from project import app, db
+from project.admin.views import load_table_job, add_multi_relationship_job
+
+ITEMS_URL = "/ravenpoint/_api/web/lists/GetByTitle('test_items')/items"
+
+def no_progress(*args, **kwargs):
+  pass
+
+def load_table(tmp_path, table_name, csv):
+  filepath = tmp_path / f'{table_name}.csv'
+  filepath.write_text(csv)
+  load_table_job(no_progress, str(filepath), table_name, table_name)
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+  tmp_path = tmp_path_factory.mktemp('csv')
+  with app.app_context():
+    db.create_all()
+    # Tags 0 and 1 have the same title
+    load_table(tmp_path, 'test_tags', 'Id,Title\n1,dup\n2,dup\n3,other\n')
+    load_table(tmp_path, 'test_people', 'Id,Title\n1,Ann\n2,Bob\n')
+    load_table(tmp_path, 'test_items', 'Id,Title,tags,people\n1,A,"0,1",0\n2,B,2,"0,1"\n3,C,,\n')
+    add_multi_relationship_job(no_progress, 'test_items', 'tags', 'test_tags', '')
+    add_multi_relationship_job(no_progress, 'test_items', 'people', 'test_people', '')
+  return app.test_client()
+
+def get_items(client, query):
+  response = client.get(f'{ITEMS_URL}?{query}')
+  assert response.status_code == 200, response.get_data(as_text=True)
+  return {item['Title']: item for item in response.get_json()['value']}
+
+def test_multi_lookup_keeps_items_with_the_same_values(client):
+  items = get_items(client, '$select=Title,tags/Title&$expand=tags')
+  assert items['A']['tags'] == [{'Title': 'dup'}, {'Title': 'dup'}]
+  assert items['B']['tags'] == [{'Title': 'other'}]
+  assert items['C']['tags'] == []
+
+def test_multi_lookups_expanded_together_are_not_multiplied(client):
+  items = get_items(client, '$select=Title,tags/Title,people/Title&$expand=tags,people')
+  assert items['A']['tags'] == [{'Title': 'dup'}, {'Title': 'dup'}]
+  assert items['A']['people'] == [{'Title': 'Ann'}]
+  assert items['B']['tags'] == [{'Title': 'other'}]
+  assert items['B']['people'] == [{'Title': 'Ann'}, {'Title': 'Bob'}]
+
+def test_filter_on_multi_lookup_returns_each_item_once(client):
+  items = get_items(client, "$select=Title,people/Title&$expand=people&$filter=people/Title eq 'Ann'")
+  assert sorted(items) == ['A', 'B']
+  assert items['B']['people'] == [{'Title': 'Ann'}, {'Title': 'Bob'}]
+
+@pytest.mark.parametrize('query', [
+  "$filter=missing eq 'x'",
+  "$select=Title,tags/missing&$expand=tags&$filter=tags/Title eq 'dup'",
+  '$select=missing',
+  '$orderby=missing',
+  '$filter=Title',
+])
+def test_invalid_queries_are_bad_requests(client, query):
+  assert client.get(f'{ITEMS_URL}?{query}').status_code == 400
@@ -0,0 +1,49 @@
+import sqlite3
+import pytest
+from project.connections import connect, conn_string
+
+@pytest.fixture
+def table():
+  with connect() as conn:
+    conn.execute('CREATE TABLE IF NOT EXISTS test_nesting (value INTEGER)')
+    conn.execute('DELETE FROM test_nesting')
+  yield 'test_nesting'
+  with connect() as conn:
+    conn.execute('DROP TABLE test_nesting')
+
+def get_committed_values(table):
+  # Read through a separate connection, which only sees committed rows
+  with sqlite3.connect(conn_string) as conn:
+    return [row[0] for row in conn.execute(f'SELECT value FROM {table} ORDER BY value')]
+
+def test_connect_returns_the_thread_connection():
+  assert connect() is connect()
+
+def test_inner_block_does_not_commit_outer_transaction(table):
+  with connect() as outer:
+    outer.execute(f'INSERT INTO {table} VALUES (1)')
+    with connect() as inner:
+      assert inner is outer
+      inner.execute(f'INSERT INTO {table} VALUES (2)')
+    assert outer.in_transaction
+    assert get_committed_values(table) == []
+  assert get_committed_values(table) == [1, 2]
+
+def test_inner_block_rolls_back_only_its_own_work(table):
+  with connect() as outer:
+    outer.execute(f'INSERT INTO {table} VALUES (1)')
+    with pytest.raises(ValueError):
+      with connect() as inner:
+        inner.execute(f'INSERT INTO {table} VALUES (2)')
+        raise ValueError
+    outer.execute(f'INSERT INTO {table} VALUES (3)')
+  assert get_committed_values(table) == [1, 3]
+
+def test_outer_error_rolls_back_inner_work(table):
+  with pytest.raises(ValueError):
+    with connect():
+      with connect() as inner:
+        inner.execute(f'INSERT INTO {table} VALUES (1)')
+      assert get_committed_values(table) == []
+      raise ValueError
+  assert get_committed_values(table) == []
@@ -0,0 +1,114 @@
+import sqlite3
+import pytest
+from project.odata import ODataFilterError, compile_filter, fill_params, get_filter_shape, parse_filter
+
+COLUMNS = {'Title', 'score', 'owner', 'updated'}
+
+def resolve_column(lookup, name):
+  if lookup is None and name in COLUMNS:
+    return f't.{name}'
+  if lookup == 'parent' and name == 'Title':
+    return 'p.Title'
+  field = name if lookup is None else f'{lookup}/{name}'
+  raise ODataFilterError(f"Column '{field}' does not exist.")
+
+def compile(query):
+  sql, params, _ = compile_filter(query, resolve_column)
+  return sql, params
+
+@pytest.fixture
+def conn():
+  conn = sqlite3.connect(':memory:')
+  conn.execute('CREATE TABLE t (Id INTEGER PRIMARY KEY, Title TEXT, score REAL, owner TEXT, updated TEXT)')
+  conn.executemany('INSERT INTO t VALUES (?, ?, ?, ?, ?)', [
+    (1, "O'Brien", 1.5, 'Branch 1', '2021-01-02'),
+    (2, '100% done', 2.5, 'Branch 2', '2022-03-04'),
+    (3, 'a_b', None, None, '2020-05-06'),
+    (4, 'ab', 4.0, 'Branch 1', None),
+  ])
+  yield conn
+  conn.close()
+
+def select_ids(conn, query):
+  sql, params = compile(query)
+  return [row[0] for row in conn.execute(f'SELECT Id FROM t WHERE {sql} ORDER BY Id', params)]
+
+def test_comparison_binds_literals():
+  assert compile("Title eq 'x' and score gt 2") == ('(t.Title = ? AND t.score > ?)', ['x', 2])
+
+def test_quotes_are_unescaped(conn):
+  assert compile("Title eq 'O''Brien'") == ('t.Title = ?', ["O'Brien"])
+  assert select_ids(conn, "Title eq 'O''Brien'") == [1]
+
+def test_like_wildcards_are_escaped(conn):
+  sql, params = compile("substringof('%', Title)")
+  assert sql == "t.Title LIKE ? ESCAPE '\\'"
+  assert params == ['%\\%%']
+  assert select_ids(conn, "substringof('%', Title)") == [2]
+  assert select_ids(conn, "substringof('_', Title)") == [3]
+  assert select_ids(conn, "startswith(Title, 'a_')") == [3]
+  assert select_ids(conn, "endswith(Title, '%')") == []
+
+def test_nested_function_calls(conn):
+  assert compile("startswith(tolower(Title), 'ab')") == ("lower(t.Title) LIKE ? ESCAPE '\\'", ['ab%'])
+  assert select_ids(conn, "startswith(tolower(owner), 'branch')") == [1, 2, 4]
+  assert select_ids(conn, "endswith(toupper(Title), 'AB')") == [4]
+  assert select_ids(conn, "substringof('BRIEN', toupper(Title))") == [1]
+  assert select_ids(conn, "year(updated) eq 2021") == [1]
+
+def test_null_comparisons(conn):
+  assert compile('owner eq null') == ('t.owner IS NULL', [])
+  assert compile('null ne owner') == ('t.owner IS NOT NULL', [])
+  assert select_ids(conn, 'owner eq null') == [3]
+  assert select_ids(conn, 'owner ne null') == [1, 2, 4]
+  with pytest.raises(ODataFilterError):
+    compile('owner gt null')
+
+def test_and_binds_tighter_than_or(conn):
+  assert compile("score gt 3 or score lt 2 and owner eq 'Branch 1'")[0] == \
+    '(t.score > ? OR (t.score < ? AND t.owner = ?))'
+  assert select_ids(conn, "score gt 3 or score lt 2 and owner eq 'Branch 2'") == [4]
+  assert select_ids(conn, "(score gt 3 or score lt 2) and owner eq 'Branch 1'") == [1, 4]
+
+def test_not_applies_to_the_next_predicate(conn):
+  assert compile("not Title eq 'ab' and score gt 2")[0] == '(NOT (t.Title = ?) AND t.score > ?)'
+  assert select_ids(conn, "not (Title eq 'ab' or score eq null)") == [1, 2]
+
+@pytest.mark.parametrize('query', [
+  'score',
+  "Title eq 'x' and score",
+  "not tolower(Title)",
+  "'x'",
+  "score or Title eq 'x'",
+  'Title eq',
+  "Title eq 'x' )",
+  "Title eq 'x' ;",
+])
+def test_rejects_invalid_filters(query):
+  with pytest.raises(ODataFilterError):
+    compile(query)
+
+def test_parenthesized_operand_is_not_a_predicate():
+  assert compile('(score) gt 2') == ('t.score > ?', [2])
+
+@pytest.mark.parametrize('query', ["missing eq 1", "startswith(missing, 'a')", "parent/missing eq 'x'"])
+def test_rejects_unknown_columns(query):
+  with pytest.raises(ODataFilterError, match='does not exist'):
+    compile(query)
+
+@pytest.mark.parametrize('query', [
+  "Title eq 'O''Brien' and score ge 1.5",
+  "substringof('50%', Title) or startswith(owner, 'a_b')",
+  "endswith(Title, 'x') and not (owner eq null or updated lt datetime'2021-01-01')",
+  "year(updated) eq 2021 and parent/Title ne 'x'",
+])
+def test_fill_params_reproduces_the_parameters(query):
+  _, params, slots = compile_filter(query, resolve_column)
+  _, literals = get_filter_shape(query)
+  assert fill_params(slots, literals) == params
+
+def test_filters_with_the_same_shape_share_sql():
+  sql, _, slots = compile_filter("Title eq 'a' and substringof('b', owner)", resolve_column)
+  shape, literals = get_filter_shape("Title eq 'x_y' and substringof('100%', owner)")
+  assert shape == get_filter_shape("Title eq 'a' and substringof('b', owner)")[0]
+  assert compile("Title eq 'x_y' and substringof('100%', owner)") == (sql, fill_params(slots, literals))
@@ -0,0 +1,27 @@
+import pytest
+from project.connections import connect
+from project.rowcounts import get_row_counts, forget_row_count
+
+@pytest.fixture
+def table():
+  # A table loaded outside the app, so it has no row count yet
+  with connect() as conn:
+    conn.execute('CREATE TABLE IF NOT EXISTS test_counts (Id INTEGER PRIMARY KEY)')
+    conn.execute('DELETE FROM test_counts')
+    conn.executemany('INSERT INTO test_counts VALUES (?)', [(0,), (1,), (2,)])
+  yield 'test_counts'
+  with connect() as conn:
+    conn.execute('DROP TABLE test_counts')
+    forget_row_count(conn, 'test_counts')
+
+def test_missing_count_is_filled_in(table):
+  with connect() as conn:
+    assert get_row_counts(conn, [table]) == {table: 3}
+    assert conn.execute('SELECT nrows FROM rp_row_counts WHERE table_db_name = ?', (table,)).fetchone() == (3,)
+
+def test_getter_leaves_caller_transaction_open(table):
+  with connect() as conn:
+    conn.execute('BEGIN')
+    conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()
+    assert get_row_counts(conn, [table]) == {table: 3}
+    assert conn.in_transaction
@@ -0,0 +1,33 @@
+import pytest
+from project import app
+from project.connections import connect
+from project.translator import get_translator
+
+@pytest.fixture
+def table():
+  with connect() as conn:
+    conn.execute('CREATE TABLE IF NOT EXISTS test_translate (Id INTEGER PRIMARY KEY, Title TEXT)')
+  yield 'test_translate'
+  with connect() as conn:
+    conn.execute('DROP TABLE test_translate')
+
+def test_repeated_calls_reuse_cached_engine_tables_and_statements(table):
+  translator = get_translator(app.config['SQLALCHEMY_DATABASE_URI'])
+  translator.clear()
+  with app.app_context():
+    before = translator.get_stats()
+    first = translator.translate(table, "Title eq 'x' and Id gt 2")
+    engine = translator._engine
+    second = translator.translate(table, "Title eq 'x' and Id gt 2")
+    translator.translate(table, 'Id eq 1')
+    after = translator.get_stats()
+
+  assert second == first
+  assert 'WHERE' in first and "'x'" in first
+  assert translator._engine is engine
+  assert get_translator(app.config['SQLALCHEMY_DATABASE_URI']) is translator
+  # One reflection of the table and one cached statement per query
+  assert after['reflections'] - before['reflections'] == 1
+  assert after['hits'] - before['hits'] == 1
+  assert after['misses'] - before['misses'] == 2
+  assert after['statements'] == 2
@@ -0,0 +1,35 @@
+import pytest
+from project.connections import connect
+from project.rowcounts import forget_row_count
+from project.utils import get_table_page
+
+COLUMNS = ['Id', 'Title']
+
+@pytest.fixture
+def table():
+  with connect() as conn:
+    conn.execute('CREATE TABLE IF NOT EXISTS test_page (Id INTEGER PRIMARY KEY, Title TEXT)')
+    conn.execute('DELETE FROM test_page')
+    conn.executemany('INSERT INTO test_page VALUES (?, ?)', [
+      (0, '100% done'), (1, 'a_b'), (2, 'ab'), (3, 'C:\\temp'), (4, 'plain'),
+    ])
+  yield 'test_page'
+  with connect() as conn:
+    conn.execute('DROP TABLE test_page')
+    forget_row_count(conn, 'test_page')
+
+def search_titles(table, args):
+  with connect() as conn:
+    page = get_table_page(conn, table, COLUMNS, args)
+  return [row[1] for row in page['data']], page['recordsFiltered']
+
+@pytest.mark.parametrize('term, titles', [
+  ('%', ['100% done']),
+  ('_', ['a_b']),
+  ('\\', ['C:\\temp']),
+  ('a_', ['a_b']),
+  ('ab', ['ab']),
+])
+def test_search_matches_wildcards_literally(table, term, titles):
+  assert search_titles(table, {'search[value]': term}) == (titles, len(titles))
+  assert search_titles(table, {'columns[1][search][value]': term}) == (titles, len(titles))